@@ -26,6 +26,7 @@ async def users_list(
         "request": request,
         "users": users.get("items", []),
         "total": users.get("total", 0),
+        "mirror": users.get("mirror"),
         "page": page,
         "search": search,
         "status": status,
@@ -1,28 +1,49 @@
 """
 Stats Service - Statistics aggregation for admin dashboard.
 """
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable, Awaitable
 from sqlalchemy import select, func
 from datetime import datetime, timedelta
 
 from app.api.services.remnawave import remnawave_service as marzban_service
+from app.api.services.panel_mirror import panel_mirror
 
 
 class StatsService:
     """Service for aggregating admin statistics."""
     
+    @staticmethod
+    async def _from_mirror(read: Callable[[], Awaitable[Optional[Dict[str, Any]]]]) -> Optional[Dict[str, Any]]:
+        """Run a mirror read if the mirror is enabled; None means "ask the panel"."""
+        if not panel_mirror.enabled:
+            return None
+        try:
+            return await read()
+        except Exception:
+            # Mirror unavailable: fall back to the live panel
+            return None
+    
     @staticmethod
     async def get_overview() -> Dict[str, Any]:
         """Get dashboard overview statistics."""
         try:
-            # Get all users from Marzban
-            users = await marzban_service.get_all_users()
-            
-            total_users = len(users) if users else 0
-            active_users = sum(1 for u in users if u.get("status") == "active") if users else 0
+            # Read the SQL mirror when enabled, otherwise stream users from Marzban
+            mirrored = await StatsService._from_mirror(panel_mirror.overview)
+            if mirrored:
+                total_users = mirrored["total_users"]
+                active_users = mirrored["active_users"]
+                total_traffic = mirrored["total_traffic"]
+            else:
+                total_users = 0
+                active_users = 0
+                total_traffic = 0
+                async for u in marzban_service.iter_users():
+                    total_users += 1
+                    if u.get("status") == "active":
+                        active_users += 1
+                    total_traffic += u.get("used_traffic", 0) or 0
             
             # Calculate total traffic
-            total_traffic = sum(u.get("used_traffic", 0) for u in users) if users else 0
             total_traffic_gb = round(total_traffic / (1024**3), 2)
             
             # Get server status
@@ -33,7 +54,8 @@ class StatsService:
                 "active_users": active_users,
                 "total_traffic_gb": total_traffic_gb,
                 "online_users": server.get("online_users", 0) if server.get("online") else 0,
-                "server_online": server.get("online", False)
+                "server_online": server.get("online", False),
+                "mirror": mirrored["mirror"] if mirrored else None
             }
         except Exception as e:
             return {
@@ -49,29 +71,42 @@ class StatsService:
     async def get_users(search: Optional[str] = None, status: Optional[str] = None, page: int = 1) -> Dict[str, Any]:
         """Get paginated list of users."""
         try:
-            users = await marzban_service.get_all_users()
-            if not users:
-                return {"items": [], "total": 0}
-            
-            # Filter by search
-            if search:
-                users = [u for u in users if search.lower() in u.get("username", "").lower()]
-            
-            # Filter by status
-            if status:
-                users = [u for u in users if u.get("status") == status]
-            
             # Pagination
             per_page = 20
             start = (page - 1) * per_page
             end = start + per_page
             
+            # Indexed SQL over the mirror when enabled
+            mirrored = await StatsService._from_mirror(
+                lambda: panel_mirror.list_users(search=search, status=status, offset=start, limit=per_page)
+            )
+            if mirrored is not None:
+                return mirrored
+            
+            # Stream users and keep only the requested page in memory
+            needle = search.lower() if search else None
+            items = []
+            total = 0
+            async for u in marzban_service.iter_users():
+                # Filter by search
+                if needle and needle not in (u.get("username") or "").lower():
+                    continue
+                
+                # Filter by status
+                if status and u.get("status") != status:
+                    continue
+                
+                if start <= total < end:
+                    items.append(u)
+                total += 1
+            
             return {
-                "items": users[start:end],
-                "total": len(users)
+                "items": items,
+                "total": total,
+                "mirror": None
             }
         except Exception:
-            return {"items": [], "total": 0}
+            return {"items": [], "total": 0, "mirror": None}
     
     @staticmethod
     async def get_user_detail(telegram_id: int) -> Optional[Dict[str, Any]]:
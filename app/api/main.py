@@ -14,17 +14,59 @@ async def startup():
     # Only for dev: create tables on startup
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    
+    # Compile subscription link rewrite rules once (fails fast on a bad config)
+    from app.api.services.link_rewrite import get_rewriter
+    get_rewriter()
+    
+    # Host templates for locally rendered subscriptions (SUB_RENDER_MODE=local)
+    from app.api.services.local_render import local_renderer
+    local_renderer.load()
+    
+    # Keep-alive pool for the /sub proxy
+    from app.api.services.upstream_client import upstream_client
+    await upstream_client.start()
+    
+    # Write-behind device logging from the /sub proxy
+    from app.api.services.device_log import device_log
+    device_log.start()
+    
+    # Anonymized /sub request traces for offline replay (SUB_TRACE_ENABLED=true)
+    from app.api.services.trace_recorder import trace_recorder
+    trace_recorder.start()
+    
+    # Background delta sync of the panel users mirror (PANEL_MIRROR_ENABLED=true)
+    from app.api.services.panel_mirror import panel_mirror
+    panel_mirror.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    from app.api.services.device_log import device_log
+    from app.api.services.lkg_store import lkg_store
+    from app.api.services.panel_mirror import panel_mirror
+    from app.api.services.remnawave import remnawave_service
+    from app.api.services.trace_recorder import trace_recorder
+    from app.api.services.upstream_client import upstream_client
+    await device_log.stop()
+    await lkg_store.flush()
+    trace_recorder.stop()
+    await panel_mirror.stop()
+    await upstream_client.close()
+    # Persistent ssh + psql process for hwid device queries
+    await remnawave_service.device_channel.close()
 
 @app.get("/")
 async def root():
     return {"status": "ok", "service": "VPN SaaS Core API"}
 
-from app.api.routers import users, billing, subscription
+from app.api.routers import users, billing, subscription, webhooks, metrics
 from app.api.routers.users import server_router
 
 app.include_router(users.router)
 app.include_router(billing.router)
 app.include_router(subscription.router)
+app.include_router(webhooks.router)
+app.include_router(metrics.router)
 app.include_router(server_router)
 
 # Mount Admin Panel
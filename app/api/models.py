@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, BigInteger
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, BigInteger, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.api.db.database import Base
@@ -78,9 +78,15 @@ class Config(Base):
 class Device(Base):
     """Track devices that connected to subscription endpoint."""
     __tablename__ = "devices"
+    __table_args__ = (
+        # One row per user + client (upserted by device_log; survives token revokes)
+        UniqueConstraint("user_id", "ua_hash", name="uq_devices_user_ua"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # Resolved from the /sub token
+    subscription_token = Column(String, index=True, nullable=True)    # Latest /sub/{token}
+    ua_hash = Column(String(16), nullable=True)                       # blake2b of User-Agent
     device_name = Column(String, nullable=True)  # e.g. "iPhone 14 Pro Max"
     os_version = Column(String, nullable=True)   # e.g. "iOS 18.2"
     app_name = Column(String, nullable=True)     # e.g. "Happ"
@@ -91,3 +97,39 @@ class Device(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     user = relationship("User")
+
+
+class PanelUser(Base):
+    """Local mirror of Remnawave panel users (kept current by panel_mirror)."""
+    __tablename__ = "panel_users"
+
+    uuid = Column(String, primary_key=True)                 # Remnawave user UUID
+    username = Column(String, index=True, nullable=False)
+    telegram_id = Column(BigInteger, index=True, nullable=True)
+    short_uuid = Column(String, index=True, nullable=True)
+    status = Column(String, index=True, nullable=True)      # active / disabled / ...
+    data_limit = Column(BigInteger, nullable=True)
+    used_traffic = Column(BigInteger, nullable=True)
+    expire = Column(BigInteger, nullable=True)              # Unix timestamp
+    subscription_url = Column(Text, nullable=True)
+    sub_last_user_agent = Column(Text, nullable=True)
+    online_at = Column(String, nullable=True)
+    note = Column(Text, nullable=True)
+    hwid_device_limit = Column(Integer, nullable=True)
+    vless_uuid = Column(String, nullable=True)              # Protocol credentials (local render)
+    trojan_password = Column(String, nullable=True)
+    ss_password = Column(String, nullable=True)
+    content_hash = Column(String(32), nullable=False)       # Delta sync: changed rows only
+    synced_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class PanelMirrorState(Base):
+    """Single-row bookkeeping for the panel mirror (freshness, last error)."""
+    __tablename__ = "panel_mirror_state"
+
+    id = Column(Integer, primary_key=True)
+    last_sync_at = Column(DateTime(timezone=True), nullable=True)
+    last_full_sync_at = Column(DateTime(timezone=True), nullable=True)
+    users_count = Column(Integer, default=0)
+    last_error = Column(Text, nullable=True)
+    last_error_at = Column(DateTime(timezone=True), nullable=True)
@@ -0,0 +1,47 @@
+"""
+Metrics Router - внутренние счётчики сервисов в JSON.
+"""
+from fastapi import APIRouter
+
+from app.api.services.admission import admission
+from app.api.services.device_log import device_log
+from app.api.services.lkg_store import lkg_store
+from app.api.services.local_render import local_renderer
+from app.api.services.remnawave import remnawave_service as marzban_service
+from app.api.services.subscription_cache import subscription_cache
+from app.api.services.subscription_formats import subscription_formats
+from app.api.services.trace_recorder import trace_recorder
+from app.api.services.upstream_client import upstream_client
+from app.api.services.user_agent import cache_stats as user_agent_cache_stats
+
+router = APIRouter(prefix="/metrics", tags=["metrics"])
+
+
+@router.get("/subscription")
+async def subscription_metrics():
+    """
+    /sub прокси: пул соединений к Marzban и задержка соединения, кэш ответов
+    и форматов, локальный рендер, допуск/отказы, устройства, запись трасс.
+    """
+    return {
+        "upstream": upstream_client.snapshot(),
+        "cache": subscription_cache.snapshot(),
+        "formats": subscription_formats.snapshot(),
+        "admission": admission.snapshot(),
+        "last_known_good": lkg_store.snapshot(),
+        "local_render": local_renderer.snapshot(),
+        "devices": device_log.snapshot(),
+        "user_agents": user_agent_cache_stats(),
+        "trace": trace_recorder.snapshot(),
+    }
+
+
+@router.get("/remnawave")
+async def remnawave_metrics():
+    """Кэши, объединение запросов и точечный поиск RemnawaveService."""
+    return {
+        "caches": marzban_service.get_cache_stats(),
+        "coalescing": marzban_service.get_coalescing_stats(),
+        "lookup": marzban_service.get_lookup_stats(),
+        "device_channel": marzban_service.device_channel.stats,
+    }
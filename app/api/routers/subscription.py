@@ -5,96 +5,261 @@ logs device info, and proxies to Marzban.
 """
 from fastapi import APIRouter, Request, Response
 from fastapi.responses import PlainTextResponse
-import httpx
+import base64
 import logging
-import re
-import os
+import time
+
+from app.api.services.admission import Overloaded, admission
+from app.api.services.device_log import device_log
+from app.api.services.link_rewrite import get_rewriter
+from app.api.services.local_render import local_renderer
+from app.api.services.remnawave import remnawave_service
+from app.api.services.subscription_cache import (
+    SubscriptionResponse, UpstreamUnavailable, subscription_cache
+)
+from app.api.services.subscription_formats import negotiate, subscription_formats
+from app.api.services.trace_recorder import note_upstream, trace_recorder
+from app.api.services.upstream_client import upstream_client
+from app.api.services.user_agent import parse_user_agent
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/sub", tags=["subscription"])
 
-MARZBAN_URL = os.getenv("MARZBAN_URL", "https://instabotwebhook.ru:8000")
+# Revoked / disabled / deleted users must not keep getting cached links
+remnawave_service.add_subscription_listener(subscription_cache.invalidate)
+# ...nor locally rendered ones until the panel mirror has caught up
+remnawave_service.add_subscription_listener(local_renderer.mark_changed)
+remnawave_service.add_subscription_listener(subscription_formats.invalidate)
 
 
 def parse_device_from_headers(headers: dict) -> dict:
-    """Parse device info from HTTP headers."""
-    user_agent = headers.get("user-agent", "")
-    
-    device_info = {
-        "user_agent": user_agent,
-        "device_name": None,
-        "os_version": None,
-        "app_name": None,
-        "app_version": None
-    }
+    """Parse device info from HTTP headers (shared cached parser, see user_agent)."""
+    device_info = parse_user_agent(headers.get("user-agent", "")).as_device_info()
+    
+    # Log full headers for debugging
+    logger.info(f"Device parsed: {device_info}")
     
-    if not user_agent:
-        return device_info
+    return device_info
+
+
+def rewrite_subscription(token: str, upstream_text: str) -> str:
+    """
+    Decode Marzban links (plain or base64), apply MomsVPN branding and
+    add Trojan / Shadowsocks fallbacks (see link_rewrite rules).
+    """
+    # Get upstream links and decode from base64 if needed
+    all_links = []
+    upstream_content = upstream_text.strip()
     
-    ua_lower = user_agent.lower()
+    # DEBUG: Log raw content to see if Hysteria2 is present
+    logger.info(f"Raw subscription content for {token[:10]}...: {upstream_content[:500]}...")
     
-    # Parse Happ: "Happ/3.7.0/ios CFNetwork/3860.300.31 Darwin/25.2.0"
-    # Or other clients
+    for line in upstream_content.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+            
+        # Check if it's already a plain link
+        if line.startswith(('vless://', 'vmess://', 'trojan://', 'ss://', 'hysteria2://', 'hy2://')):
+            all_links.append(line)
+        else:
+            # Try to decode base64
+            try:
+                decoded = base64.b64decode(line).decode('utf-8')
+                # Split if multiple links in one base64 block
+                for decoded_line in decoded.split('\n'):
+                    decoded_line = decoded_line.strip()
+                    if decoded_line.startswith(('vless://', 'vmess://', 'trojan://', 'ss://', 'hysteria2://', 'hy2://')):
+                        all_links.append(decoded_line)
+            except Exception:
+                # If can't decode, skip
+                pass
     
-    # Extract app name and version
-    app_match = re.match(r'^(\w+)/([0-9.]+)', user_agent)
-    if app_match:
-        device_info["app_name"] = app_match.group(1)
-        device_info["app_version"] = app_match.group(2)
+    # Rename, tune and extend links with the compiled rules (app/api/config/link_rewrite.json)
+    enhanced_links = get_rewriter().rewrite(all_links)
     
-    # Darwin version to iOS version mapping (approximate)
-    darwin_to_ios = {
-        "25.": "18.",  # iOS 18.x
-        "24.": "17.",  # iOS 17.x
-        "23.": "16.",  # iOS 16.x
-        "22.": "15.",  # iOS 15.x
-        "21.": "14.",  # iOS 14.x
+    # Return all links, newline separated
+    return "\n".join(enhanced_links)
+
+
+def forwarded_headers(upstream_headers, token: str) -> dict:
+    """Marzban headers passed through to the client."""
+    # Forward ALL Marzban headers for traffic display and branding
+    response_headers = {
+        "Content-Type": "text/plain; charset=utf-8",
     }
     
-    darwin_match = re.search(r'darwin/(\d+)\.(\d+)', ua_lower)
-    if darwin_match:
-        major = darwin_match.group(1)
-        minor = darwin_match.group(2)
-        for darwin_prefix, ios_prefix in darwin_to_ios.items():
-            if major + "." == darwin_prefix:
-                # Convert Darwin minor to approximate iOS minor
-                ios_minor = int(minor) // 100 if int(minor) > 10 else minor
-                device_info["os_version"] = f"iOS {ios_prefix}{ios_minor}"
-                break
-    
-    # Detect device type
-    if "iphone" in ua_lower or "/ios" in ua_lower:
-        device_info["device_name"] = "iPhone"
-    elif "ipad" in ua_lower:
-        device_info["device_name"] = "iPad"
-    elif "android" in ua_lower:
-        device_info["device_name"] = "Android"
-        # Try to extract Android version
-        android_match = re.search(r'android[/\s]*([\d.]+)', ua_lower)
-        if android_match:
-            device_info["os_version"] = f"Android {android_match.group(1)}"
-    elif "windows" in ua_lower:
-        device_info["device_name"] = "Windows PC"
-        device_info["os_version"] = "Windows"
-    elif "mac" in ua_lower:
-        device_info["device_name"] = "Mac"
-        device_info["os_version"] = "macOS"
+    # Forward Marzban headers exactly as-is (preserves traffic, name, etc)
+    headers_to_forward = [
+        'subscription-userinfo',   # Traffic: upload, download, total, expire
+        'profile-title',           # Subscription name (already base64 from Marzban)
+        'profile-update-interval', # Update interval
+        'support-url',             # Support link
+        'profile-web-page-url',    # Web page
+        'content-disposition',     # Filename
+    ]
     
-    # Log full headers for debugging
-    logger.info(f"Device parsed: {device_info}")
+    for header_name in headers_to_forward:
+        if header_name in upstream_headers:
+            response_headers[header_name] = upstream_headers[header_name]
     
-    return device_info
+    # Spread the next refresh wave (SUB_UPDATE_INTERVAL_JITTER, off by default)
+    if 'profile-update-interval' in response_headers:
+        response_headers['profile-update-interval'] = admission.jitter_update_interval(
+            response_headers['profile-update-interval'], token
+        )
+    
+    return response_headers
+
+
+async def fetch_subscription(token: str) -> SubscriptionResponse:
+    """Fetch the subscription from Marzban and build the final response."""
+    # SUB_RENDER_MODE=local: links from the panel mirror, Marzban only when the mirror can't answer
+    rendered = await local_renderer.render(token)
+    if rendered is not None:
+        links, headers = rendered
+        return SubscriptionResponse(
+            "\n".join(get_rewriter().rewrite(links)),
+            forwarded_headers(headers, token)
+        )
+    
+    upstream_ms = 0.0
+    try:
+        # Bounded concurrency towards Marzban (raises Overloaded instead of piling up)
+        async with admission.slot():
+            started = time.perf_counter()
+            try:
+                # Shared keep-alive pool (created on app startup), no TLS handshake per refresh.
+                # Fixed User-Agent: the panel varies its answer by UA, the cache is per token only
+                response = await upstream_client.get(f"/sub/{token}", headers={
+                    "User-Agent": upstream_client.user_agent
+                })
+            finally:
+                upstream_ms = (time.perf_counter() - started) * 1000
+    except Overloaded:
+        raise
+    except Exception as e:
+        note_upstream(0, 0, upstream_ms)
+        raise UpstreamUnavailable(repr(e))
+    
+    note_upstream(response.status_code, len(response.content), upstream_ms)
+    
+    if response.status_code != 200:
+        upstream = SubscriptionResponse(response.text, {}, response.status_code)
+        if response.status_code >= 500:
+            raise UpstreamUnavailable(f"HTTP {response.status_code}", upstream)
+        return upstream
+    
+    return SubscriptionResponse(
+        rewrite_subscription(token, response.text),
+        forwarded_headers(response.headers, token)
+    )
+
+
+async def fetch_traced(token: str) -> SubscriptionResponse:
+    """
+    fetch_subscription for the cache. A background refresh has no client
+    request to attach its upstream call to, so with tracing on it writes
+    its own trace line (X-Cache REFRESH).
+    """
+    trace = trace_recorder.begin_background()
+    status, size = 0, 0
+    try:
+        response = await fetch_subscription(token)
+        status, size = response.status_code, len(response.encoded)
+        return response
+    except UpstreamUnavailable as e:
+        if e.response is not None:
+            status = e.response.status_code
+        raise
+    finally:
+        trace_recorder.finish(trace, token, "", None, status, "REFRESH", size)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match check (weak comparison, as RFC 9110 requires for it)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Accept-Encoding allows gzip: listed (or via *) with q > 0, per RFC 9110."""
+    qualities = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        qualities[coding] = q
+    if "gzip" in qualities:
+        return qualities["gzip"] > 0
+    if "x-gzip" in qualities:
+        return qualities["x-gzip"] > 0
+    return qualities.get("*", 0.0) > 0
+
+
+def build_response(result: SubscriptionResponse, cache_state: str, request: Request) -> Response:
+    """
+    Final /sub response: 304 when the client already has this body,
+    the precompressed body for gzip clients, the plain body otherwise.
+    """
+    headers = {**result.headers, "X-Cache": cache_state}
+    if result.status_code != 200:
+        return PlainTextResponse(content=result.body, status_code=result.status_code, headers=headers)
+    
+    headers["ETag"] = result.etag
+    # Format is negotiated by Accept / User-Agent as well (see subscription_formats)
+    headers["Vary"] = "Accept, Accept-Encoding, User-Agent"
+    if etag_matches(request.headers.get("if-none-match", ""), result.etag):
+        # Same body; fresh subscription-userinfo still goes out with the 304
+        headers.pop("Content-Type", None)
+        return Response(status_code=304, headers=headers)
+    
+    body = result.encoded
+    if accepts_gzip(request.headers.get("accept-encoding", "")) and result.gzipped is not None:
+        body = result.gzipped
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, status_code=200, headers=headers)
 
 
 @router.get("/{token}")
 async def subscription_proxy(token: str, request: Request):
+    """Serve the subscription; with SUB_TRACE_ENABLED=true also record an anonymized trace line."""
+    trace = trace_recorder.begin()
+    response = await serve_subscription(token, request)
+    trace_recorder.finish(
+        trace, token, request.headers.get("user-agent", ""), request.query_params.get("format"),
+        response.status_code, response.headers.get("x-cache"), len(response.body)
+    )
+    return response
+
+
+async def serve_subscription(token: str, request: Request) -> Response:
     """
     Proxy subscription requests to Marzban while capturing device info.
     Adds Hysteria2 and Shadowsocks links for unified subscription.
+    Final responses are cached per token (see subscription_cache).
+    sing-box JSON / Clash YAML are rendered from the cached links on demand
+    (?format=, Accept or User-Agent, see subscription_formats).
     """
-    import base64
-    
     # Get client IP
     client_ip = request.client.host if request.client else "unknown"
     
@@ -108,122 +273,40 @@ async def subscription_proxy(token: str, request: Request):
     logger.info(f"User-Agent: {device_info['user_agent']}")
     logger.info(f"Parsed device: {device_info['device_name']} / {device_info['os_version']}")
     
-    # Proxy request to Marzban
+    user_agent = headers_dict.get("user-agent", "")
+    fmt = negotiate(request.query_params.get("format"), headers_dict.get("accept", ""), user_agent)
+    if fmt is None:
+        return PlainTextResponse(content="Unknown format", status_code=400)
+    
+    # Proxy request to Marzban (or serve the cached response)
     try:
-        async with httpx.AsyncClient(verify=os.getenv("MARZBAN_VERIFY_SSL", "true").lower() != "false", timeout=30) as client:
-            marzban_url = f"{MARZBAN_URL}/sub/{token}"
-            response = await client.get(marzban_url, headers={
-                "User-Agent": headers_dict.get("user-agent", "")
-            })
-            
-            if response.status_code != 200:
-                return PlainTextResponse(content=response.text, status_code=response.status_code)
-            
-            # Get upstream links and decode from base64 if needed
-            all_links = []
-            upstream_content = response.text.strip()
-            
-            # DEBUG: Log raw content to see if Hysteria2 is present
-            logger.info(f"Raw subscription content for {token[:10]}...: {upstream_content[:500]}...")
-            
-            for line in upstream_content.split('\n'):
-                line = line.strip()
-                if not line:
-                    continue
-                    
-                # Check if it's already a plain link
-                if line.startswith(('vless://', 'vmess://', 'trojan://', 'ss://', 'hysteria2://', 'hy2://')):
-                    all_links.append(line)
-                else:
-                    # Try to decode base64
-                    try:
-                        decoded = base64.b64decode(line).decode('utf-8')
-                        # Split if multiple links in one base64 block
-                        for decoded_line in decoded.split('\n'):
-                            decoded_line = decoded_line.strip()
-                            if decoded_line.startswith(('vless://', 'vmess://', 'trojan://', 'ss://', 'hysteria2://', 'hy2://')):
-                                all_links.append(decoded_line)
-                    except Exception:
-                        # If can't decode, skip
-                        pass
-            
-            # Process and enhance links from Marzban
-            enhanced_links = []
-            user_uuid = None  # Will extract from VLESS links
-            has_trojan = False  # Track if Trojan already in subscription
-            profile_counter = 0
-            
-            for link in all_links:
-                # Extract UUID from VLESS links for Trojan
-                if link.startswith('vless://'):
-                    uuid_match = link.split('://')[1].split('@')[0]
-                    if uuid_match:
-                        user_uuid = uuid_match
-                
-                # Track if Trojan already exists
-                if link.startswith('trojan://'):
-                    has_trojan = True
-                
-                # Rename profiles with MomsVPN branding
-                if '#' in link:
-                    base, old_name = link.rsplit('#', 1)
-                    profile_counter += 1
-                    
-                    if 'security=reality' in link:
-                        # Primary - Reality with fragmentation
-                        link = f"{base}&fragment=3,1,tlshello#✅ Основной Moms"
-                    elif link.startswith('vless://') and 'type=ws' in link:
-                        link = f"{base}#✅ Запасной Moms"
-                    elif link.startswith('trojan://'):
-                        link = f"{base}#✅ Альтернативный Moms"
-                    elif link.startswith('ss://'):
-                        continue  # Skip, we add our own SS below
-                else:
-                    # Add fragment to Reality without name
-                    if 'security=reality' in link:
-                        link = f"{link}&fragment=3,1,tlshello#✅ Основной Moms"
-                
-                enhanced_links.append(link)
-            
-            # Add Trojan WebSocket as fallback only if not already present
-            if user_uuid and not has_trojan:
-                trojan_link = f"trojan://{user_uuid}@instabotwebhook.ru:443?security=tls&type=ws&path=%2Ftrojanws&sni=instabotwebhook.ru&fp=chrome#✅ Альтернативный Moms"
-                enhanced_links.append(trojan_link)
-            
-            # Add Shadowsocks as last resort
-            ss_key = "6Xtl5eyOFNZ73i0xfHWeCw=="
-            ss_userinfo = base64.b64encode(f"2022-blake3-aes-128-gcm:{ss_key}".encode()).decode()
-            shadowsocks_link = f"ss://{ss_userinfo}@31.130.130.238:8388#✅ Резервный Moms"
-            enhanced_links.append(shadowsocks_link)
-            
-            # Return all links, newline separated
-            content = "\n".join(enhanced_links)
-            
-            # Forward ALL Marzban headers for traffic display and branding
-            response_headers = {
-                "Content-Type": "text/plain; charset=utf-8",
-            }
-            
-            # Forward Marzban headers exactly as-is (preserves traffic, name, etc)
-            headers_to_forward = [
-                'subscription-userinfo',   # Traffic: upload, download, total, expire
-                'profile-title',           # Subscription name (already base64 from Marzban)
-                'profile-update-interval', # Update interval
-                'support-url',             # Support link
-                'profile-web-page-url',    # Web page
-                'content-disposition',     # Filename
-            ]
-            
-            for header_name in headers_to_forward:
-                if header_name in response.headers:
-                    response_headers[header_name] = response.headers[header_name]
-            
-            return PlainTextResponse(
-                content=content,
-                status_code=200,
-                headers=response_headers
-            )
+        result, cache_state = await subscription_cache.get_or_fetch(
+            token, lambda: fetch_traced(token)
+        )
+    except Overloaded as e:
+        # Load shedding: last known response if we have one, else a fast 503
+        cached, _ = await subscription_cache.fallback(token)
+        admission.record_shed(served_cached=cached is not None)
+        logger.warning(f"Shedding /sub request for {token[:10]}...: {e.reason}")
+        if cached is not None:
+            if cached.status_code == 200:
+                device_log.record(token, device_info, client_ip)
+            return build_response(subscription_formats.render(token, cached, fmt), "SHED", request)
+        return PlainTextResponse(
+            content="Service busy, retry later",
+            status_code=503,
+            headers={"Retry-After": str(admission.retry_after_for(token))}
+        )
+    except UpstreamUnavailable as e:
+        logger.error(f"Error proxying to Marzban: {e}")
+        if e.response is not None:
+            return PlainTextResponse(content=e.response.body, status_code=e.response.status_code)
+        return PlainTextResponse(content="Error", status_code=500)
     except Exception as e:
         logger.error(f"Error proxying to Marzban: {e}")
         return PlainTextResponse(content="Error", status_code=500)
-
+    
+    if result.status_code == 200:
+        # Only a served subscription proves the token; store the sighting in the background
+        device_log.record(token, device_info, client_ip)
+    return build_response(subscription_formats.render(token, result, fmt), cache_state, request)
@@ -0,0 +1,67 @@
+"""
+Remnawave webhooks - push-инвалидация кэшей RemnawaveService.
+
+Панель шлёт события о пользователях (создан, изменён, отключён, сброс
+трафика, новое устройство) на POST /webhooks/remnawave. Тело подписано
+HMAC-SHA256 с общим секретом (заголовок X-Remnawave-Signature).
+
+Кэши RemnawaveService живут в памяти процесса, поэтому событие обновляет
+только процесс API, принявший его (справочник, кэш устройств, кэш /sub).
+Бот работает отдельным процессом на polling и событий не получает: его
+справочник и кэш устройств по-прежнему живут по REMNAWAVE_USER_CACHE_TTL /
+REMNAWAVE_DEVICE_CACHE_TTL, так что поднимать эти TTL из-за webhook нельзя.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+
+from fastapi import APIRouter, HTTPException, Request
+
+from app.api.services.remnawave import remnawave_service as marzban_service
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/webhooks", tags=["webhooks"])
+
+WEBHOOK_SECRET = os.getenv("REMNAWAVE_WEBHOOK_SECRET", "")
+SIGNATURE_HEADER = "X-Remnawave-Signature"
+
+
+def sign_payload(body: bytes, secret: str) -> str:
+    """Hex HMAC-SHA256 тела запроса (так же подписывает панель)."""
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(body: bytes, signature: str, secret: str) -> bool:
+    if not secret or not signature:
+        return False
+    return hmac.compare_digest(sign_payload(body, secret), signature.strip().lower())
+
+
+@router.post("/remnawave")
+async def remnawave_webhook(request: Request):
+    """Принять событие панели и обновить справочник / кэш устройств."""
+    if not WEBHOOK_SECRET:
+        # Без секрета подпись не проверить — событий не принимаем
+        raise HTTPException(status_code=503, detail="Webhook secret is not configured")
+    
+    body = await request.body()
+    if not verify_signature(body, request.headers.get(SIGNATURE_HEADER, ""), WEBHOOK_SECRET):
+        logger.warning("Rejected Remnawave webhook with invalid signature")
+        raise HTTPException(status_code=401, detail="Invalid signature")
+    
+    try:
+        payload = json.loads(body)
+        event = payload["event"]
+        data = payload.get("data") or {}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise HTTPException(status_code=400, detail="Malformed event")
+    if not isinstance(event, str) or not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Malformed event")
+    
+    action = marzban_service.apply_webhook_event(event, data)
+    logger.info(f"Remnawave webhook {event}: {action}")
+    return {"status": "ok", "event": event, "action": action}
@@ -0,0 +1,133 @@
+"""
+Admission - ограничение одновременных запросов /sub прокси к Marzban.
+
+Клиенты с одинаковым profile-update-interval обновляются волнами, а
+таймаут upstream 30 секунд позволяет запросам копиться. Здесь:
+
+- не больше SUB_MAX_CONCURRENT запросов к Marzban одновременно;
+- не больше SUB_MAX_QUEUE ожидающих, каждый ждёт не дольше SUB_QUEUE_TIMEOUT;
+- остальные сразу получают Overloaded: роутер отдаёт закэшированный
+  ответ, если он есть, иначе быстрый 503 с Retry-After;
+- опционально profile-update-interval сдвигается на 0..SUB_UPDATE_INTERVAL_JITTER
+  часов (стабильно для токена), чтобы следующие обновления шли вразнобой.
+
+Ответы из кэша ограничение не проходят: оно защищает только Marzban.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Запрос не допущен к Marzban (очередь полна или ожидание истекло)."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _token_offset(token: str, modulo: int) -> int:
+    """Стабильный для токена сдвиг 0..modulo-1."""
+    if modulo <= 1:
+        return 0
+    digest = hashlib.blake2b(token.encode(), digest_size=4).digest()
+    return int.from_bytes(digest, "big") % modulo
+
+
+class AdmissionControl:
+    """Семафор с ограниченной очередью ожидания и счётчиками отказов."""
+
+    def __init__(self):
+        self.max_concurrent = int(os.getenv("SUB_MAX_CONCURRENT", "64"))
+        self.max_queue = int(os.getenv("SUB_MAX_QUEUE", "256"))
+        self.queue_timeout = float(os.getenv("SUB_QUEUE_TIMEOUT", "5"))
+        self.retry_after = int(os.getenv("SUB_RETRY_AFTER", "30"))
+        self.interval_jitter = int(os.getenv("SUB_UPDATE_INTERVAL_JITTER", "0"))
+
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._active = 0
+        self._waiting = 0
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,            # Допущено после ожидания в очереди
+            "shed_queue_full": 0,   # Отказ сразу: очередь полна
+            "shed_timeout": 0,      # Отказ после SUB_QUEUE_TIMEOUT в очереди
+            "served_stale": 0,      # Отказ закрыт закэшированным ответом
+            "rejected_503": 0,      # Отказ без кэша: 503 + Retry-After
+            "peak_active": 0,
+            "peak_waiting": 0,
+        }
+
+    # ==================== ДОПУСК ====================
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Занять слот запроса к Marzban или бросить Overloaded."""
+        if self._semaphore.locked():
+            if self._waiting >= self.max_queue:
+                self.stats["shed_queue_full"] += 1
+                raise Overloaded("queue full")
+            self._waiting += 1
+            self.stats["peak_waiting"] = max(self.stats["peak_waiting"], self._waiting)
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.stats["shed_timeout"] += 1
+                raise Overloaded("queue timeout")
+            finally:
+                self._waiting -= 1
+            self.stats["queued"] += 1
+        else:
+            await self._semaphore.acquire()
+
+        self.stats["admitted"] += 1
+        self._active += 1
+        self.stats["peak_active"] = max(self.stats["peak_active"], self._active)
+        try:
+            yield
+        finally:
+            self._active -= 1
+            self._semaphore.release()
+
+    def record_shed(self, served_cached: bool) -> None:
+        """Чем закрыт отказ: закэшированным ответом или 503."""
+        self.stats["served_stale" if served_cached else "rejected_503"] += 1
+
+    # ==================== РАЗНЕСЕНИЕ ОБНОВЛЕНИЙ ====================
+
+    def retry_after_for(self, token: str) -> int:
+        """Retry-After для отказа: база + стабильный сдвиг токена, чтобы повторы не шли разом."""
+        return self.retry_after + _token_offset(token, self.retry_after)
+
+    def jitter_update_interval(self, value: Optional[str], token: str) -> Optional[str]:
+        """profile-update-interval (часы) + 0..SUB_UPDATE_INTERVAL_JITTER часов для токена."""
+        if not self.interval_jitter or value is None:
+            return value
+        try:
+            hours = int(value.strip())
+        except ValueError:
+            return value
+        return str(hours + _token_offset(token, self.interval_jitter + 1))
+
+    # ==================== МЕТРИКИ ====================
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            **self.stats,
+            "active": self._active,
+            "waiting": self._waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "interval_jitter": self.interval_jitter,
+        }
+
+
+# Singleton
+admission = AdmissionControl()
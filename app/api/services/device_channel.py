@@ -0,0 +1,225 @@
+"""
+Device Channel - долгоживущий канал к БД Remnawave для запросов по устройствам.
+
+Одна SSH-сессия и один процесс psql внутри контейнера принимают много
+запросов подряд: не платим за TCP, обмен ключами, docker exec и старт psql
+на каждый клик. Параметры передаются через переменные psql (:'name'),
+а не подставляются в строку shell-команды.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Значения параметров: UUID и литералы массивов из UUID ({a,b,c})
+_SAFE_PARAM = re.compile(r"^[0-9A-Za-z_{},-]*$")
+_SAFE_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class DeviceQueryError(Exception):
+    """Запрос к БД устройств не выполнен."""
+
+
+class DeviceQueryChannel:
+    """Постоянный ssh + psql канал с переподключением, таймаутами и fallback."""
+
+    def __init__(self):
+        self.ssh_key = os.getenv("REMNAWAVE_SSH_KEY", "/root/.ssh/id_rsa_remnawave")
+        self.ssh_host = os.getenv("REMNAWAVE_SSH_HOST", "root@85.192.29.22")
+        self.container = os.getenv("REMNAWAVE_PG_CONTAINER", "root-postgres-1")
+        self.mode = os.getenv("REMNAWAVE_DEVICE_CHANNEL", "persistent").lower()
+        self.query_timeout = float(os.getenv("REMNAWAVE_DEVICE_QUERY_TIMEOUT", "5"))
+        # После серии сбоев постоянного канала даём ему остыть и идём через fallback
+        self.failure_threshold = 3
+        self.cooldown = 60.0
+
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._lock = asyncio.Lock()
+        self._seq = 0
+        self._failures = 0
+        self._disabled_until = 0.0
+
+        self.stats = {
+            "queries": 0,
+            "connects": 0,
+            "fallbacks": 0,
+            "timeouts": 0,
+            "errors": 0,
+        }
+
+    # ==================== ПУБЛИЧНОЕ API ====================
+
+    async def query(self, sql: str, params: Optional[Dict[str, str]] = None,
+                    timeout: Optional[float] = None) -> List[List[str]]:
+        """
+        Выполнить один SQL-запрос (одной строкой, с ';' в конце).
+        Параметры подставляются psql как :'name' — экранированные литералы.
+        Возвращает строки результата, колонки разделены '|'.
+        """
+        script = self._build_script(sql, params or {})
+        timeout = timeout or self.query_timeout
+        self.stats["queries"] += 1
+
+        if self.mode == "persistent" and time.monotonic() >= self._disabled_until:
+            try:
+                rows = await self._query_persistent(script, timeout)
+                self._failures = 0
+                return rows
+            except DeviceQueryError:
+                # Ошибка самого SQL — fallback её не исправит
+                raise
+            except asyncio.TimeoutError:
+                # Медленный запрос через fallback станет только медленнее
+                self._record_failure()
+                raise DeviceQueryError(f"query timed out after {timeout:.1f}s")
+            except Exception as e:
+                self._record_failure()
+                logger.warning(f"Persistent device channel failed ({e!r}), falling back to one-shot ssh")
+
+        self.stats["fallbacks"] += 1
+        return await self._query_oneshot(script, timeout)
+
+    async def close(self) -> None:
+        """Закрыть постоянный канал (при остановке приложения)."""
+        async with self._lock:
+            await self._terminate()
+
+    def _record_failure(self) -> None:
+        self._failures += 1
+        if self._failures >= self.failure_threshold:
+            logger.warning(f"Device channel disabled for {self.cooldown:.0f}s after {self._failures} failures")
+            self._disabled_until = time.monotonic() + self.cooldown
+            self._failures = 0
+
+    # ==================== ПОСТОЯННЫЙ КАНАЛ ====================
+
+    async def _query_persistent(self, script: str, timeout: float) -> List[List[str]]:
+        async with self._lock:
+            # Одна попытка переподключения: ssh мог отвалиться между запросами
+            for attempt in range(2):
+                if self._proc is None or self._proc.returncode is not None:
+                    await self._connect()
+                try:
+                    return await asyncio.wait_for(self._exchange(script), timeout)
+                except DeviceQueryError:
+                    raise
+                except asyncio.TimeoutError:
+                    self.stats["timeouts"] += 1
+                    # Недочитанный ответ рассинхронизирует канал — только пересоздать
+                    await self._terminate()
+                    raise
+                except (ConnectionError, BrokenPipeError) as e:
+                    await self._terminate()
+                    if attempt:
+                        raise
+                    logger.info(f"Device channel dropped ({e!r}), reconnecting")
+            raise ConnectionError("device channel unavailable")
+
+    async def _connect(self) -> None:
+        self.stats["connects"] += 1
+        self._proc = await asyncio.create_subprocess_exec(
+            *self._ssh_args(), self._psql_command(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+
+    async def _exchange(self, script: str) -> List[List[str]]:
+        self._seq += 1
+        sentinel = f"__momsvpn_end_{self._seq}__"
+        proc = self._proc
+        proc.stdin.write(f"{script}\\echo {sentinel}\n".encode())
+        await proc.stdin.drain()
+
+        lines = []
+        while True:
+            raw = await proc.stdout.readline()
+            if not raw:
+                raise ConnectionError("device channel closed")
+            line = raw.decode(errors="replace").rstrip("\n")
+            if line == sentinel:
+                break
+            lines.append(line)
+        return self._parse_output(lines)
+
+    async def _terminate(self) -> None:
+        proc, self._proc = self._proc, None
+        if proc is None or proc.returncode is not None:
+            return
+        try:
+            proc.kill()
+            await proc.wait()
+        except ProcessLookupError:
+            pass
+
+    # ==================== FALLBACK: ПРОЦЕСС НА ЗАПРОС ====================
+
+    async def _query_oneshot(self, script: str, timeout: float) -> List[List[str]]:
+        proc = await asyncio.create_subprocess_exec(
+            *self._ssh_args(), self._psql_command(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(script.encode()), timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            proc.kill()
+            await proc.wait()
+            raise DeviceQueryError(f"query timed out after {timeout:.1f}s")
+        if proc.returncode != 0:
+            self.stats["errors"] += 1
+            raise ConnectionError(f"ssh exited with {proc.returncode}")
+        return self._parse_output(stdout.decode(errors="replace").splitlines())
+
+    # ==================== ВНУТРЕННЕЕ ====================
+
+    def _ssh_args(self) -> List[str]:
+        return [
+            "ssh", "-i", self.ssh_key,
+            "-o", "BatchMode=yes",
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "ConnectTimeout=3",
+            "-o", "ServerAliveInterval=15",
+            # fallback-вызовы переиспользуют TCP/SSH через ControlMaster
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=/tmp/momsvpn-ssh-%C",
+            "-o", "ControlPersist=300",
+            self.ssh_host,
+        ]
+
+    def _psql_command(self) -> str:
+        # Ошибки psql приходят в тот же поток, что и данные (2>&1)
+        return (
+            f"docker exec -i {self.container} "
+            f"psql -U remnawave -d remnawave -X -q -A -t -F '|' -v ON_ERROR_STOP=0 2>&1"
+        )
+
+    @staticmethod
+    def _build_script(sql: str, params: Dict[str, str]) -> str:
+        if "\n" in sql:
+            raise ValueError("SQL must be a single line")
+        lines = []
+        for name, value in params.items():
+            value = str(value)
+            if not _SAFE_NAME.match(name) or not _SAFE_PARAM.match(value):
+                raise ValueError(f"Unsafe query parameter {name!r}")
+            lines.append(f"\\set {name} '{value}'\n")
+        lines.append(sql.rstrip() + "\n")
+        return "".join(lines)
+
+    def _parse_output(self, lines: List[str]) -> List[List[str]]:
+        rows = []
+        for line in lines:
+            if line.startswith(("ERROR:", "psql:", "FATAL:")):
+                self.stats["errors"] += 1
+                raise DeviceQueryError(line)
+            if line.strip():
+                rows.append([col.strip() for col in line.split("|")])
+        return rows
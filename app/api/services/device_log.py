@@ -0,0 +1,325 @@
+"""
+Device Log - запись устройств из /sub прокси в таблицу devices (write-behind).
+
+Успешный (200) ответ /sub только кладёт «устройство замечено» в очередь
+процесса (put_nowait, без ожидания БД). Фоновый писатель забирает очередь
+пачками, находит пользователя по токену (зеркало панели, затем
+RemnawaveService по short_uuid; ответы кэшируются), отбрасывает токены без пользователя, схлопывает повторы
+одного устройства и делает upsert по (user_id, ua_hash): новая строка или
+обновление last_seen / IP / токена. После revoke токен меняется, а строка
+устройства остаётся той же.
+
+Очередь ограничена DEVICE_LOG_QUEUE_SIZE: при перегрузке новые записи
+отбрасываются (счётчик dropped), а не копятся в памяти и не тормозят ответ.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, inspect, select, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.api.db.database import Base, async_session_maker, engine
+from app.api.models import Device, PanelUser, User
+from app.api.services.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Уникальный ключ строки устройства (см. Device.__table_args__)
+_USER_UA_CONSTRAINT = "uq_devices_user_ua"
+
+# Поля device_info -> колонки devices
+_INFO_FIELDS = ("device_name", "os_version", "app_name", "app_version", "user_agent")
+
+
+def ua_hash(user_agent: str) -> str:
+    """Короткий хэш User-Agent: ключ устройства внутри подписки."""
+    return hashlib.blake2b((user_agent or "").encode(), digest_size=8).hexdigest()
+
+
+class DeviceSighting:
+    """Одно обращение устройства к /sub."""
+
+    __slots__ = ("token", "ua_hash", "info", "ip_address", "seen_at")
+
+    def __init__(self, token: str, info: Dict[str, Optional[str]], ip_address: Optional[str]):
+        self.token = token
+        self.ua_hash = ua_hash(info.get("user_agent") or "")
+        self.info = info
+        self.ip_address = ip_address
+        self.seen_at = datetime.now(timezone.utc)
+
+
+class DeviceLog:
+    """Ограниченная очередь + фоновый пакетный upsert в devices."""
+
+    def __init__(self):
+        self.enabled = os.getenv("DEVICE_LOG_ENABLED", "true").lower() != "false"
+        self.queue_size = int(os.getenv("DEVICE_LOG_QUEUE_SIZE", "10000"))
+        self.batch_size = int(os.getenv("DEVICE_LOG_BATCH", "500"))
+        # Сколько ждать добора пачки после первой записи
+        self.flush_interval = float(os.getenv("DEVICE_LOG_FLUSH_INTERVAL", "2"))
+
+        self._queue: "asyncio.Queue[DeviceSighting]" = asyncio.Queue(maxsize=self.queue_size)
+        self._task: Optional[asyncio.Task] = None
+        self._pending: Optional[List[DeviceSighting]] = None  # Пачка, которую писатель собирает
+        self._schema_ready = False
+        self._upsert = postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert
+        # token -> telegram_id (None — панель его не знает) для токенов мимо зеркала
+        self._owners = TTLCache(
+            maxsize=int(os.getenv("DEVICE_LOG_TOKEN_CACHE_SIZE", "20000")),
+            ttl=float(os.getenv("DEVICE_LOG_TOKEN_CACHE_TTL", "3600"))
+        )
+        # Неизвестный токен спрашиваем снова раньше: пользователя могли только что создать
+        self.unknown_token_ttl = float(os.getenv("DEVICE_LOG_UNKNOWN_TOKEN_TTL", "300"))
+        self.lookup_concurrency = max(1, int(os.getenv("DEVICE_LOG_LOOKUP_CONCURRENCY", "4")))
+        self.stats = {
+            "enqueued": 0,
+            "dropped": 0,        # Очередь полна — запись отброшена
+            "coalesced": 0,      # Повторы одного устройства внутри пачки
+            "written": 0,        # Строк отправлено в upsert
+            "unresolved": 0,     # Токен не привязан к пользователю — не записано
+            "lookups": 0,        # Запросы владельца токена в панель
+            "lookup_errors": 0,
+            "batches": 0,
+            "write_errors": 0,
+            "lost": 0,           # Записей в пачках, которые не удалось записать
+            "last_batch_ms": None,
+        }
+
+    # ==================== ЗАПРОС ====================
+
+    def record(self, token: str, device_info: Dict[str, Optional[str]], ip_address: Optional[str]) -> bool:
+        """Поставить устройство в очередь; никогда не ждёт. False — отброшено."""
+        if not self.enabled:
+            return False
+        try:
+            self._queue.put_nowait(DeviceSighting(token, device_info, ip_address))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            if self.stats["dropped"] % 1000 == 1:
+                logger.warning(f"Device log queue full ({self.queue_size}), dropping sightings")
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    # ==================== ФОНОВЫЙ ПИСАТЕЛЬ ====================
+
+    def start(self) -> None:
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Device log writer started (queue={self.queue_size}, batch={self.batch_size})")
+
+    async def stop(self) -> None:
+        """Остановить писателя и записать то, что осталось в очереди."""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        batch, self._pending = self._pending or [], None
+        while batch or not self._queue.empty():
+            await self._write(self._drain(batch))
+            batch = []
+
+    async def _run(self) -> None:
+        while True:
+            self._pending = [await self._queue.get()]
+            # Даём пачке набраться: обновления подписок приходят волнами
+            if self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.flush_interval)
+            await self._write(self._drain(self._pending))
+            self._pending = None
+
+    def _drain(self, batch: List[DeviceSighting]) -> List[DeviceSighting]:
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _write(self, batch: List[DeviceSighting]) -> None:
+        started = time.perf_counter()
+        written = 0
+        try:
+            await self.ensure_schema()
+            async with async_session_maker() as session:
+                user_ids = await self._resolve_users(session, {s.token for s in batch})
+                # Последнее обращение устройства выигрывает (и старый, и новый токен после revoke)
+                latest: Dict[Tuple[int, str], DeviceSighting] = {}
+                for sighting in batch:
+                    user_id = user_ids.get(sighting.token)
+                    if user_id is not None:
+                        latest[(user_id, sighting.ua_hash)] = sighting
+                resolved = sum(1 for s in batch if s.token in user_ids)
+                self.stats["unresolved"] += len(batch) - resolved
+                self.stats["coalesced"] += resolved - len(latest)
+                if not latest:
+                    return
+
+                rows = [self._row(s, user_id) for (user_id, _), s in latest.items()]
+                stmt = self._upsert(Device).values(rows)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[Device.user_id, Device.ua_hash],
+                    set_={
+                        "subscription_token": stmt.excluded.subscription_token,
+                        "last_seen": stmt.excluded.last_seen,
+                        "ip_address": stmt.excluded.ip_address,
+                        "user_agent": stmt.excluded.user_agent,
+                        "device_name": stmt.excluded.device_name,
+                        "os_version": stmt.excluded.os_version,
+                        "app_name": stmt.excluded.app_name,
+                        "app_version": stmt.excluded.app_version,
+                    },
+                )
+                await session.execute(stmt)
+                await session.commit()
+                written = len(latest)
+        except Exception as e:
+            self.stats["write_errors"] += 1
+            self.stats["lost"] += len(batch)
+            logger.error(f"Device log batch of {len(batch)} failed: {e}")
+            return
+
+        self.stats["batches"] += 1
+        self.stats["written"] += written
+        self.stats["last_batch_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    @staticmethod
+    def _row(sighting: DeviceSighting, user_id: Optional[int]) -> Dict[str, Any]:
+        row = {field: sighting.info.get(field) for field in _INFO_FIELDS}
+        row.update(
+            subscription_token=sighting.token,
+            ua_hash=sighting.ua_hash,
+            user_id=user_id,
+            ip_address=sighting.ip_address,
+            last_seen=sighting.seen_at,
+        )
+        return row
+
+    async def _resolve_users(self, session, tokens: set) -> Dict[str, int]:
+        """
+        token -> users.id: зеркало панели (short_uuid -> telegram_id), для
+        остальных токенов — RemnawaveService по short_uuid (индекс в памяти,
+        затем точечный запрос в панель) с кэшем ответов в _owners.
+        Токены без пользователя в ответ не попадают.
+        """
+        rows = await session.execute(
+            select(PanelUser.short_uuid, User.id)
+            .join(User, User.telegram_id == PanelUser.telegram_id)
+            .where(PanelUser.short_uuid.in_(tokens))
+        )
+        user_ids: Dict[str, int] = dict(rows.all())
+
+        # telegram_id -> токены (старый и новый токен одного пользователя после revoke)
+        telegram_ids: Dict[int, List[str]] = {}
+        for token, telegram_id in (await self._token_owners(tokens - user_ids.keys())).items():
+            telegram_ids.setdefault(telegram_id, []).append(token)
+        if telegram_ids:
+            rows = await session.execute(
+                select(User.telegram_id, User.id).where(User.telegram_id.in_(telegram_ids))
+            )
+            for telegram_id, user_id in rows.all():
+                for token in telegram_ids[telegram_id]:
+                    user_ids[token] = user_id
+        return user_ids
+
+    async def _token_owners(self, tokens: set) -> Dict[str, int]:
+        """token -> telegram_id владельца: из кэша, остальные — запросом в панель."""
+        owners: Dict[str, int] = {}
+        missing = []
+        for token in tokens:
+            entry = self._owners.get(token)
+            if entry is None or (entry.value is None and entry.age >= self.unknown_token_ttl):
+                missing.append(token)
+            elif entry.value is not None:
+                owners[token] = entry.value
+        if not missing:
+            return owners
+
+        from app.api.services.remnawave import remnawave_service
+
+        semaphore = asyncio.Semaphore(self.lookup_concurrency)
+
+        async def lookup(token: str) -> None:
+            async with semaphore:
+                self.stats["lookups"] += 1
+                try:
+                    panel_user = await remnawave_service.get_user_by_short_uuid(token)
+                except Exception as e:
+                    # Ошибку не кэшируем: следующая пачка спросит снова
+                    self.stats["lookup_errors"] += 1
+                    logger.debug(f"Device log owner lookup for a token failed: {e}")
+                    return
+            telegram_id = panel_user.get("telegram_id") if panel_user else None
+            telegram_id = int(telegram_id) if telegram_id is not None else None
+            self._owners.set(token, telegram_id)
+            if telegram_id is not None:
+                owners[token] = telegram_id
+
+        await asyncio.gather(*(lookup(token) for token in missing))
+        return owners
+
+    # ==================== СХЕМА ====================
+
+    async def ensure_schema(self) -> None:
+        if self._schema_ready:
+            return
+        async with engine.begin() as conn:
+            await conn.run_sync(self._prepare_table)
+        self._schema_ready = True
+
+    @staticmethod
+    def _prepare_table(conn) -> None:
+        inspector = inspect(conn)
+        table = Device.__table__
+        if inspector.has_table(table.name):
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            if "ua_hash" not in columns:
+                # Таблица от старой модели раньше не заполнялась — пустую пересоздаём
+                rows = conn.execute(text(f"SELECT COUNT(*) FROM {table.name}")).scalar()
+                if rows:
+                    raise RuntimeError("devices table has rows but no ua_hash column; migrate it manually")
+                table.drop(conn)
+            elif _USER_UA_CONSTRAINT not in {c["name"] for c in inspector.get_unique_constraints(table.name)}:
+                # Ключ (subscription_token, ua_hash) -> (user_id, ua_hash): строки без пользователя
+                # отбрасываем, дубли одного устройства под разными токенами схлопываем
+                kept: Dict[Tuple[int, str], Dict[str, Any]] = {}
+                for row in conn.execute(
+                    select(table).where(table.c.user_id.isnot(None)).order_by(table.c.last_seen, table.c.id)
+                ).mappings():
+                    kept[(row["user_id"], row["ua_hash"])] = {k: v for k, v in row.items() if k != "id"}
+                logger.warning(f"Migrating devices to one row per user and User-Agent ({len(kept)} rows kept)")
+                table.drop(conn)
+                Base.metadata.create_all(conn, tables=[table])
+                if kept:
+                    conn.execute(insert(table), list(kept.values()))
+                return
+        Base.metadata.create_all(conn, tables=[table])
+
+    # ==================== МЕТРИКИ ====================
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "queued": self._queue.qsize(),
+            "queue_size": self.queue_size,
+            "running": self._task is not None,
+            "token_cache": self._owners.snapshot(),
+        }
+
+
+# Singleton
+device_log = DeviceLog()
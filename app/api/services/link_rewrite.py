@@ -0,0 +1,289 @@
+"""
+Link Rewrite - декларативные правила переписывания ссылок подписки.
+
+Правила читаются из JSON (SUB_REWRITE_RULES, по умолчанию
+app/api/config/link_rewrite.json) и компилируются один раз при старте:
+условия по схеме и query-параметрам, действия rename / append_params /
+drop, плюс добавляемые ссылки (inject) по шаблонам.
+
+Компиляция превращает правила в исходник одной Python-функции (ветка на
+схему, условия — проверки подстрок, все значения из конфига — литералы
+через repr). Каждая ссылка разбирается один раз: scheme / userinfo /
+query / имя за несколько partition, без цепочек поисков по всей строке;
+переписанная ссылка собирается одной f-строкой. Исходник лежит в
+LinkRewriter.source. Новый сервер или переименование — правка конфига, не кода.
+"""
+
+import base64
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES_PATH = Path(__file__).resolve().parent.parent / "config" / "link_rewrite.json"
+
+CAPTURE_FIELDS = ("userinfo", "name", "query")
+
+
+class RewriteConfigError(ValueError):
+    """Ошибка в конфиге правил."""
+
+
+# ==================== ПРАВИЛА ====================
+
+class _Rule:
+    """Правило из конфига: условия и действие."""
+
+    __slots__ = ("name", "scheme", "query", "named", "drop", "rename", "append")
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.name = spec.get("name", "rule")
+        match = spec.get("match") or {}
+        self.scheme: Optional[str] = match.get("scheme")
+        # key -> допустимые значения
+        self.query: Tuple[Tuple[str, Tuple[str, ...]], ...] = tuple(
+            (str(key), tuple(str(v) for v in (values if isinstance(values, list) else [values])))
+            for key, values in (match.get("query") or {}).items()
+        )
+        self.named: Optional[bool] = match.get("named")
+        self.drop = bool(spec.get("drop"))
+        self.rename: Optional[str] = spec.get("rename")
+        params = spec.get("append_params") or {}
+        self.append = "&".join(f"{key}={value}" for key, value in params.items())
+        if not (self.drop or self.rename or self.append):
+            raise RewriteConfigError(f"Rule {self.name!r} has no action")
+
+    def condition(self) -> str:
+        """Условие правила как выражение Python над query / name."""
+        parts = []
+        if self.named is True:
+            parts.append("name is not None")
+        elif self.named is False:
+            parts.append("name is None")
+        for key, values in self.query:
+            needles = [f"&{key}={value}&" for value in values]
+            exact = " or ".join(f"{needle!r} in f'&{{query}}&'" for needle in needles)
+            if len(values) == 1:
+                # Дешёвый отсев подстрокой, точная проверка границ — только если нашлось
+                parts.append(f"{needles[0][1:-1]!r} in query and {exact}")
+            else:
+                parts.append(f"({exact})")
+        return " and ".join(parts) or "True"
+
+    def prefilter(self) -> Optional[str]:
+        """Подстрока, без которой правило точно не подходит (None — такой нет)."""
+        for key, values in self.query:
+            if len(values) == 1:
+                return f"{key}={values[0]}"
+        return None
+
+    def action(self, prefix: str) -> List[str]:
+        """Тело правила: добавить переписанную ссылку (drop — ничего) и перейти к следующей.
+
+        prefix — начало ссылки в синтаксисе f-строки ('vless://' или '{scheme}://'):
+        ссылка собирается одной f-строкой, без цепочки сложений.
+        """
+        if self.drop:
+            return ["continue"]
+        suffix = "" if self.rename is None else "#" + _escape(self.rename)
+        if not self.append:
+            links = [prefix + "{base}" + suffix]
+        elif self.query:
+            # Правило с условием по query подходит только к ссылке с query
+            links = [prefix + "{base}&" + _escape(self.append) + suffix]
+        else:
+            links = [prefix + "{base}" + sep + _escape(self.append) + suffix for sep in "&?"]
+        if self.rename is None:
+            links = [variant for link in links for variant in (link + "#{name}", link)]
+        exprs = [f"f{link!r}" for link in links]
+        if len(exprs) == 4:
+            # (&, ?) x (с именем, без имени)
+            expr = (f"(({exprs[0]}) if name is not None else ({exprs[1]})) if query else "
+                    f"(({exprs[2]}) if name is not None else ({exprs[3]}))")
+        elif len(exprs) == 2:
+            condition = "query" if self.rename is not None else "name is not None"
+            expr = f"({exprs[0]}) if {condition} else ({exprs[1]})"
+        else:
+            expr = exprs[0]
+        return [f"append({expr})", "continue"]
+
+
+def _escape(text: str) -> str:
+    """Текст из конфига как литеральная часть f-строки."""
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+class _Injection:
+    """Ссылка, добавляемая в конец подписки по шаблону."""
+
+    __slots__ = ("name", "requires", "unless_scheme", "template", "constants")
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.name = spec.get("name", "inject")
+        self.requires: Tuple[str, ...] = tuple(spec.get("requires") or ())
+        self.unless_scheme: Optional[str] = spec.get("unless_scheme")
+        self.template: str = spec["template"]
+        self.constants: Dict[str, str] = {}
+        for var, value in (spec.get("vars") or {}).items():
+            if isinstance(value, dict) and "base64" in value:
+                value = base64.b64encode(value["base64"].encode()).decode()
+            self.constants[var] = str(value)
+        # Опечатка в шаблоне всплывёт при старте, а не на запросе клиента
+        try:
+            self.template.format(**self.constants, **{var: "" for var in self.requires})
+        except KeyError as e:
+            raise RewriteConfigError(f"Injection {self.name!r} uses undefined variable {e}")
+
+    def render(self, captured: Dict[str, str], schemes: set) -> Optional[str]:
+        if self.unless_scheme and self.unless_scheme in schemes:
+            return None
+        if any(not captured.get(var) for var in self.requires):
+            return None
+        return self.template.format(**self.constants, **captured)
+
+
+# ==================== КОМПИЛЯЦИЯ ====================
+
+# Разбор остатка ссылки (после "scheme://"): userinfo@host:port?query#name
+_SPLIT_LINES = [
+    "base, hash_sign, name = rest.rpartition('#')",
+    "if not hash_sign:",
+    "    base, name = rest, None",
+    "authority, _, query = base.partition('?')",
+]
+_USERINFO_LINES = [
+    "userinfo, at_sign, _ = authority.partition('@')",
+    "if not at_sign:",
+    "    userinfo = ''",
+]
+
+
+def _branch(rules: List[_Rule], captures: List[Tuple[str, str]], prefix: str) -> List[str]:
+    """Тело ветки одной схемы: разбор, захваты, правила по порядку."""
+    lines = list(_SPLIT_LINES)
+    if any(field == "userinfo" for _, field in captures):
+        lines += _USERINFO_LINES
+    for var, field in captures:
+        # Последняя подходящая ссылка выигрывает
+        lines += [f"if {field}:", f"    captured[{var!r}] = {field}"]
+    for rule in rules:
+        lines.append(f"if {rule.condition()}:  # {rule.name!r}")
+        lines += [f"    {line}" for line in rule.action(prefix)]
+
+    prefilters = [rule.prefilter() for rule in rules]
+    if captures or not rules or None in prefilters:
+        return lines
+    # Ни одно правило не подойдёт без своей подстроки — чужие ссылки даже не разбираем
+    guard = " or ".join(f"{needle!r} in rest" for needle in dict.fromkeys(prefilters))
+    return [f"if {guard}:"] + [f"    {line}" for line in lines]
+
+
+def compile_rules(rules: List[_Rule], captures: Dict[str, Tuple[Optional[str], str]],
+                  watched: Set[str]) -> Tuple[str, Callable]:
+    """Исходник и функция rewrite_links(links, captured, schemes) -> list.
+
+    В schemes попадают только схемы из watched (их спрашивают inject-правила
+    через unless_scheme), а не схема каждой ссылки.
+    """
+    schemes: List[str] = []
+    for scheme in [rule.scheme for rule in rules] + [scheme for scheme, _ in captures.values()]:
+        if scheme and scheme not in schemes:
+            schemes.append(scheme)
+
+    def applicable(scheme: Optional[str]):
+        return (
+            [rule for rule in rules if rule.scheme in (None, scheme)],
+            [(var, field) for var, (s, field) in captures.items() if s in (None, scheme)],
+        )
+
+    body = []
+    for index, scheme in enumerate(schemes):
+        body.append(f"{'if' if index == 0 else 'elif'} scheme == {scheme!r}:")
+        if scheme in watched:
+            body.append(f"    schemes.add({scheme!r})")
+        body += [f"    {line}" for line in _branch(*applicable(scheme), _escape(f"{scheme}://"))]
+    # Правила без схемы — для всех остальных схем
+    other = ["schemes.add(scheme)"] if watched.difference(schemes) else []
+    any_rules, any_captures = applicable(None)
+    if any_rules or any_captures:
+        other += _branch(any_rules, any_captures, "{scheme}://")
+    if other and body:
+        body.append("else:")
+        body += [f"    {line}" for line in other]
+    else:
+        body += other
+
+    lines = [
+        "def rewrite_links(links, captured, schemes):",
+        "    output = []",
+        "    append = output.append",
+        "    for raw in links:",
+        "        scheme, sep, rest = raw.partition('://')",
+        "        if sep:",
+    ]
+    lines += [f"            {line}" for line in body or ["pass"]]
+    lines += [
+        "        append(raw)",
+        "    return output",
+    ]
+    source = "\n".join(lines) + "\n"
+
+    namespace: Dict[str, Any] = {}
+    exec(compile(source, "<link_rewrite rules>", "exec"), namespace)
+    return source, namespace["rewrite_links"]
+
+
+class LinkRewriter:
+    """Скомпилированный набор правил."""
+
+    def __init__(self, config: Dict[str, Any]):
+        rules = [_Rule(spec) for spec in config.get("rules") or []]
+        self.rule_count = len(rules)
+
+        captures: Dict[str, Tuple[Optional[str], str]] = {}
+        for var, spec in (config.get("captures") or {}).items():
+            field = spec.get("field", "userinfo")
+            if field not in CAPTURE_FIELDS:
+                raise RewriteConfigError(f"Capture {var!r}: unknown field {field!r}")
+            captures[var] = (spec.get("scheme"), field)
+
+        self._injections = [_Injection(spec) for spec in config.get("inject") or []]
+        # source — для отладки: что именно выполняется на каждом запросе
+        watched = {injection.unless_scheme for injection in self._injections if injection.unless_scheme}
+        self.source, self._rewrite_links = compile_rules(rules, captures, watched)
+
+    def rewrite(self, links: List[str]) -> List[str]:
+        """Применить правила к ссылкам и добавить inject-ссылки."""
+        captured: Dict[str, str] = {}
+        schemes: set = set()
+        output = self._rewrite_links(links, captured, schemes)
+
+        for injection in self._injections:
+            extra = injection.render(captured, schemes)
+            if extra is not None:
+                output.append(extra)
+        return output
+
+
+def load_rewriter(path: Optional[str] = None) -> LinkRewriter:
+    """Прочитать и скомпилировать правила из JSON."""
+    path = Path(path or os.getenv("SUB_REWRITE_RULES") or DEFAULT_RULES_PATH)
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    rewriter = LinkRewriter(config)
+    logger.info(f"Loaded {rewriter.rule_count} link rewrite rules from {path}")
+    return rewriter
+
+
+_rewriter: Optional[LinkRewriter] = None
+
+
+def get_rewriter() -> LinkRewriter:
+    """Общий скомпилированный набор правил (компилируется один раз)."""
+    global _rewriter
+    if _rewriter is None:
+        _rewriter = load_rewriter()
+    return _rewriter
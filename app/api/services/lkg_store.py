@@ -0,0 +1,198 @@
+"""
+LKG Store - последний удачный ответ /sub на диске (last-known-good).
+
+Кэш ответов живёт в памяти и пропадает при рестарте API: если в этот
+момент Marzban / Remnawave недоступны, клиенты получали 500 и теряли
+конфиги. Здесь каждый удачно переписанный ответ сохраняется в SQLite
+(тело сжато zlib) и отдаётся, когда upstream не отвечает, а в памяти
+ответа нет.
+
+- файл открывается лениво, при первом обращении (старт API не ждёт);
+- запись не блокирует запрос: все операции идут в одном фоновом потоке
+  по очереди (сохранение и следующее за ним удаление не переставятся);
+- ограничения SUB_LKG_MAX_ENTRIES / SUB_LKG_MAX_BYTES / SUB_LKG_MAX_AGE,
+  вытесняются давно не использованные записи (LRU по accessed_at);
+- отозванные / отключённые токены удаляются вместе с кэшем в памяти.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# По умолчанию рядом с остальными данными приложения, а не в текущем каталоге
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), "../../../data/sub_lkg.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lkg (
+    token TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    headers TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lkg_accessed_at ON lkg (accessed_at);
+"""
+
+
+class LastKnownGoodStore:
+    """SQLite-хранилище последних удачных ответов по токену."""
+
+    def __init__(self):
+        self.enabled = os.getenv("SUB_LKG_ENABLED", "true").lower() != "false"
+        self.path = os.getenv("SUB_LKG_PATH", DEFAULT_PATH)
+        self.max_entries = int(os.getenv("SUB_LKG_MAX_ENTRIES", "50000"))
+        self.max_bytes = int(os.getenv("SUB_LKG_MAX_BYTES", str(256 * 1024 * 1024)))
+        self.max_age = float(os.getenv("SUB_LKG_MAX_AGE", str(7 * 86400)))
+        # Проверка ограничений — раз в столько записей
+        self.prune_every = 500
+
+        self._conn: Optional[sqlite3.Connection] = None
+        # Один поток: соединение SQLite не делится, операции выполняются в порядке вызова
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lkg-store")
+        self._writes_since_prune = 0
+        self._pending: Set[asyncio.Task] = set()
+        self.stats = {
+            "saves": 0,
+            "loads": 0,
+            "hits": 0,          # Ответ найден на диске
+            "deletes": 0,
+            "evicted": 0,       # Удалено по возрасту / количеству / размеру
+            "errors": 0,
+            "entries": None,    # После последней проверки ограничений
+            "bytes": None,
+        }
+
+    # ==================== API ====================
+
+    def save_later(self, token: str, body: str, headers: Dict[str, str]) -> None:
+        """Сохранить удачный ответ в фоне (запрос не ждёт диск)."""
+        if self.enabled:
+            self._spawn(self._call(self._save, token, body, headers))
+
+    def delete_later(self, token: str) -> None:
+        """Удалить ответ токена в фоне (revoke / отключение / 4xx от Marzban)."""
+        if self.enabled:
+            self._spawn(self._call(self._delete, token))
+
+    async def load(self, token: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        """(тело, заголовки) последнего удачного ответа токена или None."""
+        if not self.enabled:
+            return None
+        self.stats["loads"] += 1
+        response = await self._call(self._load, token)
+        if response is not None:
+            self.stats["hits"] += 1
+        return response
+
+    async def flush(self) -> None:
+        """Дождаться фоновых записей (shutdown)."""
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "open": self._conn is not None,
+            "pending_writes": len(self._pending),
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
+
+    # ==================== ВНУТРЕННЕЕ ====================
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _call(self, func, *args):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Last-known-good store {func.__name__} failed: {e}")
+            return None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Только из потока self._executor
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+            logger.info(f"Last-known-good store opened: {self.path}")
+        return self._conn
+
+    def _save(self, token: str, text: str, headers: Dict[str, str]) -> None:
+        body = zlib.compress(text.encode("utf-8"), 6)
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            "INSERT INTO lkg (token, body, headers, size, stored_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(token) DO UPDATE SET body = excluded.body, headers = excluded.headers, "
+            "size = excluded.size, stored_at = excluded.stored_at, accessed_at = excluded.accessed_at",
+            (token, body, json.dumps(headers), len(body), now, now),
+        )
+        self.stats["saves"] += 1
+        self._writes_since_prune += 1
+        if self._writes_since_prune >= self.prune_every:
+            self._writes_since_prune = 0
+            self._prune(conn)
+
+    def _delete(self, token: str) -> None:
+        deleted = self._connection().execute("DELETE FROM lkg WHERE token = ?", (token,)).rowcount
+        self.stats["deletes"] += deleted
+
+    def _load(self, token: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT body, headers, stored_at FROM lkg WHERE token = ?", (token,)
+        ).fetchone()
+        if row is None:
+            return None
+        body, headers, stored_at = row
+        if time.time() - stored_at > self.max_age:
+            return None
+        conn.execute("UPDATE lkg SET accessed_at = ? WHERE token = ?", (time.time(), token))
+        return zlib.decompress(body).decode("utf-8"), json.loads(headers)
+
+    def _prune(self, conn: sqlite3.Connection) -> None:
+        """Возраст, затем количество и размер: вытесняем самые давно использованные."""
+        evicted = conn.execute(
+            "DELETE FROM lkg WHERE stored_at < ?", (time.time() - self.max_age,)
+        ).rowcount
+        entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM lkg").fetchone()
+
+        excess = entries - self.max_entries
+        if excess > 0 or total > self.max_bytes:
+            victims = []
+            for token, size in conn.execute("SELECT token, size FROM lkg ORDER BY accessed_at"):
+                if excess <= 0 and total <= self.max_bytes:
+                    break
+                victims.append((token,))
+                excess -= 1
+                total -= size
+            conn.executemany("DELETE FROM lkg WHERE token = ?", victims)
+            evicted += len(victims)
+            entries -= len(victims)
+
+        self.stats["evicted"] += evicted
+        self.stats["entries"] = entries
+        self.stats["bytes"] = total
+
+
+# Singleton
+lkg_store = LastKnownGoodStore()
@@ -0,0 +1,245 @@
+"""
+Local Render - ссылки подписки из зеркала панели, без запроса к Marzban.
+
+Режим SUB_RENDER_MODE=local: для токена /sub берём пользователя из
+зеркала (panel_mirror, индекс по short_uuid), подставляем его учётные
+данные (vless_uuid / trojan_password / ss_password) в шаблоны хостов из
+SUB_RENDER_HOSTS и строим subscription-userinfo по счётчикам трафика из
+зеркала. Дальше ссылки проходят те же правила link_rewrite, что и ответ
+Marzban, поэтому клиент получает ту же подписку.
+
+Панель остаётся источником правды: зеркало сверяется с ней фоновой
+синхронизацией, а запрос идёт в Marzban как раньше, если
+- зеркало устарело (PANEL_MIRROR_MAX_AGE) или пользователя в нём нет;
+- пользователь не active, истёк или выбрал лимит (ответ для них решает панель);
+- токен изменился (revoke / статус) после последней синхронизации зеркала.
+
+Формат файла хостов — app/api/config/render_hosts.example.json.
+"""
+
+import base64
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+from app.api.services.panel_mirror import panel_mirror
+from app.api.services.user_record import UserRecord
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOSTS_PATH = Path(__file__).resolve().parent.parent / "config" / "render_hosts.json"
+
+# Переменные пользователя, доступные в шаблонах ссылок и заголовков
+USER_VARS = ("username", "short_uuid", "vless_uuid", "trojan_password", "ss_password", "ss_userinfo")
+
+
+class RenderConfigError(ValueError):
+    """Ошибка в файле хостов."""
+
+
+def _constant(value: Any) -> str:
+    """Значение из конфига; {"base64": "..."} кодируется при загрузке."""
+    if isinstance(value, dict) and "base64" in value:
+        return base64.b64encode(value["base64"].encode()).decode()
+    return str(value)
+
+
+class _HostTemplate:
+    """Ссылка одного хоста / инбаунда."""
+
+    __slots__ = ("name", "template", "constants", "ss_method", "requires")
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.name = spec.get("name", "host")
+        self.template: str = spec["template"]
+        self.constants = {var: _constant(value) for var, value in (spec.get("vars") or {}).items()}
+        shadowed = sorted(set(self.constants) & set(USER_VARS))
+        if shadowed:
+            raise RenderConfigError(f"Host {self.name!r} vars shadow user variables: {', '.join(shadowed)}")
+        # ss_userinfo = base64("method:password") для Shadowsocks
+        self.ss_method: Optional[str] = spec.get("ss_method")
+        self.requires = tuple(var for var in USER_VARS if "{" + var + "}" in self.template)
+        if "ss_userinfo" in self.requires and not self.ss_method:
+            raise RenderConfigError(f"Host {self.name!r} uses ss_userinfo without ss_method")
+        # Опечатка в шаблоне всплывёт при старте, а не на запросе клиента
+        try:
+            self.template.format(**self.constants, **{var: "" for var in USER_VARS})
+        except KeyError as e:
+            raise RenderConfigError(f"Host {self.name!r} uses undefined variable {e}")
+
+    def render(self, user_vars: Dict[str, str]) -> Optional[str]:
+        if "ss_userinfo" in self.requires:
+            if not user_vars.get("ss_password"):
+                return None
+            user_vars = {**user_vars, "ss_userinfo": base64.b64encode(
+                f"{self.ss_method}:{user_vars['ss_password']}".encode()
+            ).decode()}
+        if any(not user_vars.get(var) for var in self.requires):
+            # Нет учётных данных протокола — хост пропускаем
+            return None
+        return self.template.format(**self.constants, **user_vars)
+
+
+class LocalRenderer:
+    """Шаблоны хостов + чтение пользователя из зеркала."""
+
+    def __init__(self):
+        self.enabled = os.getenv("SUB_RENDER_MODE", "proxy").lower() == "local"
+        self.hosts_path = Path(os.getenv("SUB_RENDER_HOSTS") or DEFAULT_HOSTS_PATH)
+        # Как часто перечитывать состояние зеркала (секунды)
+        self.freshness_ttl = 5.0
+
+        self._hosts: Optional[List[_HostTemplate]] = None
+        self._headers: Dict[str, str] = {}
+        self._mirror_synced_at = 0.0
+        self._mirror_stale = True
+        self._freshness_checked = 0.0
+        # token -> когда панель сообщила об изменении (до синхронизации зеркала идём в Marzban)
+        self._changed: Dict[str, float] = {}
+        self.stats = {
+            "rendered": 0,
+            "fallback_stale": 0,      # Зеркало устарело
+            "fallback_missing": 0,    # Токена нет в зеркале
+            "fallback_inactive": 0,   # Не active / истёк / лимит
+            "fallback_changed": 0,    # Изменён после синхронизации зеркала
+            "fallback_error": 0,
+        }
+
+    # ==================== КОНФИГ ====================
+
+    def load(self) -> None:
+        """Прочитать шаблоны хостов; ошибка конфига отключает режим (подписки идут в Marzban)."""
+        if not self.enabled:
+            return
+        try:
+            with open(self.hosts_path, encoding="utf-8") as f:
+                config = json.load(f)
+            hosts = [_HostTemplate(spec) for spec in config.get("hosts") or []]
+            if not hosts:
+                raise RenderConfigError("no hosts")
+            headers = {name: _constant(value) for name, value in (config.get("headers") or {}).items()}
+            for name, value in headers.items():
+                try:
+                    value.format(**{var: "" for var in USER_VARS})
+                except KeyError as e:
+                    raise RenderConfigError(f"Header {name!r} uses undefined variable {e}")
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Local subscription render disabled, cannot load {self.hosts_path}: {e}")
+            self.enabled = False
+            return
+        self._hosts, self._headers = hosts, headers
+        logger.info(f"Local subscription render: {len(hosts)} hosts from {self.hosts_path}")
+        if not panel_mirror.enabled:
+            logger.warning("Local subscription render needs the panel mirror (PANEL_MIRROR_ENABLED=true)")
+
+    # ==================== РЕНДЕР ====================
+
+    async def render(self, token: str) -> Optional[Tuple[List[str], Dict[str, str]]]:
+        """(ссылки до link_rewrite, заголовки) или None — отдать запрос в Marzban."""
+        if not self.enabled:
+            return None
+        if self._hosts is None:
+            self.load()
+            if not self.enabled:
+                return None
+        try:
+            await self._check_freshness()
+            if self._mirror_stale:
+                self.stats["fallback_stale"] += 1
+                return None
+            changed_at = self._changed.get(token)
+            if changed_at is not None:
+                if changed_at >= self._mirror_synced_at:
+                    self.stats["fallback_changed"] += 1
+                    return None
+                del self._changed[token]
+            user = await panel_mirror.get_by_token(token)
+        except Exception as e:
+            self.stats["fallback_error"] += 1
+            logger.warning(f"Local render failed for {token[:10]}..., using upstream: {e}")
+            return None
+
+        if user is None:
+            self.stats["fallback_missing"] += 1
+            return None
+        if not self._is_servable(user):
+            self.stats["fallback_inactive"] += 1
+            return None
+
+        user_vars = {var: str(user.get(var) or "") for var in USER_VARS}
+        links = [link for link in (host.render(user_vars) for host in self._hosts) if link is not None]
+        headers = self.render_headers(user_vars)
+        headers["subscription-userinfo"] = self.userinfo(user)
+        self.stats["rendered"] += 1
+        return links, headers
+
+    def render_headers(self, user_vars: Dict[str, str]) -> Dict[str, str]:
+        """
+        Заголовки из шаблонов. Значения переменных percent-encoded (RFC 5987):
+        username из панели может содержать кавычки, ';', перевод строки или
+        не-ASCII, которые сломали бы content-disposition.
+        """
+        encoded = {var: quote(value, safe="") for var, value in user_vars.items()}
+        return {name: value.format(**encoded) for name, value in self._headers.items()}
+
+    @staticmethod
+    def userinfo(user: UserRecord) -> str:
+        """subscription-userinfo из счётчиков зеркала (панель не делит трафик на upload / download)."""
+        return (
+            f"upload=0; download={int(user.get('used_traffic') or 0)}; "
+            f"total={int(user.get('data_limit') or 0)}; expire={int(user.get('expire') or 0)}"
+        )
+
+    @staticmethod
+    def _is_servable(user: UserRecord) -> bool:
+        if user.get("status") != "active":
+            return False
+        expire = user.get("expire") or 0
+        if expire and expire <= time.time():
+            return False
+        limit = user.get("data_limit") or 0
+        if limit and (user.get("used_traffic") or 0) >= limit:
+            return False
+        return True
+
+    async def _check_freshness(self) -> None:
+        now = time.monotonic()
+        if now - self._freshness_checked < self.freshness_ttl:
+            return
+        mirror = await panel_mirror.freshness()
+        self._mirror_stale = mirror["stale"]
+        if mirror["synced_at"] is not None:
+            self._mirror_synced_at = datetime.fromisoformat(mirror["synced_at"]).timestamp()
+            # Изменения до синхронизации зеркала уже в нём
+            self._changed = {t: at for t, at in self._changed.items() if at >= self._mirror_synced_at}
+        self._freshness_checked = now
+
+    # ==================== ИНВАЛИДАЦИЯ ====================
+
+    def mark_changed(self, tokens: List[str]) -> None:
+        """Слушатель remnawave_service: токены идут в Marzban до следующей синхронизации зеркала."""
+        if not self.enabled:
+            return
+        now = time.time()
+        for token in tokens:
+            self._changed[token] = now
+
+    # ==================== МЕТРИКИ ====================
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "hosts": len(self._hosts or ()),
+            "mirror_stale": self._mirror_stale,
+            "pending_changes": len(self._changed),
+        }
+
+
+# Singleton
+local_renderer = LocalRenderer()
@@ -0,0 +1,316 @@
+"""
+Panel Mirror - локальная SQL-копия пользователей Remnawave.
+
+Фоновая delta-синхронизация проходит по выборке панели, сравнивает хэш
+содержимого каждой записи с сохранённым и пишет в БД только изменившиеся
+строки (и удаляет пропавшие). Админка читает зеркало индексированным SQL
+вместо полной выборки панели; каждый путь чтения сообщает, насколько
+зеркало свежее (см. freshness()). Решения о включении / отключении ключей
+(сверка подписок) принимаются по живой панели, не по зеркалу.
+
+Полная пересборка для восстановления: cron/resync_panel_mirror.py
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from sqlalchemy import case, delete, func, insert, inspect, or_, select, update
+
+from app.api.db.database import Base, async_session_maker, engine
+from app.api.models import PanelMirrorState, PanelUser
+from app.api.services.user_record import USER_FIELDS, UserRecord
+
+logger = logging.getLogger(__name__)
+
+# Поле UserRecord -> колонка panel_users
+_FIELD_COLUMNS = tuple((field, "uuid" if field == "_uuid" else field) for field in USER_FIELDS)
+_STATE_ID = 1
+
+
+def content_hash(record: UserRecord) -> str:
+    """Хэш всех полей записи: совпал — строку в БД не трогаем."""
+    payload = "\x1f".join("" if value is None else str(value) for value in record.values())
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class PanelMirror:
+    """Зеркало пользователей панели в SQL с delta-синхронизацией."""
+
+    def __init__(self):
+        self.enabled = os.getenv("PANEL_MIRROR_ENABLED", "false").lower() == "true"
+        self.interval = float(os.getenv("PANEL_MIRROR_INTERVAL", "120"))
+        # Старше этого зеркало считается устаревшим (локальный рендер /sub идёт в панель)
+        self.max_age = float(os.getenv("PANEL_MIRROR_MAX_AGE", "600"))
+        self.batch_size = 500
+
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._schema_ready = False
+        self.last_result: Optional[Dict[str, Any]] = None
+
+    # ==================== СИНХРОНИЗАЦИЯ ====================
+
+    async def ensure_schema(self) -> None:
+        """Создать таблицы зеркала (бот и cron не проходят через startup API)."""
+        if self._schema_ready:
+            return
+        async with engine.begin() as conn:
+            await conn.run_sync(self._prepare_tables)
+        self._schema_ready = True
+
+    @staticmethod
+    def _prepare_tables(conn) -> None:
+        inspector = inspect(conn)
+        if inspector.has_table(PanelUser.__tablename__):
+            columns = {column["name"] for column in inspector.get_columns(PanelUser.__tablename__)}
+            missing = [column for _, column in _FIELD_COLUMNS if column not in columns]
+            if missing:
+                # Зеркало восстанавливается из панели: пересоздаём, следующий проход зальёт всё
+                logger.warning(f"panel_users lacks {missing}, recreating the mirror table")
+                PanelUser.__table__.drop(conn)
+                if inspector.has_table(PanelMirrorState.__tablename__):
+                    conn.execute(delete(PanelMirrorState))
+        Base.metadata.create_all(conn, tables=[PanelUser.__table__, PanelMirrorState.__table__])
+
+    async def sync(self, full: bool = False) -> Dict[str, Any]:
+        """
+        Один проход синхронизации.
+        full=False: пишем только новые/изменившиеся записи (по хэшу), удаляем пропавшие.
+        full=True: перезаписываем все записи без сверки хэшей (восстановление).
+        Каждая страница выборки — своя короткая транзакция, чтобы не держать
+        блокировку записи на весь проход. Выборка прервалась — записанные
+        страницы остаются (это данные панели), а удаление пропавших и отметка
+        синхронизации (freshness) делаются только после полного прохода.
+        """
+        from app.api.services.remnawave import remnawave_service
+
+        async with self._lock:
+            await self.ensure_schema()
+            started = _utcnow()
+            result = {"mode": "full" if full else "delta", "seen": 0, "inserted": 0,
+                      "updated": 0, "unchanged": 0, "deleted": 0}
+            try:
+                async with async_session_maker() as session:
+                    rows = await session.execute(select(PanelUser.uuid, PanelUser.content_hash))
+                    known: Dict[str, str] = dict(rows.all())
+                    await session.commit()
+
+                    seen = set()
+                    async for page in remnawave_service.iter_user_pages():
+                        inserts, updates = [], []
+                        for record in page:
+                            uuid = record.get("_uuid")
+                            if not uuid or uuid in seen:
+                                continue
+                            seen.add(uuid)
+                            digest = content_hash(record)
+                            if not full and known.get(uuid) == digest:
+                                result["unchanged"] += 1
+                                continue
+                            values = self._row_values(record, digest, started)
+                            (updates if uuid in known else inserts).append(values)
+                        if inserts:
+                            await session.execute(insert(PanelUser), inserts)
+                        if updates:
+                            await session.execute(update(PanelUser), updates)
+                        await session.commit()
+                        result["inserted"] += len(inserts)
+                        result["updated"] += len(updates)
+
+                    gone = [uuid for uuid in known if uuid not in seen]
+                    for start in range(0, len(gone), self.batch_size):
+                        chunk = gone[start:start + self.batch_size]
+                        await session.execute(delete(PanelUser).where(PanelUser.uuid.in_(chunk)))
+                        await session.commit()
+                    result["deleted"] = len(gone)
+                    result["seen"] = len(seen)
+
+                    state = await self._get_state(session)
+                    state.last_sync_at = started
+                    if full:
+                        state.last_full_sync_at = started
+                    state.users_count = len(seen)
+                    state.last_error = None
+                    await session.commit()
+            except Exception as e:
+                logger.error(f"Panel mirror {result['mode']} sync failed: {e}")
+                await self._record_error(e)
+                raise
+
+            result["duration"] = round((_utcnow() - started).total_seconds(), 3)
+            self.last_result = result
+            logger.info(f"Panel mirror sync: {result}")
+            return result
+
+    async def resync(self) -> Dict[str, Any]:
+        """Полная пересборка зеркала."""
+        return await self.sync(full=True)
+
+    # ==================== ФОНОВЫЙ ЦИКЛ ====================
+
+    def start(self) -> None:
+        """Запустить фоновую синхронизацию (если PANEL_MIRROR_ENABLED=true)."""
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Panel mirror sync started (every {self.interval:.0f}s)")
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Уже залогировано в sync(); следующий проход попробует снова
+                pass
+            await asyncio.sleep(self.interval)
+
+    # ==================== ЧТЕНИЕ ====================
+
+    async def freshness(self) -> Dict[str, Any]:
+        """Когда зеркало последний раз успешно синхронизировано и не устарело ли оно."""
+        await self.ensure_schema()
+        async with async_session_maker() as session:
+            state = await session.get(PanelMirrorState, _STATE_ID)
+
+        if state is None or state.last_sync_at is None:
+            return {"synced_at": None, "age": None, "stale": True, "users": 0,
+                    "last_error": state.last_error if state else None}
+
+        synced_at = state.last_sync_at
+        if synced_at.tzinfo is None:
+            # SQLite отдаёт naive datetime
+            synced_at = synced_at.replace(tzinfo=timezone.utc)
+        age = (_utcnow() - synced_at).total_seconds()
+        return {
+            "synced_at": synced_at.isoformat(),
+            "age": round(age, 1),
+            "stale": age > self.max_age,
+            "users": state.users_count or 0,
+            "last_error": state.last_error,
+        }
+
+    async def overview(self) -> Optional[Dict[str, Any]]:
+        """Счётчики для дашборда; None, если зеркало ещё ни разу не синхронизировано."""
+        mirror = await self.freshness()
+        if mirror["synced_at"] is None:
+            return None
+        async with async_session_maker() as session:
+            row = (await session.execute(select(
+                func.count(),
+                func.coalesce(func.sum(case((PanelUser.status == "active", 1), else_=0)), 0),
+                func.coalesce(func.sum(PanelUser.used_traffic), 0),
+            ))).one()
+        return {
+            "total_users": row[0],
+            "active_users": int(row[1]),
+            "total_traffic": int(row[2]),
+            "mirror": mirror,
+        }
+
+    async def list_users(self, search: Optional[str] = None, status: Optional[str] = None,
+                         offset: int = 0, limit: int = 20) -> Optional[Dict[str, Any]]:
+        """
+        Страница пользователей с поиском (username / Telegram ID) и фильтром статуса.
+        None, если зеркало ещё ни разу не синхронизировано.
+        """
+        mirror = await self.freshness()
+        if mirror["synced_at"] is None:
+            return None
+
+        conditions = []
+        if search:
+            needle = search.lower()
+            match = func.lower(PanelUser.username).contains(needle, autoescape=True)
+            if needle.isdigit():
+                match = or_(match, PanelUser.telegram_id == int(needle))
+            conditions.append(match)
+        if status:
+            conditions.append(PanelUser.status == status)
+
+        async with async_session_maker() as session:
+            total = (await session.execute(
+                select(func.count()).select_from(PanelUser).where(*conditions)
+            )).scalar_one()
+            rows = (await session.execute(
+                select(PanelUser).where(*conditions)
+                .order_by(PanelUser.username).offset(offset).limit(limit)
+            )).scalars().all()
+
+        return {"items": [self._to_record(row) for row in rows], "total": total, "mirror": mirror}
+
+    async def get_user(self, username: str) -> Optional[UserRecord]:
+        """Пользователь по username или по Telegram ID из user_123 (как UserDirectory.get)."""
+        await self.ensure_schema()
+        async with async_session_maker() as session:
+            row = (await session.execute(
+                select(PanelUser).where(PanelUser.username == username).limit(1)
+            )).scalar_one_or_none()
+            if row is None and username.startswith("user_") and username[5:].isdigit():
+                row = (await session.execute(
+                    select(PanelUser).where(PanelUser.telegram_id == int(username[5:])).limit(1)
+                )).scalar_one_or_none()
+        return self._to_record(row) if row is not None else None
+
+    async def get_by_token(self, token: str) -> Optional[UserRecord]:
+        """Пользователь по токену /sub (short_uuid, индекс)."""
+        await self.ensure_schema()
+        async with async_session_maker() as session:
+            row = (await session.execute(
+                select(PanelUser).where(PanelUser.short_uuid == token).limit(1)
+            )).scalar_one_or_none()
+        return self._to_record(row) if row is not None else None
+
+    # ==================== ВНУТРЕННЕЕ ====================
+
+    @staticmethod
+    def _row_values(record: UserRecord, digest: str, synced_at: datetime) -> Dict[str, Any]:
+        values = {column: record.get(field) for field, column in _FIELD_COLUMNS}
+        values["content_hash"] = digest
+        values["synced_at"] = synced_at
+        return values
+
+    @staticmethod
+    def _to_record(row: PanelUser) -> UserRecord:
+        return UserRecord(**{field: getattr(row, column) for field, column in _FIELD_COLUMNS})
+
+    @staticmethod
+    async def _get_state(session) -> PanelMirrorState:
+        state = await session.get(PanelMirrorState, _STATE_ID)
+        if state is None:
+            state = PanelMirrorState(id=_STATE_ID, users_count=0)
+            session.add(state)
+        return state
+
+    async def _record_error(self, error: Exception) -> None:
+        try:
+            async with async_session_maker() as session:
+                state = await self._get_state(session)
+                state.last_error = str(error)[:500]
+                state.last_error_at = _utcnow()
+                await session.commit()
+        except Exception as e:
+            logger.debug(f"Could not store panel mirror error: {e}")
+
+
+# Singleton
+panel_mirror = PanelMirror()
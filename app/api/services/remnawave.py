@@ -3,14 +3,27 @@ Remnawave Service - замена MarzbanService для работы с Remnawave
 Полная совместимость с существующим кодом бота.
 """
 
+import asyncio
 import httpx
 import os
+import re
 import logging
-from typing import Optional, Dict, Any, List
+from collections import deque
+from typing import Optional, Dict, Any, List, AsyncIterator, Deque, Iterable, Callable
 from datetime import datetime
 
+from app.api.services.device_channel import DeviceQueryChannel
+from app.api.services.single_flight import SingleFlight
+from app.api.services.ttl_cache import TTLCache
+from app.api.services.user_agent import parse_user_agent
+from app.api.services.user_directory import UserDirectory
+from app.api.services.user_lookup import DirectLookup
+from app.api.services.user_record import UserRecord, records_from_panel
+
 logger = logging.getLogger(__name__)
 
+_UUID_RE = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
+
 
 class RemnawaveService:
     """Сервис для работы с Remnawave API (замена MarzbanService)."""
@@ -22,6 +35,50 @@ class RemnawaveService:
         verify_ssl = os.getenv("REMNAWAVE_VERIFY_SSL", "true").lower() != "false"
         self.client = httpx.AsyncClient(timeout=30.0, verify=verify_ssl)
         
+        # Индекс пользователей в памяти (username / telegram_id / uuid / short_uuid).
+        # Webhook-события обновляют его только в процессе API, бот полагается на TTL
+        self.directory = UserDirectory(ttl=float(os.getenv("REMNAWAVE_USER_CACHE_TTL", "60")))
+        
+        # Пагинация /api/users: parallel | sequential
+        self.pagination_mode = os.getenv("REMNAWAVE_PAGINATION", "parallel").lower()
+        self.page_limit = 50  # Запрашиваем по 50, но сервер может отдать 25
+        self.page_concurrency = max(1, int(os.getenv("REMNAWAVE_PAGE_CONCURRENCY", "4")))
+        self.page_retries = max(0, int(os.getenv("REMNAWAVE_PAGE_RETRIES", "2")))
+        
+        # Точечный поиск по ключу (uuid / short_uuid / username / telegram_id) до полной выборки
+        self.direct_lookup_enabled = os.getenv("REMNAWAVE_DIRECT_LOOKUP", "true").lower() != "false"
+        self.lookup = DirectLookup(
+            self.client, self.base_url, self._get_headers,
+            recheck_after=float(os.getenv("REMNAWAVE_LOOKUP_RECHECK", "3600"))
+        )
+        
+        # Массовая смена статуса: параллельные PUT или bulk-эндпоинт панели (если задан)
+        self.bulk_concurrency = max(1, int(os.getenv("REMNAWAVE_BULK_CONCURRENCY", "8")))
+        self.bulk_endpoint = os.getenv("REMNAWAVE_BULK_ENDPOINT", "")  # например /api/users/bulk/update
+        self.bulk_chunk_size = 500
+        
+        # Одновременные одинаковые запросы (листинг, lookup по ключу) делят один вызов
+        self._flights = SingleFlight()
+        
+        # Постоянный ssh + psql канал к БД панели (устройства hwid)
+        self.device_channel = DeviceQueryChannel()
+        self.device_chunk_size = 500  # UUID в одном ANY(...) запросе
+        
+        # Кэш устройств по UUID: список моделей меняется редко
+        self.device_cache = TTLCache(
+            maxsize=int(os.getenv("REMNAWAVE_DEVICE_CACHE_SIZE", "2048")),
+            ttl=float(os.getenv("REMNAWAVE_DEVICE_CACHE_TTL", "300"))
+        )
+        # Сколько секунд после TTL можно отдавать старый список, обновляя его в фоне (0 — выкл.)
+        self.device_cache_stale = float(os.getenv("REMNAWAVE_DEVICE_CACHE_STALE", "0"))
+        # Поколение записи по UUID: растёт при сбросе, чтобы загрузка, начатая
+        # до сброса, не вернула в кэш старый список
+        self._device_generations: Dict[str, int] = {}
+        self._background_tasks = set()
+        
+        # Кто держит ответы /sub по токену (кэш подписок): зовём при revoke / смене статуса
+        self._subscription_listeners: List[Callable[[List[str]], None]] = []
+        
         if not self.api_key:
             logger.warning("REMNAWAVE_API_KEY not set!")
     
@@ -34,112 +91,333 @@ class RemnawaveService:
     
     # ==================== ПОЛЬЗОВАТЕЛИ ====================
     
-    async def get_user(self, username: str, fetch_devices: bool = False) -> Optional[Dict[str, Any]]:
+    async def get_user(self, username: str, fetch_devices: bool = False,
+                       raise_errors: bool = False) -> Optional[UserRecord]:
         """
         Получить пользователя по username.
         Совместимость: принимает username (user_123), ищет в Remnawave.
+        Порядок поиска: свежий индекс UserDirectory -> эндпоинты панели по
+        ключу (DirectLookup) -> полная выборка, если панель не дала ответа.
+        Одновременные вызовы с тем же ключом делят один запрос.
         fetch_devices: Если True, загружает список устройств через SSH.
+        raise_errors: пробросить ошибку панели; тогда None значит только
+        «такого пользователя нет».
+        """
+        try:
+            user = await self._flights.run(
+                ("user", username, fetch_devices),
+                lambda: self._get_user(username, fetch_devices)
+            )
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.error(f"Error fetching user {username}: {e}")
+            return None
+        # Каждому вызывающему — своя копия общего результата
+        return user.copy() if user is not None else None
+    
+    async def _get_user(self, username: str, fetch_devices: bool) -> Optional[UserRecord]:
+        """Lookup без объединения вызовов (см. get_user); ошибки панели пробрасывает."""
+        target_user = await self._find_user(username)
+        
+        if target_user:
+            # Отдаём копию, чтобы не портить запись в справочнике
+            target_user = target_user.copy()
+            
+            # Если нужны устройства, подгружаем через SSH (так как get_all_users их не грузит)
+            if fetch_devices:
+                # В target_user['sub_last_user_agent'] лежит сырая строка, если мы её не обогатили
+                # Но нам нужен UUID (он есть в hidden поле _uuid)
+                
+                user_uuid = target_user.get("_uuid")
+                if user_uuid:
+                    model = await self._get_device_model_from_ssh(user_uuid)
+                    if model:
+                        target_user["sub_last_user_agent"] = model
+                        
+            return target_user
+            
+        return None
+    
+    async def _find_user(self, username: str) -> Optional[UserRecord]:
+        """Найти запись пользователя самым дешёвым доступным способом."""
+        if self.directory.is_fresh():
+            user = self.directory.get(username)
+            if user is not None:
+                return user
+        
+        if self.direct_lookup_enabled:
+            telegram_id = self._telegram_id_from_username(username)
+            user = await self._lookup_direct(username=username, telegram_id=telegram_id)
+            if user is not False:
+                return user
+        
+        # Панель не ответила по ключу — перебираем всех
+        if not self.directory.is_fresh():
+            await self._refresh_directory()
+        user = self.directory.get(username)
+        if user is None and not self.directory.is_fresh():
+            # Выборка не удалась: «нет такого пользователя» мы не знаем
+            raise Exception(f"User list unavailable, cannot resolve {username}")
+        return user
+    
+    async def _lookup_direct(self, username: Optional[str] = None,
+                             telegram_id: Optional[int] = None):
         """
-    async def get_user(self, username: str, fetch_devices: bool = False) -> Optional[Dict[str, Any]]:
+        Поиск через эндпоинты по ключу.
+        UserRecord — найден, None — панель подтвердила, что его нет,
+        False — ответа нет (эндпоинты не поддерживаются или ошибка), нужен перебор.
+        """
+        # uuid / short_uuid берём из старой записи индекса: это самые дешёвые запросы
+        known = (self.directory.get(username) if username else None) \
+            or (self.directory.get_by_telegram_id(telegram_id) if telegram_id is not None else None)
+        keys = {
+            "uuid": known.get("_uuid") if known else None,
+            "short_uuid": known.get("short_uuid") if known else None,
+            "username": username,
+            "telegram_id": telegram_id,
+        }
+        
+        def match(raw: Dict[str, Any]) -> bool:
+            if username and raw.get("username") == username:
+                return True
+            return telegram_id is not None and str(raw.get("telegramId")) == str(telegram_id)
+        
+        result = await self.lookup.find(keys, match=match)
+        if result.user is not None:
+            record = self._convert_user_format(result.user)
+            self.directory.upsert(record)
+            return record
+        if result.conclusive:
+            if known is not None:
+                self.directory.remove(known)
+            return None
+        return False
+    
+    async def get_user_by_short_uuid(self, short_uuid: str) -> Optional[UserRecord]:
         """
-        Получить информацию о пользователе.
-        Ищет по всем страницам через get_all_users, так как прямой поиск по API сломан.
+        Пользователь по токену /sub (short_uuid).
+        Порядок: свежий индекс -> /api/users/by-short-uuid -> полная выборка,
+        только если эндпоинт не поддерживается. Ошибки панели пробрасывает.
         """
+        return await self._flights.run(
+            ("short_uuid", short_uuid),
+            lambda: self._find_by_short_uuid(short_uuid)
+        )
+    
+    async def _find_by_short_uuid(self, short_uuid: str) -> Optional[UserRecord]:
+        if self.directory.is_fresh():
+            user = self.directory.get_by_short_uuid(short_uuid)
+            if user is not None:
+                return user
+    
+        if self.direct_lookup_enabled and self.lookup.supports("short_uuid") is not False:
+            result = await self.lookup.find(
+                {"short_uuid": short_uuid},
+                match=lambda raw: raw.get("shortUuid") == short_uuid
+            )
+            if result.user is not None:
+                record = self._convert_user_format(result.user)
+                self.directory.upsert(record)
+                return record
+            if self.lookup.supports("short_uuid"):
+                # Эндпоинт ответил, но пользователя не дал (нет такого или ошибка)
+                return None
+    
+        if not self.directory.is_fresh():
+            await self._refresh_directory()
+        return self.directory.get_by_short_uuid(short_uuid)
+    
+    @staticmethod
+    def _telegram_id_from_username(username: str) -> Optional[int]:
+        if username.startswith("user_"):
+            try:
+                return int(username[len("user_"):])
+            except ValueError:
+                return None
+        return None
+    
+    async def _refresh_directory(self) -> None:
+        """Перечитать всех пользователей панели в справочник."""
+        # get_all_users сам обновляет справочник при полной выборке
+        await self.get_all_users()
+    
+    async def get_all_users(self) -> List[UserRecord]:
+        """
+        Получить всех пользователей из Remnawave (с поддержкой пагинации).
+        Собирает iter_user_pages в один список и обновляет справочник.
+        Одновременные вызовы делят одну выборку.
+        Потребителям, которым не нужен весь список разом, лучше iter_users().
+        """
+        users = await self._flights.run(("all_users",), self._load_all_users)
+        return list(users)
+    
+    def get_coalescing_stats(self) -> Dict[str, int]:
+        """Счётчики объединения запросов: calls / leaders / coalesced / in_flight."""
+        return {**self._flights.stats, "in_flight": self._flights.in_flight}
+    
+    def get_lookup_stats(self) -> Dict[str, Any]:
+        """Счётчики точечного поиска и поддержка эндпоинтов панелью."""
+        return {**self.lookup.stats, "endpoints": self.lookup.support_snapshot()}
+    
+    async def _load_all_users(self) -> List[UserRecord]:
+        """Полная выборка без объединения вызовов (см. get_all_users)."""
         try:
-            # Получаем всех пользователей (с учетом пагинации)
-            all_users = await self.get_all_users()
+            all_users = []
+            async for page in self.iter_user_pages():
+                all_users.extend(page)
             
-            target_user = None
+            # Сюда доходим только при полной выборке — неполный список не публикуем
+            self.directory.replace(all_users)
             
-            # 1. Точное совпадение username
-            for user in all_users:
-                if user.get("username") == username:
-                    target_user = user
-                    break
+            logger.info(f"Total users fetched: {len(all_users)}")
+            return all_users
             
-            # 2. Поиск по Telegram ID (если username = user_123)
-            if not target_user and username.startswith("user_"):
-                try:
-                    tg_id = int(username.replace("user_", ""))
-                    for user in all_users:
-                        if user.get("telegram_id") == tg_id:
-                            target_user = user
-                            break
-                except ValueError:
-                    pass
+        except Exception as e:
+            logger.error(f"Error fetching all users: {e}")
+            return []
+    
+    async def iter_users(self) -> AsyncIterator[UserRecord]:
+        """
+        Потоково отдать пользователей панели по одному.
+        Следующие страницы уже качаются, пока вызывающий обрабатывает текущую.
+        Ошибка страницы (после повторов) пробрасывается вызывающему.
+        """
+        async for page in self.iter_user_pages():
+            for user in page:
+                yield user
+    
+    async def iter_user_pages(self) -> AsyncIterator[List[UserRecord]]:
+        """
+        Потоково отдать пользователей страницами в исходном порядке.
+        В режиме parallel первая страница сообщает total, а вперёд качается
+        не больше REMNAWAVE_PAGE_CONCURRENCY окон — память не растёт с базой.
+        """
+        first = await self._fetch_users_page(0, self.page_limit)
+        first_users = first.get("users", [])
+        if not first_users:
+            return
+        
+        yield records_from_panel(first_users)
+        
+        total = first.get("total")
+        offset = len(first_users)
+        
+        if self.pagination_mode == "parallel" and isinstance(total, int):
+            # Реальный размер страницы (сервер может отдать 25 вместо 50)
+            page_size = len(first_users)
+            offsets = iter(range(page_size, total, page_size))
+            pending: Deque[asyncio.Task] = deque()
             
-            if target_user:
-                # Если нужны устройства, подгружаем через SSH (так как get_all_users их не грузит)
-                if fetch_devices:
-                    # В target_user['sub_last_user_agent'] лежит сырая строка, если мы её не обогатили
-                    # Но нам нужен UUID (он есть в hidden поле _uuid)
-                    
-                    user_uuid = target_user.get("_uuid")
-                    if user_uuid:
-                        model = await self._get_device_model_from_ssh(user_uuid)
-                        if model:
-                            target_user["sub_last_user_agent"] = model
-                            
-                return target_user
-                
-            return None
+            def schedule_next() -> None:
+                window_start = next(offsets, None)
+                if window_start is not None:
+                    pending.append(asyncio.create_task(
+                        self._fetch_users_window(window_start, min(window_start + page_size, total))
+                    ))
             
-        except Exception as e:
-            logger.error(f"Error fetching user {username}: {e}")
-            return None
+            for _ in range(self.page_concurrency):
+                schedule_next()
+            
+            try:
+                while pending:
+                    rows = await pending.popleft()
+                    schedule_next()
+                    if rows:
+                        yield records_from_panel(rows)
+            finally:
+                self._cancel_tasks(pending)
+            
+            # Пользователи, добавленные во время выборки, окажутся за total — дочитываем хвост
+            offset = max(total, page_size)
+        
+        async for page in self._iter_pages_sequential(offset, previous_first=first_users[0].get("uuid")):
+            yield page
     
-    async def get_all_users(self) -> List[Dict[str, Any]]:
-        """Получить всех пользователей из Remnawave (с поддержкой пагинации)."""
-        all_users = []
+    async def _iter_pages_sequential(self, offset: int, previous_first: Optional[str] = None) -> AsyncIterator[List[UserRecord]]:
+        """Последовательные страницы с предзагрузкой следующей, начиная с offset."""
         # Используем running offset, так как сервер может возвращать меньше записей, чем limit
-        current_offset = 0
-        limit = 50 # Запрашиваем по 50, но сервер может отдать 25
-        
+        next_page = asyncio.create_task(self._fetch_users_page(offset, self.page_limit))
         try:
-            headers = await self._get_headers()
-            
             while True:
+                page = await next_page
+                users = page.get("users", [])
+                
+                # Если вернулось 0, то выходим
+                if not users:
+                    return
+                
+                # Защита от бесконечного цикла: панель игнорирует start и отдаёт одно и то же
+                first_uuid = users[0].get("uuid")
+                if first_uuid is not None and first_uuid == previous_first:
+                    raise Exception(f"Pagination stalled at offset {offset}: page repeats")
+                previous_first = first_uuid
+                
+                # Увеличиваем смещение на реальное количество полученных пользователей
+                offset += len(users)
+                next_page = asyncio.create_task(self._fetch_users_page(offset, self.page_limit))
+                
+                yield records_from_panel(users)
+        finally:
+            self._cancel_tasks([next_page])
+    
+    @staticmethod
+    def _cancel_tasks(tasks) -> None:
+        """Отменить недочитанные предзагрузки (вызывающий вышел из итерации)."""
+        for task in tasks:
+            if task.done():
+                if not task.cancelled():
+                    task.exception()  # Чтобы asyncio не ругался на непрочитанную ошибку
+            else:
+                task.cancel()
+    
+    async def _fetch_users_page(self, offset: int, limit: int) -> Dict[str, Any]:
+        """
+        Одна страница /api/users с повторами.
+        Возвращает объект response панели ({"users": [...], "total": N}).
+        Ошибка после всех повторов пробрасывается — список не обрезается молча.
+        """
+        headers = await self._get_headers()
+        last_error = None
+        
+        for attempt in range(self.page_retries + 1):
+            try:
                 # API использует параметр 'start' для смещения
                 response = await self.client.get(
-                    f"{self.base_url}/api/users?start={current_offset}&limit={limit}",
+                    f"{self.base_url}/api/users?start={offset}&limit={limit}",
                     headers=headers
                 )
-                
                 if response.status_code == 200:
-                    data = response.json()
-                    response_data = data.get("response", {})
-                    users = response_data.get("users", [])
-                    
-                    if not users:
-                        break
-                        
-                    for u in users:
-                        # Логируем имена для отладки
-                        # logger.info(f"Found user: {u.get('username')} (ID: {u.get('telegramId')})")
-                        all_users.append(await self._convert_user_format(u))
-                    
-                    # Увеличиваем смещение на реальное количество полученных пользователей
-                    users_count = len(users)
-                    current_offset += users_count
-                    
-                    # Если вернулось меньше чем мы ожидали (например 0), то выходим
-                    if users_count == 0:
-                        break
-                        
-                    # Защита от бесконечного цикла (5000 пользователей)
-                    if current_offset > 5000:
-                        logger.warning("Pagination limit reached (5000 users)")
-                        break
-                else:
-                    logger.error(f"Error fetching users offset {current_offset}: {response.status_code}")
+                    return response.json().get("response", {})
+                
+                last_error = f"HTTP {response.status_code}"
+                # 4xx (кроме 429) повтором не лечится
+                if response.status_code < 500 and response.status_code != 429:
                     break
+            except httpx.HTTPError as e:
+                last_error = str(e) or type(e).__name__
             
-            logger.info(f"Total users fetched: {len(all_users)}. Usernames: {[u.get('username') for u in all_users]}")
-            return all_users
-            
-        except Exception as e:
-            logger.error(f"Error fetching all users: {e}")
-            return []
+            if attempt < self.page_retries:
+                logger.warning(f"Retrying users page offset {offset} ({last_error})")
+                await asyncio.sleep(0.5 * (2 ** attempt))
+        
+        raise Exception(f"Error fetching users offset {offset}: {last_error}")
+    
+    async def _fetch_users_window(self, start: int, end: int) -> List[Dict[str, Any]]:
+        """
+        Скачать пользователей в диапазоне [start, end).
+        Если сервер отдал короткую страницу, дочитываем хвост окна.
+        """
+        rows: List[Dict[str, Any]] = []
+        offset = start
+        while offset < end:
+            page = await self._fetch_users_page(offset, end - offset)
+            users = page.get("users", [])
+            if not users:
+                break
+            rows.extend(users[:end - offset])
+            offset += len(users)
+        return rows
     
     async def create_or_update_user(self, telegram_id: int, username: str = "User", ip_limit: int = 2) -> Dict[str, Any]:
         """
@@ -194,28 +472,22 @@ class RemnawaveService:
                 data = response.json()
                 user = data.get("response", data)
                 logger.info(f"Created new user {remnawave_username} in Remnawave.")
-                return await self._convert_user_format(user)
+                created_user = self._convert_user_format(user)
+                self.directory.upsert(created_user)
+                return created_user
             elif response.status_code == 400 and "User username already exists" in response.text:
                 logger.warning(f"User {remnawave_username} exists (400), trying to find by Telegram ID...")
-                # Попытка найти пользователя по Telegram ID через get_all_users (или другой метод если есть)
-                # Remnawave API не имеет прямого поиска по TG ID, поэтому перебираем (кэширование бы не помешало)
-                all_users = await self.get_all_users()
-                for user in all_users:
-                    if str(user.get("telegram_id")) == str(telegram_id):
-                        return user
+                # Сначала точечно: by-username / by-telegram-id
+                user = await self._lookup_direct(username=remnawave_username, telegram_id=telegram_id)
+                if user:
+                    logger.info(f"Direct fetch for {remnawave_username} succeeded.")
+                    return user.copy()
                 
-                # Если не нашли по ID, пробуем принудительно вернуть по username
-                # Пытаемся сделать прямой запрос, вдруг API поддерживает /api/users/{username}
-                try:
-                    direct_resp = await self.client.get(f"{self.base_url}/api/users/{remnawave_username}", headers=headers)
-                    if direct_resp.status_code == 200:
-                        direct_data = direct_resp.json()
-                        # Remnawave возвращает {response: {...}}
-                        user_obj = direct_data.get("response", direct_data)
-                        logger.info(f"Direct fetch for {remnawave_username} succeeded.")
-                        return await self._convert_user_format(user_obj)
-                except:
-                    pass
+                # Эндпоинты не помогли — перечитываем панель и ищем по Telegram ID
+                await self._refresh_directory()
+                user = self.directory.get_by_telegram_id(telegram_id) or self.directory.get(remnawave_username)
+                if user:
+                    return user.copy()
 
                 # Если ничего не помогло, кидаем ошибку
                 logger.error(f"User {remnawave_username} reported as existing but not found by search.")
@@ -251,24 +523,161 @@ class RemnawaveService:
                 logger.error(f"User {username} has no UUID")
                 return False
             
-            headers = await self._get_headers()
-            response = await self.client.put(
-                f"{self.base_url}/api/users/{uuid}",
-                json={"status": status},
-                headers=headers
-            )
-            
-            if response.status_code == 200:
+            status_code = await self._put_status(uuid, status, user)
+            if status_code == 200:
                 logger.info(f"{'Enabled' if status == 'ACTIVE' else 'Disabled'} user {username}")
                 return True
             
-            logger.error(f"Failed to update status: {response.status_code}")
+            logger.error(f"Failed to update status: {status_code}")
             return False
             
         except Exception as e:
             logger.error(f"Error updating user status: {e}")
             return False
     
+    async def _put_status(self, uuid: str, status: str, user: Optional[UserRecord] = None) -> int:
+        """PUT статуса по UUID. При успехе обновляет справочник. Возвращает HTTP-код."""
+        headers = await self._get_headers()
+        response = await self.client.put(
+            f"{self.base_url}/api/users/{uuid}",
+            json={"status": status},
+            headers=headers
+        )
+        if response.status_code == 200:
+            # Обновляем запись в справочнике, чтобы следующий клик видел новый статус
+            updated = self._user_from_response(response)
+            if updated is None:
+                updated = self._with_status(user or self.directory.get_by_uuid(uuid), status)
+            if updated is not None:
+                self.directory.upsert(updated)
+            self._notify_subscription_changed(updated or user)
+        return response.status_code
+    
+    @staticmethod
+    def _with_status(user: Optional[UserRecord], status: str) -> Optional[UserRecord]:
+        if user is None:
+            return None
+        user = user.copy()
+        user["status"] = status.lower()
+        return user
+    
+    async def bulk_set_status(self, targets: Iterable[str], status: str) -> Dict[str, Any]:
+        """
+        Выставить статус (ACTIVE / DISABLED) многим пользователям разом.
+        targets: username (user_123) или UUID панели.
+        UUID не требуют запросов, username разрешаются по справочнику — не больше
+        одной полной выборки на весь вызов. Изменения уходят bulk-запросом панели
+        (REMNAWAVE_BULK_ENDPOINT), а без него — параллельными PUT под семафором.
+        
+        Returns:
+            {"status", "requested", "updated", "not_found", "failed",
+             "results": {target: {"result": "updated" | "not_found" | "error",
+                                  "uuid": str | None, "error": str | None}}}
+        """
+        status = status.upper()
+        targets = list(dict.fromkeys(t for t in targets if t))
+        results: Dict[str, Dict[str, Any]] = {}
+        resolved: Dict[str, str] = {}  # target -> uuid
+        
+        def resolve(target: str) -> Optional[str]:
+            user = self.directory.get(target) or self.directory.get_by_uuid(target)
+            if user is not None:
+                return user.get("_uuid")
+            return target if _UUID_RE.match(target) else None
+        
+        unresolved = []
+        for target in targets:
+            uuid = resolve(target)
+            if uuid:
+                resolved[target] = uuid
+            else:
+                unresolved.append(target)
+        
+        if unresolved:
+            listing_error = None
+            if not self.directory.is_fresh():
+                await self._refresh_directory()
+                if not self.directory.is_fresh():
+                    listing_error = "user listing failed"
+            for target in unresolved:
+                user = self.directory.get(target)
+                if user is not None and user.get("_uuid"):
+                    resolved[target] = user["_uuid"]
+                elif listing_error:
+                    results[target] = {"result": "error", "uuid": None, "error": listing_error}
+                else:
+                    results[target] = {"result": "not_found", "uuid": None, "error": None}
+        
+        pending = dict(resolved)
+        if pending and self.bulk_endpoint:
+            for target in await self._bulk_put_status(pending, status):
+                results[target] = {"result": "updated", "uuid": pending.pop(target), "error": None}
+        
+        semaphore = asyncio.Semaphore(self.bulk_concurrency)
+        
+        async def update(target: str, uuid: str) -> None:
+            async with semaphore:
+                try:
+                    status_code = await self._put_status(uuid, status)
+                except Exception as e:
+                    results[target] = {"result": "error", "uuid": uuid, "error": repr(e)}
+                    return
+            if status_code == 200:
+                results[target] = {"result": "updated", "uuid": uuid, "error": None}
+            elif status_code == 404:
+                results[target] = {"result": "not_found", "uuid": uuid, "error": None}
+            else:
+                results[target] = {"result": "error", "uuid": uuid, "error": f"HTTP {status_code}"}
+        
+        await asyncio.gather(*(update(target, uuid) for target, uuid in pending.items()))
+        
+        report = {
+            "status": status,
+            "requested": len(targets),
+            "updated": 0,
+            "not_found": 0,
+            "failed": 0,
+            "results": {target: results[target] for target in targets},
+        }
+        for result in results.values():
+            key = {"updated": "updated", "not_found": "not_found"}.get(result["result"], "failed")
+            report[key] += 1
+        logger.info(
+            f"Bulk status {status}: {report['updated']} updated, "
+            f"{report['not_found']} not found, {report['failed']} failed of {report['requested']}"
+        )
+        return report
+    
+    async def _bulk_put_status(self, targets: Dict[str, str], status: str) -> List[str]:
+        """
+        Bulk-эндпоинт панели ({"uuids": [...], "fields": {"status": ...}}), пачками.
+        Возвращает targets, обновлённые этим способом; остальные уйдут поштучно.
+        """
+        done = []
+        items = list(targets.items())
+        headers = await self._get_headers()
+        for start in range(0, len(items), self.bulk_chunk_size):
+            chunk = items[start:start + self.bulk_chunk_size]
+            try:
+                response = await self.client.post(
+                    f"{self.base_url}{self.bulk_endpoint}",
+                    json={"uuids": [uuid for _, uuid in chunk], "fields": {"status": status}},
+                    headers=headers
+                )
+            except httpx.HTTPError as e:
+                logger.warning(f"Bulk status update failed ({e!r}), falling back to per-user updates")
+                break
+            if response.status_code not in (200, 201):
+                logger.warning(f"Bulk status update returned {response.status_code}, falling back to per-user updates")
+                break
+            for target, uuid in chunk:
+                updated = self._with_status(self.directory.get_by_uuid(uuid), status)
+                if updated is not None:
+                    self.directory.upsert(updated)
+                    self._notify_subscription_changed(updated)
+                done.append(target)
+        return done
+    
     async def delete_user(self, username: str) -> bool:
         """Удалить пользователя из Remnawave."""
         try:
@@ -287,6 +696,8 @@ class RemnawaveService:
             
             if response.status_code in [200, 204]:
                 logger.info(f"Deleted user {username}")
+                self.directory.remove(user)
+                self._notify_subscription_changed(user)
                 return True
             
             return False
@@ -331,6 +742,14 @@ class RemnawaveService:
             )
             
             if response.status_code == 200:
+                # Панель возвращает пользователя с новыми short_uuid / subscription_url
+                updated = self._user_from_response(response)
+                if updated is not None:
+                    self.directory.upsert(updated)
+                else:
+                    self.directory.invalidate()
+                # Старый токен больше не действует — убираем закэшированные ответы /sub
+                self._notify_subscription_changed(user, updated)
                 return response.json()
             else:
                 raise Exception(f"Revoke failed: {response.status_code}")
@@ -365,130 +784,252 @@ class RemnawaveService:
     
     # ==================== УТИЛИТЫ ====================
     
-    async def _convert_user_format(self, remnawave_user: Dict[str, Any], fetch_devices: bool = False) -> Dict[str, Any]:
+    def _user_from_response(self, response: httpx.Response) -> Optional[UserRecord]:
+        """Пользователь из ответа на изменение ({response: {...}}), если панель его вернула."""
+        try:
+            data = response.json()
+        except ValueError:
+            return None
+        user = data.get("response", data) if isinstance(data, dict) else None
+        if isinstance(user, dict) and user.get("uuid"):
+            return self._convert_user_format(user)
+        return None
+    
+    def _convert_user_format(self, remnawave_user: Dict[str, Any]) -> UserRecord:
+        """Конвертировать формат Remnawave в формат Marzban для совместимости."""
+        return UserRecord.from_panel(remnawave_user)
+    
+    async def _get_device_model_from_ssh(self, user_uuid: str) -> Optional[str]:
         """
-        Конвертировать формат Remnawave в формат Marzban для совместимости.
-        fetch_devices: Если True, делает SSH запрос за списком устройств (медленно!).
+        Получает список устройств напрямую из БД Remnawave через постоянный SSH-канал.
+        Возвращает отформатированную строку с нумерованным списком,
+        "" если устройств нет и None если БД недоступна.
         """
-        traffic = remnawave_user.get("userTraffic", {})
-        
-        # Конвертация expire
-        expire_at = remnawave_user.get("expireAt")
-        expire_timestamp = 0
-        if expire_at:
-            try:
-                dt = datetime.fromisoformat(expire_at.replace("Z", "+00:00"))
-                expire_timestamp = int(dt.timestamp())
-            except:
-                pass
-        
-        user_dict = {
-            # Сохраняем оригинальный UUID для API вызовов
-            "_uuid": remnawave_user.get("uuid"),
-            
-            # Совместимость с Marzban полями
-            "username": remnawave_user.get("username"),
-            "status": remnawave_user.get("status", "ACTIVE").lower(),  # active/disabled
-            "data_limit": remnawave_user.get("trafficLimitBytes", 0),
-            "used_traffic": traffic.get("usedTrafficBytes", 0),
-            "expire": expire_timestamp,
-            "subscription_url": remnawave_user.get("subscriptionUrl", ""),
-            "sub_last_user_agent": remnawave_user.get("subLastUserAgent", ""),
-            "online_at": traffic.get("onlineAt"),
-            "note": remnawave_user.get("description", ""),
-            
-            # Дополнительные поля Remnawave
-            "telegram_id": remnawave_user.get("telegramId"),
-            "short_uuid": remnawave_user.get("shortUuid"),
-            "hwid_device_limit": remnawave_user.get("hwidDeviceLimit")
-        }
+        try:
+            models = await self.get_device_models([user_uuid])
+            return self._format_device_models(models.get(user_uuid, []))
+        except Exception as e:
+            logger.warning(f"Device lookup failed for {user_uuid}: {e}")
         
-        # Пытаемся получить красивую модель устройства через SSH (ТОЛЬКО ЕСЛИ ЗАПРОШЕНО)
-        if fetch_devices:
-            try:
-                user_uuid = remnawave_user.get("uuid")
-                logger.info(f"fetch_devices=True, user_uuid={user_uuid}")
-                if user_uuid:
-                    model = await self._get_device_model_from_ssh(user_uuid)
-                    logger.info(f"SSH returned model: {model[:100] if model else 'None'}...")
-                    if model is not None:
-                        user_dict["sub_last_user_agent"] = model
-            except Exception as e:
-                logger.error(f"Error fetching devices via SSH: {e}")
-            
-        return user_dict
+        return None
     
-    async def _get_device_model_from_ssh(self, user_uuid: str) -> Optional[str]:
+    async def get_device_models(self, user_uuids: List[str]) -> Dict[str, List[str]]:
         """
-        Получает список устройств напрямую из БД Remnawave через SSH туннель.
-        Возвращает отформатированную строку с нумерованным списком.
+        Устройства сразу для многих пользователей: один запрос на пачку UUID
+        (WHERE user_uuid = ANY(...)) вместо запроса на каждого.
+        Свежие списки берутся из кэша; устаревшие отдаются сразу и
+        обновляются в фоне (REMNAWAVE_DEVICE_CACHE_STALE).
+        Возвращает {uuid: [модели по created_at, не больше 5]}; у кого устройств нет — [].
+        Ошибка БД пробрасывается.
         """
+        result: Dict[str, List[str]] = {}
+        missing: List[str] = []
+        stale: List[str] = []
+        
+        for user_uuid in dict.fromkeys(u for u in user_uuids if u):
+            entry = self.device_cache.get(user_uuid, max_stale=self.device_cache_stale)
+            if entry is None:
+                missing.append(user_uuid)
+                continue
+            result[user_uuid] = list(entry.value)
+            if not self.device_cache.is_fresh(entry):
+                stale.append(user_uuid)
+        
+        if stale:
+            self._spawn(self._refresh_device_models(stale))
+        
+        if missing:
+            result.update(await self._load_device_models(missing))
+        
+        return result
+    
+    async def _refresh_device_models(self, user_uuids: List[str]) -> None:
+        """Фоновое обновление устаревших записей кэша устройств."""
         try:
-            import asyncio
-            
-            # Получаем топ-5 последних активных устройств
-            cmd = (
-                f"ssh -i /root/.ssh/id_rsa_remnawave -o BatchMode=yes -o StrictHostKeyChecking=no -o ConnectTimeout=3 "
-                f"root@85.192.29.22 "
-                f"\"docker exec root-postgres-1 psql -U remnawave -d remnawave -t -c "
-                f"\\\"SELECT device_model FROM hwid_user_devices WHERE user_uuid = '{user_uuid}' ORDER BY created_at ASC LIMIT 5;\\\"\""
+            await self._flights.run(
+                ("devices", tuple(user_uuids)),
+                lambda: self._load_device_models(user_uuids)
             )
-            
-            proc = await asyncio.create_subprocess_shell(
-                cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+        except Exception as e:
+            logger.warning(f"Background device refresh failed: {e}")
+    
+    async def _load_device_models(self, user_uuids: List[str]) -> Dict[str, List[str]]:
+        """Прочитать устройства из БД панели и положить в кэш."""
+        # UUID из БД приходят в нижнем регистре — сопоставляем по нему
+        requested = {}
+        for user_uuid in user_uuids:
+            requested.setdefault(user_uuid.lower(), user_uuid)
+        result: Dict[str, List[str]] = {user_uuid: [] for user_uuid in requested.values()}
+        generations = {user_uuid: self._device_generations.get(user_uuid, 0) for user_uuid in result}
+        
+        keys = list(requested)
+        for i in range(0, len(keys), self.device_chunk_size):
+            chunk = keys[i:i + self.device_chunk_size]
+            # Топ-5 первых устройств каждого пользователя
+            rows = await self.device_channel.query(
+                "SELECT user_uuid, device_model FROM ("
+                "SELECT user_uuid, device_model, created_at, "
+                "row_number() OVER (PARTITION BY user_uuid ORDER BY created_at ASC) AS rn "
+                "FROM hwid_user_devices WHERE user_uuid = ANY(:'user_uuids'::uuid[])"
+                ") d WHERE rn <= 5 ORDER BY user_uuid, created_at ASC;",
+                {"user_uuids": "{" + ",".join(chunk) + "}"}
             )
+            for row in rows:
+                if len(row) < 2:
+                    continue
+                user_uuid = requested.get(row[0].lower())
+                model = "|".join(row[1:])
+                if user_uuid is not None and model:
+                    result[user_uuid].append(model)
+        
+        for user_uuid, models in result.items():
+            # Сброс во время чтения: список уже устарел, в кэш его не кладём
+            if self._device_generations.get(user_uuid, 0) == generations[user_uuid]:
+                self.device_cache.set(user_uuid, tuple(models))
+        return result
+    
+    def invalidate_devices(self, user_uuid: str) -> None:
+        """Сбросить кэш устройств пользователя (после сброса привязки)."""
+        self._device_generations[user_uuid] = self._device_generations.get(user_uuid, 0) + 1
+        self.device_cache.pop(user_uuid)
+        # Идущее фоновое обновление с этим UUID не должно подхватывать новых ожидающих
+        self._flights.forget_where(
+            lambda key: key[0] == "devices" and user_uuid in key[1]
+        )
+    
+    async def invalidate_user_devices(self, telegram_id: int) -> None:
+        """Сбросить кэш устройств по Telegram ID (для бота)."""
+        user = self.directory.get(f"user_{telegram_id}") or await self.get_user(f"user_{telegram_id}")
+        if user and user.get("_uuid"):
+            self.invalidate_devices(user["_uuid"])
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Метрики кэшей сервиса: устройства и справочник пользователей."""
+        return {
+            "devices": self.device_cache.snapshot(),
+            "directory": {
+                "size": len(self.directory),
+                "age": self.directory.age,
+                "fresh": self.directory.is_fresh(),
+            },
+        }
+    
+    # ==================== WEBHOOK-СОБЫТИЯ ====================
+    
+    # События с пользователем в data: запись в справочнике заменяем присланной
+    USER_EVENTS = {
+        "user.created", "user.modified", "user.enabled", "user.disabled",
+        "user.limited", "user.expired", "user.revoked", "user.traffic_reset",
+        "user.first_connected", "user.bandwidth_usage_threshold_reached",
+    }
+    
+    def apply_webhook_event(self, event: str, data: Dict[str, Any]) -> str:
+        """
+        Применить событие Remnawave к справочнику и кэшу устройств.
+        Возвращает, что сделано: upserted / removed / devices_invalidated / ignored.
+        """
+        if event.startswith("user_hwid_devices."):
+            # {user: {...}, hwidUserDevice: {...}}
+            raw_user = data.get("user") or {}
+            user_uuid = raw_user.get("uuid") or data.get("userUuid") \
+                or (data.get("hwidUserDevice") or {}).get("userUuid")
+            if raw_user.get("uuid"):
+                self.directory.upsert(self._convert_user_format(raw_user))
+            if not user_uuid:
+                return "ignored"
+            self.invalidate_devices(user_uuid)
+            return "devices_invalidated"
+        
+        if not data.get("uuid"):
+            return "ignored"
+        
+        user = self._convert_user_format(data)
+        # Прежняя запись знает старый short_uuid (важно для user.revoked)
+        previous = self.directory.get_by_uuid(user["_uuid"])
+        
+        if event == "user.deleted":
+            self.directory.remove(user)
+            self.invalidate_devices(user["_uuid"])
+            self._notify_subscription_changed(previous, user)
+            return "removed"
+        
+        if event in self.USER_EVENTS:
+            self.directory.upsert(user)
+            if event != "user.created":
+                self._notify_subscription_changed(previous, user)
+            return "upserted"
+        
+        return "ignored"
+    
+    # ==================== ПОДПИСКИ: СЛУШАТЕЛИ ====================
+    
+    def add_subscription_listener(self, listener: Callable[[List[str]], None]) -> None:
+        """Подписаться на изменения пользователей: listener(tokens) после revoke / статуса / удаления."""
+        self._subscription_listeners.append(listener)
+    
+    @staticmethod
+    def subscription_tokens(user: Optional[UserRecord]) -> List[str]:
+        """Токены /sub пользователя: short_uuid и последний сегмент subscription_url."""
+        if user is None:
+            return []
+        tokens = []
+        if user.get("short_uuid"):
+            tokens.append(user["short_uuid"])
+        url = (user.get("subscription_url") or "").rstrip("/")
+        if url:
+            tokens.append(url.rsplit("/", 1)[-1])
+        return list(dict.fromkeys(tokens))
+    
+    def _notify_subscription_changed(self, *users: Optional[UserRecord]) -> None:
+        tokens = list(dict.fromkeys(t for user in users for t in self.subscription_tokens(user)))
+        if not tokens:
+            return
+        for listener in self._subscription_listeners:
+            try:
+                listener(tokens)
+            except Exception as e:
+                logger.warning(f"Subscription listener failed: {e}")
+    
+    def _spawn(self, coro) -> None:
+        """Запустить фоновую задачу, не теряя на неё ссылку."""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    @staticmethod
+    def _format_device_models(raw_models: List[str]) -> str:
+        """Убрать дубликаты (сохраняя порядок) и оформить нумерованный список."""
+        unique_models = []
+        seen = set()
+        
+        for model in raw_models:
+            if model not in seen:
+                unique_models.append(model)
+                seen.add(model)
+        
+        if not unique_models:
+            return ""
+        
+        # Формируем красивый список:
+        # 1. 📱 iPhone 14 Pro Max
+        # 2. 🤖 Samsung Galaxy S21
+        formatted_lines = []
+        for i, model in enumerate(unique_models, 1):
+            # Добавляем эмодзи если его нет
+            prefix = ""
+            if not any(x in model for x in ["📱", "🤖", "💻", ""]):
+                if "iPhone" in model or "iPad" in model:
+                    prefix = "📱 "
+                elif "Android" in model or "Samsung" in model or "Pixel" in model or "Xiaomi" in model:
+                    prefix = "🤖 "
+                elif "Mac" in model:
+                    prefix = "💻 "
+                else:
+                    prefix = "📱 "
             
-            stdout, stderr = await proc.communicate()
-            
-            if stdout:
-                output = stdout.decode().strip()
-                if not output:
-                    return ""
-                    
-                # Разбиваем на строки и убираем дубликаты, сохраняя порядок
-                raw_models = [line.strip() for line in output.split('\n') if line.strip()]
-                unique_models = []
-                seen = set()
-                
-                for model in raw_models:
-                    if model not in seen:
-                        unique_models.append(model)
-                        seen.add(model)
-                
-                if not unique_models:
-                    return ""
-                
-                # Формируем красивый список:
-                # 1. 📱 iPhone 14 Pro Max
-                # 2. 🤖 Samsung Galaxy S21
-                formatted_lines = []
-                for i, model in enumerate(unique_models, 1):
-                    # Добавляем эмодзи если его нет
-                    prefix = ""
-                    if not any(x in model for x in ["📱", "🤖", "💻", ""]):
-                        if "iPhone" in model or "iPad" in model:
-                            prefix = "📱 "
-                        elif "Android" in model or "Samsung" in model or "Pixel" in model or "Xiaomi" in model:
-                            prefix = "🤖 "
-                        elif "Mac" in model:
-                            prefix = "💻 "
-                        else:
-                            prefix = "📱 "
-                    
-                    formatted_lines.append(f"{i}. {prefix}{model}")
-                    
-                return "\n".join(formatted_lines)
+            formatted_lines.append(f"{i}. {prefix}{model}")
             
-            # Если stdout пустой, но без ошибок (proc.returncode == 0), значит устройств нет
-            if proc.returncode == 0:
-                return ""
-                
-        except Exception:
-            pass
-        
-        return None
+        return "\n".join(formatted_lines)
         
     async def reset_user_devices(self, telegram_id: int) -> bool:
         """
@@ -503,24 +1044,15 @@ class RemnawaveService:
             if not user_uuid:
                 return False
             
-            import asyncio
-            
-            cmd = (
-                f"ssh -i /root/.ssh/id_rsa_remnawave -o BatchMode=yes -o StrictHostKeyChecking=no -o ConnectTimeout=3 "
-                f"root@85.192.29.22 "
-                f"\"docker exec root-postgres-1 psql -U remnawave -d remnawave -c "
-                f"\\\"DELETE FROM hwid_user_devices WHERE user_uuid = '{user_uuid}';\\\"\""
-            )
-            
-            proc = await asyncio.create_subprocess_shell(
-                cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            # Ждем завершения
-            await proc.communicate()
-            return proc.returncode == 0
+            try:
+                await self.device_channel.query(
+                    "DELETE FROM hwid_user_devices WHERE user_uuid = :'user_uuid';",
+                    {"user_uuid": user_uuid}
+                )
+            finally:
+                # Даже при ошибке список мог измениться — перечитаем при следующем показе
+                self.invalidate_devices(user_uuid)
+            return True
             
         except Exception as e:
             logger.error(f"Error resetting devices: {e}")
@@ -536,28 +1068,26 @@ class RemnawaveService:
         if ua.startswith("📱") or ua.startswith("") or ua.startswith("🤖"):
             return ua
 
-        import re
-        ua_lower = ua.lower()
+        info = parse_user_agent(ua)
         
         # Парсинг Happ User-Agent (если SSH не сработал)
-        if "happ" in ua_lower:
-            if "ios" in ua_lower or "darwin" in ua_lower:
+        if "happ" in ua.lower():
+            if info.os_name in ("iOS", "macOS"):
                 return " <b>iPhone</b> (Happ)"
-            if "android" in ua_lower:
+            if info.os_name == "Android":
                 return "🤖 <b>Android</b> (Happ)"
             return "📱 <b>Mobile</b>"
 
-        if "ios" in ua_lower or "iphone" in ua_lower or "ipad" in ua_lower:
-            device = "iPad" if "ipad" in ua_lower else "iPhone"
-            return f" <b>{device}</b>"
+        if info.os_name == "iOS":
+            return f" <b>{info.device}</b>"
         
-        elif "android" in ua_lower:
+        elif info.os_name == "Android":
             return f"🤖 <b>Android</b>"
         
-        elif "windows" in ua_lower:
+        elif info.os_name == "Windows":
             return "💻 <b>Windows PC</b>"
         
-        elif "mac" in ua_lower or "darwin" in ua_lower:
+        elif info.os_name == "macOS":
             return "🍎 <b>Mac</b>"
             
         return "📱 <b>Устройство</b>"
@@ -0,0 +1,69 @@
+"""
+Single Flight - объединение одновременных одинаковых вызовов.
+
+Пока по ключу выполняется запрос, остальные вызовы с тем же ключом не
+запускают свой, а ждут результат первого.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Группа in-flight запросов с общими результатами и счётчиками."""
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.stats = {
+            "calls": 0,      # Всего вызовов run()
+            "leaders": 0,    # Реально выполненных запросов
+            "coalesced": 0,  # Вызовов, получивших чужой результат
+        }
+
+    @property
+    def in_flight(self) -> int:
+        """Сколько запросов выполняется прямо сейчас."""
+        return len(self._inflight)
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполнить factory() или присоединиться к уже идущему вызову с тем же ключом.
+        Запрос живёт в отдельной задаче: отмена одного ожидающего не отменяет
+        его для остальных.
+        """
+        self.stats["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["leaders"] += 1
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def forget(self, key: Hashable) -> None:
+        """
+        Отвязать идущий вызов от ключа: следующий run() запустит новый запрос,
+        а уже ожидающие получат результат старого.
+        """
+        self._inflight.pop(key, None)
+
+    def forget_where(self, predicate: Callable[[Hashable], bool]) -> None:
+        """forget() для всех ключей, на которых predicate(key) истинен."""
+        for key in [key for key in self._inflight if predicate(key)]:
+            del self._inflight[key]
+
+    def is_current(self, key: Hashable, task: "asyncio.Future") -> bool:
+        """Вызов task всё ещё актуален для ключа (не отвязан через forget())."""
+        return self._inflight.get(key) is task
+
+    def _forget(self, key: Hashable, task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            # Ошибку увидят все ожидающие; здесь только помечаем её прочитанной
+            logger.debug(f"Single-flight call {key!r} failed: {task.exception()}")
@@ -0,0 +1,252 @@
+"""
+Subscription Cache - готовые ответы /sub/{token} по токену.
+
+Клиенты (Happ и др.) опрашивают подписку постоянно; каждый опрос раньше
+шёл в Marzban и заново декодировался и переписывался. Здесь хранится
+итоговое тело и пересылаемые заголовки:
+
+- свежий ответ (< SUB_CACHE_TTL) отдаётся из кэша;
+- subscription-userinfo (трафик) стареет быстрее (SUB_CACHE_USERINFO_TTL):
+  ответ всё ещё отдаётся из кэша, но в фоне запрашивается новый;
+- устаревший ответ (< TTL + SUB_CACHE_STALE) отдаётся сразу, обновление в фоне;
+- если Marzban недоступен, отдаём любой ответ не старше SUB_CACHE_STALE_IF_ERROR.
+
+Одновременные запросы одного токена (несколько устройств пользователя,
+повторы клиента) ждут один запрос к Marzban (SingleFlight) и получают
+общий переписанный ответ — и при промахе, и при фоновом обновлении.
+
+Ключ — только токен: Marzban опрашивается с одним фиксированным User-Agent
+(SUB_UPSTREAM_USER_AGENT), поэтому его ответ не зависит от клиента, а
+формат для клиента выбирается уже из кэша (subscription_formats).
+
+Записи пользователя сбрасываются при revoke_subscription / смене статуса
+(слушатель RemnawaveService).
+
+Удачные ответы дублируются на диск (lkg_store): после рестарта API, пока
+Marzban недоступен, клиенты получают последний известный ответ, а не 500.
+"""
+
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from app.api.services.lkg_store import lkg_store
+from app.api.services.single_flight import SingleFlight
+from app.api.services.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+# Меньше этого тело не сжимаем: заголовки gzip съедят выигрыш
+GZIP_MIN_SIZE = 512
+
+
+class SubscriptionResponse:
+    """
+    Готовый ответ /sub: тело, заголовки, код.
+    ETag и gzip-версия тела считаются при первом обращении и живут вместе
+    с ответом в кэше: сжатие — один раз на изменение, а не на каждый запрос.
+    """
+
+    __slots__ = ("body", "headers", "status_code", "_encoded", "_etag", "_gzipped")
+
+    def __init__(self, body: str, headers: Dict[str, str], status_code: int = 200):
+        self.body = body
+        self.headers = headers
+        self.status_code = status_code
+        self._encoded: Optional[bytes] = None
+        self._etag: Optional[str] = None
+        self._gzipped: Optional[bytes] = None
+
+    @property
+    def encoded(self) -> bytes:
+        """Тело в UTF-8."""
+        if self._encoded is None:
+            self._encoded = self.body.encode("utf-8")
+        return self._encoded
+
+    @property
+    def etag(self) -> str:
+        """Сильный ETag переписанного тела."""
+        if self._etag is None:
+            self._etag = f'"{hashlib.blake2b(self.encoded, digest_size=16).hexdigest()}"'
+        return self._etag
+
+    @property
+    def gzipped(self) -> Optional[bytes]:
+        """Тело в gzip (None — слишком маленькое, отдаём как есть)."""
+        if self._gzipped is None and len(self.encoded) >= GZIP_MIN_SIZE:
+            # mtime=0: одинаковое тело — одинаковые байты
+            self._gzipped = gzip.compress(self.encoded, compresslevel=6, mtime=0)
+        return self._gzipped
+
+    def with_headers(self, headers: Dict[str, str]) -> "SubscriptionResponse":
+        """То же тело с другими заголовками; ETag и gzip считаются один раз, на исходном ответе."""
+        copy = SubscriptionResponse(self.body, headers, self.status_code)
+        copy._encoded, copy._etag, copy._gzipped = self.encoded, self.etag, self.gzipped
+        return copy
+
+
+class UpstreamUnavailable(Exception):
+    """Marzban не ответил или ответил 5xx (response — его ответ, если был)."""
+
+    def __init__(self, message: str, response: Optional[SubscriptionResponse] = None):
+        super().__init__(message)
+        self.response = response
+
+
+Fetcher = Callable[[], Awaitable[SubscriptionResponse]]
+
+
+class SubscriptionCache:
+    """Ограниченный кэш ответов по токену со stale-while-revalidate и stale-if-error."""
+
+    def __init__(self):
+        self.enabled = os.getenv("SUB_CACHE_ENABLED", "true").lower() != "false"
+        self.ttl = float(os.getenv("SUB_CACHE_TTL", "300"))
+        self.userinfo_ttl = float(os.getenv("SUB_CACHE_USERINFO_TTL", "60"))
+        self.stale_ttl = float(os.getenv("SUB_CACHE_STALE", "3600"))
+        self.stale_if_error = float(os.getenv("SUB_CACHE_STALE_IF_ERROR", "86400"))
+        self._cache = TTLCache(maxsize=int(os.getenv("SUB_CACHE_SIZE", "10000")), ttl=self.ttl)
+
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        # Один запрос к Marzban на токен, остальные ждут его
+        self._flights = SingleFlight()
+        self.stats = {
+            "refreshes": 0,         # Фоновых обновлений
+            "refresh_errors": 0,
+            "served_on_error": 0,   # Ответов из кэша при недоступном Marzban
+            "served_from_disk": 0,  # ... из lkg_store (в памяти ответа не было)
+            "invalidations": 0,
+        }
+
+    # ==================== ЧТЕНИЕ ====================
+
+    async def get_or_fetch(self, token: str, fetch: Fetcher) -> Tuple[SubscriptionResponse, str]:
+        """
+        Ответ для токена и откуда он: HIT / STALE / MISS / ERROR-STALE / BYPASS.
+        fetch() возвращает ответ Marzban после переписывания или бросает
+        UpstreamUnavailable (тогда пробуем отдать старый ответ).
+        """
+        if not self.enabled:
+            return await self._flights.run(token, fetch), "BYPASS"
+
+        entry = self._cache.get(token, max_stale=self.stale_ttl)
+        if entry is not None:
+            if entry.age >= min(self.userinfo_ttl, self.ttl):
+                # Трафик в subscription-userinfo (или весь ответ) устарел — обновим в фоне
+                self._schedule_refresh(token, fetch)
+            return entry.value, "HIT" if self._cache.is_fresh(entry) else "STALE"
+
+        try:
+            response = await self._flights.run(token, lambda: self._fetch_and_store(token, fetch))
+        except UpstreamUnavailable:
+            fallback, state = await self.fallback(token)
+            if fallback is None:
+                raise
+            return fallback, state
+        return response, "MISS"
+
+    def peek(self, token: str) -> Optional[SubscriptionResponse]:
+        """Последний ответ для токена любого возраста (без учёта в счётчиках)."""
+        entry = self._cache.peek(token)
+        return entry.value if entry is not None else None
+
+    async def fallback(self, token: str) -> Tuple[Optional[SubscriptionResponse], str]:
+        """
+        Ответ, который можно отдать без Marzban, и откуда он:
+        память (не старше SUB_CACHE_STALE_IF_ERROR) -> ERROR-STALE,
+        диск (после рестарта) -> ERROR-LKG; (None, "") — отдать нечего.
+        """
+        entry = self._cache.peek(token)
+        if entry is not None and entry.age < self.stale_if_error:
+            self.stats["served_on_error"] += 1
+            return entry.value, "ERROR-STALE"
+
+        stored = await lkg_store.load(token)
+        if stored is None:
+            return None, ""
+        self.stats["served_from_disk"] += 1
+        return SubscriptionResponse(*stored), "ERROR-LKG"
+
+    # ==================== ИНВАЛИДАЦИЯ ====================
+
+    def invalidate(self, tokens: Iterable[str]) -> None:
+        """Сбросить ответы токенов (revoke, смена статуса, удаление)."""
+        for token in tokens:
+            if self._cache.pop(token) is not None:
+                self.stats["invalidations"] += 1
+            task = self._refreshing.pop(token, None)
+            if task is not None:
+                # Ответ идущего обновления уже может быть со старым статусом
+                task.cancel()
+            # Идущий запрос не попадёт в кэш, следующий запрос пойдёт в Marzban заново
+            self._flights.forget(token)
+            lkg_store.delete_later(token)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    # ==================== МЕТРИКИ ====================
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            **self._cache.snapshot(),
+            **self.stats,
+            "refreshing": len(self._refreshing),
+            "upstream_in_flight": self._flights.in_flight,
+            "flights": dict(self._flights.stats),   # coalesced — запросов, дождавшихся чужого
+            "userinfo_ttl": self.userinfo_ttl,
+            "stale_ttl": self.stale_ttl,
+            "stale_if_error": self.stale_if_error,
+        }
+
+    # ==================== ВНУТРЕННЕЕ ====================
+
+    async def _fetch_and_store(self, token: str, fetch: Fetcher) -> SubscriptionResponse:
+        """Запрос лидера SingleFlight: результат сохраняется один раз, а не каждым ожидающим."""
+        response = await fetch()
+        if self._flights.is_current(token, asyncio.current_task()):
+            self._store(token, response)
+        return response
+
+    def _store(self, token: str, response: SubscriptionResponse) -> SubscriptionResponse:
+        if response.status_code == 200:
+            self._cache.set(token, response)
+            lkg_store.save_later(token, response.body, response.headers)
+        elif 400 <= response.status_code < 500:
+            # Токен отозван или не существует — старый ответ больше не отдаём
+            self._cache.pop(token)
+            lkg_store.delete_later(token)
+        return response
+
+    def _schedule_refresh(self, token: str, fetch: Fetcher) -> None:
+        if token in self._refreshing:
+            return
+        # Чистый контекст: обновление не принадлежит запросу, который его запустил
+        # (иначе contextvars этого запроса, например его трасса, достались бы фоновой задаче)
+        task = contextvars.Context().run(asyncio.create_task, self._refresh(token, fetch))
+        self._refreshing[token] = task
+        task.add_done_callback(lambda done, token=token: self._refresh_done(token, done))
+
+    async def _refresh(self, token: str, fetch: Fetcher) -> None:
+        self.stats["refreshes"] += 1
+        try:
+            await self._flights.run(token, lambda: self._fetch_and_store(token, fetch))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats["refresh_errors"] += 1
+            logger.warning(f"Background subscription refresh failed for {token[:10]}...: {e}")
+
+    def _refresh_done(self, token: str, task: asyncio.Task) -> None:
+        if self._refreshing.get(token) is task:
+            del self._refreshing[token]
+
+
+# Singleton
+subscription_cache = SubscriptionCache()
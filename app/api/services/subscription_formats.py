@@ -0,0 +1,504 @@
+"""
+Subscription Formats - подписка в форматах sing-box (JSON) и Clash (YAML).
+
+/sub/{token} отдаёт список ссылок (vless:// trojan:// ss:// ...). Клиентам,
+которым нужен sing-box или Clash, формат выбирается по ?format=, Accept
+или User-Agent (negotiate). Ссылки итогового ответа (после link_rewrite)
+один раз разбираются в список ProxyNode, из него рендерится каждый формат.
+
+Узлы и отрендеренные форматы кэшируются по (токен, формат) вместе с ETag
+исходного ответа: пока тело подписки не изменилось, формат не
+пересобирается, и лишний формат не стоит запроса к Marzban — он строится
+из уже закэшированного ответа.
+"""
+
+import base64
+import json
+import logging
+import os
+import re
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, unquote
+
+from app.api.services.subscription_cache import SubscriptionResponse
+from app.api.services.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+URI = "uri"
+SINGBOX = "singbox"
+CLASH = "clash"
+
+CONTENT_TYPES = {
+    URI: "text/plain; charset=utf-8",
+    SINGBOX: "application/json; charset=utf-8",
+    CLASH: "text/yaml; charset=utf-8",
+}
+
+# ?format= -> формат
+_FORMAT_ALIASES = {
+    "uri": URI, "plain": URI, "links": URI,
+    "singbox": SINGBOX, "sing-box": SINGBOX, "json": SINGBOX,
+    "clash": CLASH, "mihomo": CLASH, "yaml": CLASH,
+}
+
+# Accept -> формат
+_MEDIA_TYPES = {
+    "text/plain": URI,
+    "application/json": SINGBOX,
+    "application/yaml": CLASH,
+    "application/x-yaml": CLASH,
+    "text/yaml": CLASH,
+    "text/x-yaml": CLASH,
+}
+# Диапазоны, которые принимают и список ссылок, но формат не выбирают
+_WILDCARDS = ("*/*", "text/*")
+
+# Имя клиента — первый продукт User-Agent (в нижнем регистре), по началу имени -> формат.
+# Только первый продукт: Hiddify пишет "HiddifyNext/... like ClashMeta v2ray sing-box",
+# а понимает список ссылок
+_USER_AGENTS = (
+    (("sing-box", "sfa", "sfi", "sfm", "sft"), SINGBOX),
+    (("clash", "mihomo", "stash", "flclash"), CLASH),
+)
+_PRODUCT_RE = re.compile(r"\s*([a-z0-9][a-z0-9._-]*)")
+
+# Проверка доступности для url-test групп
+_TEST_URL = "https://www.gstatic.com/generate_204"
+
+
+def negotiate(format_param: Optional[str], accept: str, user_agent: str) -> Optional[str]:
+    """Формат ответа: ?format= важнее Accept, Accept важнее User-Agent. None — неизвестный ?format=."""
+    if format_param:
+        return _FORMAT_ALIASES.get(format_param.strip().lower())
+    fmt = _accept_format(accept)
+    if fmt is not None:
+        return fmt
+    product = _PRODUCT_RE.match(user_agent.lower())
+    if product:
+        for names, fmt in _USER_AGENTS:
+            if product.group(1).startswith(names):
+                return fmt
+    return URI
+
+
+def _accept_format(accept: str) -> Optional[str]:
+    """
+    Формат по Accept (RFC 9110): больший q, при равных — раньше в списке;
+    при равенстве со списком ссылок (text/plain) — список ссылок.
+    None — Accept формат не выбирает: пусто, только */* или ничья с */*.
+    """
+    best: Dict[str, Tuple[float, int]] = {}
+    wildcard_q = 0.0
+    for index, media_range in enumerate(accept.lower().split(",")):
+        media_type, _, params = media_range.partition(";")
+        media_type = media_type.strip()
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        if media_type in _WILDCARDS:
+            wildcard_q = max(wildcard_q, q)
+        elif media_type in _MEDIA_TYPES:
+            fmt = _MEDIA_TYPES[media_type]
+            if fmt not in best or q > best[fmt][0]:
+                best[fmt] = (q, index)
+    if not best:
+        return None
+    fmt, (q, _) = min(best.items(), key=lambda item: (-item[1][0], item[0] != URI, item[1][1]))
+    if q <= 0 or (fmt != URI and q <= wildcard_q):
+        return None
+    return fmt
+
+
+# ==================== ПРОМЕЖУТОЧНАЯ ФОРМА ====================
+
+class ProxyNode(NamedTuple):
+    """Один сервер подписки без привязки к формату."""
+
+    protocol: str                        # vless / vmess / trojan / shadowsocks / hysteria2
+    name: str
+    server: str
+    port: int
+    secret: str                          # uuid (vless / vmess) или пароль
+    method: Optional[str] = None         # Шифр Shadowsocks
+    network: str = "tcp"                 # tcp / ws / grpc
+    security: str = "none"               # none / tls / reality
+    sni: Optional[str] = None
+    fingerprint: Optional[str] = None
+    flow: Optional[str] = None
+    path: Optional[str] = None
+    host: Optional[str] = None
+    public_key: Optional[str] = None     # Reality
+    short_id: Optional[str] = None
+    service_name: Optional[str] = None   # gRPC
+    alpn: Tuple[str, ...] = ()
+    insecure: bool = False
+    obfs: Optional[str] = None           # Hysteria2
+    obfs_password: Optional[str] = None
+
+
+def _b64decode(value: str) -> str:
+    value = value.strip().replace("-", "+").replace("_", "/")
+    return base64.b64decode(value + "=" * (-len(value) % 4)).decode("utf-8")
+
+
+def _split_host_port(authority: str) -> Tuple[str, int]:
+    host, _, port = authority.rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+def _query(raw: str) -> Dict[str, str]:
+    return {key: values[-1] for key, values in parse_qs(raw, keep_blank_values=True).items()}
+
+
+def _transport(params: Dict[str, str]) -> Dict[str, Any]:
+    """Общие для vless / trojan поля транспорта и TLS из query."""
+    security = params.get("security") or "none"
+    return {
+        "network": params.get("type") or "tcp",
+        "security": security,
+        "sni": params.get("sni") or params.get("peer") or None,
+        "fingerprint": params.get("fp") or None,
+        "flow": params.get("flow") or None,
+        "path": params.get("path") or None,
+        "host": params.get("host") or None,
+        "public_key": params.get("pbk") or None,
+        "short_id": params.get("sid") or None,
+        "service_name": params.get("serviceName") or None,
+        "alpn": tuple(filter(None, (params.get("alpn") or "").split(","))),
+        "insecure": params.get("allowInsecure") in ("1", "true") or params.get("insecure") in ("1", "true"),
+    }
+
+
+def parse_link(link: str) -> Optional[ProxyNode]:
+    """Ссылка -> ProxyNode; None — схема не поддерживается."""
+    scheme, sep, rest = link.partition("://")
+    if not sep:
+        return None
+    scheme = scheme.lower()
+    if scheme == "vmess":
+        return _parse_vmess(rest)
+
+    rest, _, name = rest.partition("#")
+    rest, _, query = rest.partition("?")
+    userinfo, at_sign, authority = rest.rpartition("@")
+    params = _query(query)
+    name = unquote(name)
+
+    if scheme == "ss":
+        if not at_sign:
+            # Старый формат: base64(method:password@host:port)
+            userinfo, _, authority = _b64decode(authority.rstrip("/")).rpartition("@")
+        else:
+            userinfo = unquote(userinfo)
+            if ":" not in userinfo:
+                userinfo = _b64decode(userinfo)
+        method, _, password = userinfo.partition(":")
+        server, port = _split_host_port(authority.rstrip("/"))
+        return ProxyNode("shadowsocks", name, server, port, password, method=method)
+
+    if not at_sign:
+        return None
+    server, port = _split_host_port(authority.rstrip("/"))
+    secret = unquote(userinfo)
+    if scheme in ("vless", "trojan"):
+        transport = _transport(params)
+        if scheme == "trojan" and transport["security"] == "none":
+            # Trojan без TLS не бывает
+            transport["security"] = "tls"
+        return ProxyNode(scheme, name, server, port, secret, **transport)
+    if scheme in ("hysteria2", "hy2"):
+        return ProxyNode(
+            "hysteria2", name, server, port, secret,
+            security="tls",
+            sni=params.get("sni") or None,
+            alpn=tuple(filter(None, (params.get("alpn") or "").split(","))),
+            insecure=params.get("insecure") in ("1", "true"),
+            obfs=params.get("obfs") or None,
+            obfs_password=params.get("obfs-password") or None,
+        )
+    return None
+
+
+def _parse_vmess(rest: str) -> Optional[ProxyNode]:
+    config = json.loads(_b64decode(rest.partition("#")[0]))
+    return ProxyNode(
+        "vmess", str(config.get("ps") or ""), str(config["add"]), int(config["port"]), str(config["id"]),
+        network=config.get("net") or "tcp",
+        security="tls" if config.get("tls") == "tls" else "none",
+        sni=config.get("sni") or None,
+        fingerprint=config.get("fp") or None,
+        path=config.get("path") or None,
+        host=config.get("host") or None,
+        service_name=config.get("path") if config.get("net") == "grpc" else None,
+        alpn=tuple(filter(None, (config.get("alpn") or "").split(","))),
+    )
+
+
+def parse_links(body: str) -> List[ProxyNode]:
+    """Тело подписки (ссылка на строку) -> узлы с уникальными именами."""
+    nodes: List[ProxyNode] = []
+    used: Dict[str, int] = {}
+    for line in body.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            node = parse_link(line)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.debug(f"Skipping unparsable subscription link: {e}")
+            continue
+        if node is None:
+            continue
+        # sing-box tag и имя в Clash должны быть уникальными
+        base_name = node.name or f"{node.protocol} {node.server}"
+        used[base_name] = used.get(base_name, 0) + 1
+        name = base_name if used[base_name] == 1 else f"{base_name} {used[base_name]}"
+        nodes.append(node._replace(name=name))
+    return nodes
+
+
+# ==================== SING-BOX ====================
+
+def _singbox_outbound(node: ProxyNode) -> Dict[str, Any]:
+    outbound: Dict[str, Any] = {
+        "type": node.protocol,
+        "tag": node.name,
+        "server": node.server,
+        "server_port": node.port,
+    }
+    if node.protocol in ("vless", "vmess"):
+        outbound["uuid"] = node.secret
+    else:
+        outbound["password"] = node.secret
+    if node.protocol == "vmess":
+        outbound.update(security="auto", alter_id=0)
+    if node.protocol == "shadowsocks":
+        outbound["method"] = node.method
+        return outbound
+    if node.flow:
+        outbound["flow"] = node.flow
+
+    if node.security in ("tls", "reality"):
+        tls: Dict[str, Any] = {"enabled": True}
+        if node.sni:
+            tls["server_name"] = node.sni
+        if node.insecure:
+            tls["insecure"] = True
+        if node.alpn:
+            tls["alpn"] = list(node.alpn)
+        if node.fingerprint:
+            tls["utls"] = {"enabled": True, "fingerprint": node.fingerprint}
+        if node.security == "reality":
+            tls["reality"] = {"enabled": True, "public_key": node.public_key or "", "short_id": node.short_id or ""}
+        outbound["tls"] = tls
+
+    if node.protocol == "hysteria2":
+        if node.obfs:
+            outbound["obfs"] = {"type": node.obfs, "password": node.obfs_password or ""}
+    elif node.network == "ws":
+        transport: Dict[str, Any] = {"type": "ws", "path": node.path or "/"}
+        if node.host:
+            transport["headers"] = {"Host": node.host}
+        outbound["transport"] = transport
+    elif node.network == "grpc":
+        outbound["transport"] = {"type": "grpc", "service_name": node.service_name or ""}
+    return outbound
+
+
+def render_singbox(nodes: List[ProxyNode]) -> str:
+    """Outbounds sing-box: выбор вручную (proxy) + автовыбор (auto) + узлы."""
+    tags = [node.name for node in nodes]
+    if tags:
+        groups = [
+            {"type": "selector", "tag": "proxy", "outbounds": ["auto", *tags], "default": "auto"},
+            {"type": "urltest", "tag": "auto", "outbounds": tags, "url": _TEST_URL, "interval": "5m"},
+        ]
+    else:
+        # Пустая группа sing-box не принимает: без узлов трафик идёт напрямую
+        groups = [{"type": "selector", "tag": "proxy", "outbounds": ["direct"]}]
+    config = {
+        "outbounds": [
+            *groups,
+            *(_singbox_outbound(node) for node in nodes),
+            {"type": "direct", "tag": "direct"},
+        ],
+        "route": {"final": "proxy", "auto_detect_interface": True},
+    }
+    return json.dumps(config, ensure_ascii=False, indent=2)
+
+
+# ==================== CLASH ====================
+
+def _clash_proxy(node: ProxyNode) -> Dict[str, Any]:
+    proxy: Dict[str, Any] = {
+        "name": node.name,
+        "type": "ss" if node.protocol == "shadowsocks" else node.protocol,
+        "server": node.server,
+        "port": node.port,
+        "udp": True,
+    }
+    if node.protocol == "shadowsocks":
+        proxy.update(cipher=node.method, password=node.secret)
+        return proxy
+    if node.protocol in ("vless", "vmess"):
+        proxy["uuid"] = node.secret
+    else:
+        proxy["password"] = node.secret
+    if node.protocol == "vmess":
+        proxy.update(alterId=0, cipher="auto")
+
+    if node.protocol == "hysteria2":
+        if node.sni:
+            proxy["sni"] = node.sni
+        if node.obfs:
+            proxy.update(obfs=node.obfs, **{"obfs-password": node.obfs_password or ""})
+        if node.insecure:
+            proxy["skip-cert-verify"] = True
+        return proxy
+
+    proxy["network"] = node.network
+    if node.security in ("tls", "reality"):
+        if node.protocol != "trojan":
+            proxy["tls"] = True
+        if node.sni:
+            proxy["sni" if node.protocol == "trojan" else "servername"] = node.sni
+        if node.fingerprint:
+            proxy["client-fingerprint"] = node.fingerprint
+        if node.alpn:
+            proxy["alpn"] = list(node.alpn)
+        if node.insecure:
+            proxy["skip-cert-verify"] = True
+    if node.security == "reality":
+        proxy["reality-opts"] = {"public-key": node.public_key or "", "short-id": node.short_id or ""}
+    if node.flow:
+        proxy["flow"] = node.flow
+    if node.network == "ws":
+        ws_opts: Dict[str, Any] = {"path": node.path or "/"}
+        if node.host:
+            ws_opts["headers"] = {"Host": node.host}
+        proxy["ws-opts"] = ws_opts
+    elif node.network == "grpc":
+        proxy["grpc-opts"] = {"grpc-service-name": node.service_name or ""}
+    return proxy
+
+
+def _yaml_scalar(value: Any) -> str:
+    if isinstance(value, (dict, list)):
+        return "{}" if isinstance(value, dict) else "[]"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return str(value)
+    # Строка в двойных кавычках JSON — валидный YAML (эмодзи, ':' и '#' в именах)
+    return json.dumps(str(value), ensure_ascii=False)
+
+
+def _yaml_lines(value: Any, indent: str = "") -> List[str]:
+    """Блочный YAML для dict / list / скаляров (без PyYAML)."""
+    lines: List[str] = []
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (dict, list)) and item:
+                lines.append(f"{indent}{key}:")
+                lines += _yaml_lines(item, indent + "  ")
+            else:
+                lines.append(f"{indent}{key}: {_yaml_scalar(item)}")
+    else:
+        for item in value:
+            if isinstance(item, (dict, list)) and item:
+                nested = _yaml_lines(item, indent + "  ")
+                lines.append(f"{indent}- {nested[0].lstrip()}")
+                lines += nested[1:]
+            else:
+                lines.append(f"{indent}- {_yaml_scalar(item)}")
+    return lines
+
+
+def render_clash(nodes: List[ProxyNode]) -> str:
+    """Конфиг Clash / mihomo: прокси, группы PROXY (вручную) и auto (url-test)."""
+    names = [node.name for node in nodes]
+    if names:
+        groups = [
+            {"name": "PROXY", "type": "select", "proxies": ["auto", *names]},
+            {"name": "auto", "type": "url-test", "proxies": names, "url": _TEST_URL, "interval": 300},
+        ]
+    else:
+        # Группа без прокси — ошибка конфига Clash: без узлов трафик идёт напрямую
+        groups = [{"name": "PROXY", "type": "select", "proxies": ["DIRECT"]}]
+    config = {
+        "mixed-port": 7890,
+        "allow-lan": False,
+        "mode": "rule",
+        "proxies": [_clash_proxy(node) for node in nodes],
+        "proxy-groups": groups,
+        "rules": ["MATCH,PROXY"],
+    }
+    return "\n".join(_yaml_lines(config)) + "\n"
+
+
+RENDERERS: Dict[str, Callable[[List[ProxyNode]], str]] = {
+    SINGBOX: render_singbox,
+    CLASH: render_clash,
+}
+
+
+# ==================== КЭШ ФОРМАТОВ ====================
+
+class SubscriptionFormats:
+    """Узлы и отрендеренные форматы по (токен, формат), пока ETag исходного ответа тот же."""
+
+    def __init__(self):
+        # Запись проверяется по ETag при каждом чтении; TTL только ограничивает память
+        self._cache = TTLCache(maxsize=int(os.getenv("SUB_FORMAT_CACHE_SIZE", "10000")), ttl=86400)
+        self.stats = {
+            "rendered": 0,      # Формат собран заново
+            "reused": 0,        # Тело подписки не менялось — отдан готовый
+            "parsed": 0,        # Разборов ссылок в узлы
+            "invalidations": 0,
+        }
+
+    def render(self, token: str, response: SubscriptionResponse, fmt: str) -> SubscriptionResponse:
+        """Ответ в формате fmt (uri и не-200 ответы — как есть)."""
+        if fmt == URI or response.status_code != 200:
+            return response
+        headers = {**response.headers, "Content-Type": CONTENT_TYPES[fmt]}
+
+        entry = self._cache.get((token, fmt))
+        if entry is not None and entry.value[0] == response.etag:
+            self.stats["reused"] += 1
+            return entry.value[1].with_headers(headers)
+
+        rendered = SubscriptionResponse(RENDERERS[fmt](self._nodes(token, response)), {})
+        self._cache.set((token, fmt), (response.etag, rendered))
+        self.stats["rendered"] += 1
+        return rendered.with_headers(headers)
+
+    def _nodes(self, token: str, response: SubscriptionResponse) -> List[ProxyNode]:
+        # Один разбор на изменение тела — общий для всех форматов
+        entry = self._cache.peek((token, None))
+        if entry is not None and entry.value[0] == response.etag:
+            return entry.value[1]
+        nodes = parse_links(response.body)
+        self._cache.set((token, None), (response.etag, nodes))
+        self.stats["parsed"] += 1
+        return nodes
+
+    def invalidate(self, tokens: List[str]) -> None:
+        """Сбросить форматы токенов (revoke / статус / удаление)."""
+        for token in tokens:
+            for fmt in (None, *RENDERERS):
+                if self._cache.pop((token, fmt)) is not None:
+                    self.stats["invalidations"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**self._cache.snapshot(), **self.stats}
+
+
+# Singleton
+subscription_formats = SubscriptionFormats()
@@ -0,0 +1,152 @@
+"""
+Trace Recorder - обезличенная запись запросов /sub для офлайн-воспроизведения.
+
+Включается SUB_TRACE_ENABLED=true. Каждый запрос — одна строка JSON с
+короткими ключами:
+
+    {"t": 1760000000.123, "tk": "9f2c...", "ua": "Happ/3.7.0/ios ...",
+     "f": null, "st": 200, "cs": "MISS", "ms": 41.7, "b": 3010,
+     "us": 200, "ub": 2466, "um": 38.2}
+
+t — время прихода, tk — blake2b токена с солью (SUB_TRACE_SALT; без неё
+соль случайная на процесс), f — ?format=, st / cs / ms / b — код, X-Cache,
+время ответа и размер тела; us / ub / um — код, размер и время ответа
+Marzban, если этот запрос в него ходил (лидер SingleFlight).
+
+Фоновое обновление кэша (stale-while-revalidate) пишет свою строку с
+cs "REFRESH" и пустым ua: запроса клиента за ним нет, но запрос к Marzban
+есть, и без этой строки он пропал бы из трассы.
+
+Запись не блокирует запрос: строки уходят в очередь, файл пишет поток
+QueueListener (RotatingFileHandler из logging); файл ротируется по
+SUB_TRACE_MAX_BYTES, хранится SUB_TRACE_BACKUPS старых.
+Воспроизведение: scripts/replay_subscription_trace.py
+"""
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import secrets
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Запрос к Marzban текущего запроса /sub (задачи SingleFlight видят тот же словарь)
+_upstream: ContextVar[Optional[Dict[str, Any]]] = ContextVar("sub_trace_upstream", default=None)
+
+
+def note_upstream(status: int, size: int, elapsed_ms: float) -> None:
+    """Отметить в трассе запрос к Marzban (no-op без активной записи)."""
+    upstream = _upstream.get()
+    if upstream is not None:
+        upstream.update(us=status, ub=size, um=round(elapsed_ms, 1))
+
+
+class TraceRecorder:
+    """Строки JSON через очередь в ротируемый файл."""
+
+    def __init__(self):
+        self.enabled = os.getenv("SUB_TRACE_ENABLED", "false").lower() == "true"
+        self.path = Path(os.getenv("SUB_TRACE_PATH", "./traces/sub_trace.jsonl"))
+        self.max_bytes = int(os.getenv("SUB_TRACE_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.backups = int(os.getenv("SUB_TRACE_BACKUPS", "5"))
+        self._salt = (os.getenv("SUB_TRACE_SALT") or secrets.token_hex(16)).encode()
+
+        self._queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self._listener: Optional[QueueListener] = None
+        self.stats = {"recorded": 0, "errors": 0}
+
+    # ==================== ЗАПУСК ====================
+
+    def start(self) -> None:
+        if not self.enabled or self._listener is not None:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            handler = RotatingFileHandler(
+                self.path, maxBytes=self.max_bytes, backupCount=self.backups, encoding="utf-8"
+            )
+        except OSError as e:
+            logger.error(f"Subscription trace disabled, cannot open {self.path}: {e}")
+            self.enabled = False
+            return
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._listener = QueueListener(self._queue, handler)
+        self._listener.start()
+        logger.info(f"Subscription trace recording to {self.path} (rotate at {self.max_bytes} bytes)")
+
+    def stop(self) -> None:
+        """Дописать очередь и закрыть файл."""
+        listener, self._listener = self._listener, None
+        if listener is None:
+            return
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+    # ==================== ЗАПИСЬ ====================
+
+    def begin(self) -> Optional[Dict[str, Any]]:
+        """Начать трассу запроса (None — запись выключена)."""
+        if self._listener is None:
+            return None
+        trace = {"t": round(time.time(), 3), "started": time.perf_counter()}
+        _upstream.set(trace)
+        return trace
+
+    def begin_background(self) -> Optional[Dict[str, Any]]:
+        """Трасса для запроса к Marzban вне запроса клиента (None — запись выключена
+        или запрос уже пишется в трассу клиента, например лидер SingleFlight)."""
+        if _upstream.get() is not None:
+            return None
+        return self.begin()
+
+    def finish(self, trace: Optional[Dict[str, Any]], token: str, user_agent: str,
+               fmt: Optional[str], status: int, cache_state: Optional[str], size: int) -> None:
+        if trace is None:
+            return
+        try:
+            line = {
+                "t": trace["t"],
+                "tk": self.hash_token(token),
+                "ua": user_agent[:256],
+                "f": fmt,
+                "st": status,
+                "cs": cache_state,
+                "ms": round((time.perf_counter() - trace["started"]) * 1000, 1),
+                "b": size,
+                "us": trace.get("us"),
+                "ub": trace.get("ub"),
+                "um": trace.get("um"),
+            }
+            # Мимо логгеров: уровни и logging.disable приложения трассу не режут
+            self._queue.put_nowait(logging.makeLogRecord(
+                {"msg": json.dumps(line, ensure_ascii=False, separators=(",", ":"))}
+            ))
+            self.stats["recorded"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.debug(f"Subscription trace line dropped: {e}")
+
+    def hash_token(self, token: str) -> str:
+        return hashlib.blake2b(token.encode(), key=self._salt[:64], digest_size=8).hexdigest()
+
+    # ==================== МЕТРИКИ ====================
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "running": self._listener is not None,
+            "path": str(self.path),
+        }
+
+
+# Singleton
+trace_recorder = TraceRecorder()
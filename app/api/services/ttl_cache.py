@@ -0,0 +1,87 @@
+"""
+TTL Cache - ограниченный по размеру LRU-кэш с возрастом записей.
+
+Записи не удаляются по истечении TTL: вызывающий сам решает, отдавать ли
+устаревшее значение (stale-while-revalidate) или идти за свежим.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class CacheEntry:
+    """Значение и момент его сохранения."""
+
+    __slots__ = ("value", "stored_at")
+
+    def __init__(self, value: Any, stored_at: float):
+        self.value = value
+        self.stored_at = stored_at
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.stored_at
+
+
+class TTLCache:
+    """LRU на OrderedDict со счётчиками попаданий."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self.stats = {
+            "hits": 0,        # Свежее значение
+            "stale_hits": 0,  # Отдано устаревшее значение
+            "misses": 0,      # Значения нет (или слишком старое)
+            "evictions": 0,   # Вытеснено по размеру
+        }
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, max_stale: float = 0.0) -> Optional[CacheEntry]:
+        """
+        Вернуть запись, если ей не больше ttl + max_stale секунд, иначе None.
+        Свежесть записи вызывающий проверяет через is_fresh().
+        """
+        entry = self._data.get(key)
+        if entry is None or entry.age >= self.ttl + max_stale:
+            self.stats["misses"] += 1
+            return None
+        self._data.move_to_end(key)
+        if self.is_fresh(entry):
+            self.stats["hits"] += 1
+        else:
+            self.stats["stale_hits"] += 1
+        return entry
+
+    def peek(self, key: Hashable) -> Optional[CacheEntry]:
+        """Запись любого возраста, без учёта в счётчиках и LRU."""
+        return self._data.get(key)
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return entry.age < self.ttl
+
+    def set(self, key: Hashable, value: Any) -> CacheEntry:
+        entry = CacheEntry(value, time.monotonic())
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+        return entry
+
+    def pop(self, key: Hashable) -> Optional[CacheEntry]:
+        return self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Счётчики и размер для метрик."""
+        return {**self.stats, "size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl}
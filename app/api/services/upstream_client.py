@@ -0,0 +1,171 @@
+"""
+Upstream Client - общий пул соединений /sub прокси к Marzban.
+
+Один httpx.AsyncClient на процесс: keep-alive соединения переживают
+запросы, и волна обновлений подписок (каждые profile-update-interval)
+не платит за новый TCP + TLS на каждый запрос. HTTP/2 включается, если
+установлен пакет h2 и сервер его поддерживает.
+Создаётся на startup приложения, закрывается на shutdown.
+"""
+
+import importlib.util
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def percentile(values: Iterable[float], pct: float) -> Optional[float]:
+    """Перцентиль по ближайшему рангу (None для пустой выборки)."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class UpstreamClient:
+    """Пул соединений к MARZBAN_URL с метриками использования и задержки соединения."""
+
+    def __init__(self):
+        self.base_url = os.getenv("MARZBAN_URL", "https://instabotwebhook.ru:8000")
+        self.verify = os.getenv("MARZBAN_VERIFY_SSL", "true").lower() != "false"
+        self.timeout = float(os.getenv("SUB_UPSTREAM_TIMEOUT", "30"))
+        # Один User-Agent для всех запросов /sub: ответ панели зависит от UA,
+        # а кэш подписок (и lkg_store) хранит его по одному токену
+        self.user_agent = os.getenv("SUB_UPSTREAM_USER_AGENT", "subscription-proxy")
+        self.max_connections = int(os.getenv("SUB_UPSTREAM_MAX_CONNECTIONS", "100"))
+        self.max_keepalive = int(os.getenv("SUB_UPSTREAM_MAX_KEEPALIVE", "20"))
+        self.keepalive_expiry = float(os.getenv("SUB_UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+        self.http2 = (
+            os.getenv("SUB_UPSTREAM_HTTP2", "true").lower() != "false"
+            and importlib.util.find_spec("h2") is not None
+        )
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._in_flight = 0
+        # Последние замеры установки соединения, мс
+        self._connect_ms: Deque[float] = deque(maxlen=1024)
+        self._tls_ms: Deque[float] = deque(maxlen=1024)
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "connects": 0,        # Новых TCP-соединений (остальные — из пула)
+            "peak_in_flight": 0,
+        }
+
+    # ==================== ЖИЗНЕННЫЙ ЦИКЛ ====================
+
+    async def start(self) -> None:
+        if self._client is not None:
+            return
+        self._client = httpx.AsyncClient(
+            verify=self.verify,
+            timeout=self.timeout,
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+        logger.info(
+            f"Upstream pool started: {self.base_url} http2={self.http2} "
+            f"max_connections={self.max_connections} keepalive={self.max_keepalive}"
+        )
+
+    async def close(self) -> None:
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    # ==================== ЗАПРОСЫ ====================
+
+    async def get(self, path: str, headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+        """GET {MARZBAN_URL}{path} через общий пул."""
+        if self._client is None:
+            # Роутер подключён без startup (скрипты, тесты) — поднимаем пул лениво
+            await self.start()
+
+        self.stats["requests"] += 1
+        self._in_flight += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self._in_flight)
+        try:
+            return await self._client.get(
+                f"{self.base_url}{path}",
+                headers=headers,
+                extensions={"trace": self._make_trace()},
+            )
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self._in_flight -= 1
+
+    def _make_trace(self):
+        """Колбэк httpcore trace: время connect_tcp и start_tls нового соединения."""
+        started: Dict[str, float] = {}
+
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            step, _, phase = event_name.rpartition(".")
+            if phase == "started":
+                started[step] = time.perf_counter()
+            elif phase == "complete" and step in started:
+                elapsed_ms = (time.perf_counter() - started.pop(step)) * 1000
+                if step == "connection.connect_tcp":
+                    self.stats["connects"] += 1
+                    self._connect_ms.append(elapsed_ms)
+                elif step == "connection.start_tls":
+                    self._tls_ms.append(elapsed_ms)
+
+        return trace
+
+    # ==================== МЕТРИКИ ====================
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Использование пула и задержки соединения для /metrics."""
+        connections = self._pool_connections()
+        idle = sum(1 for c in connections if c.is_idle())
+        requests = self.stats["requests"]
+        return {
+            **self.stats,
+            "in_flight": self._in_flight,
+            "http2": self.http2,
+            "pool": {
+                "open": len(connections),
+                "idle": idle,
+                "active": len(connections) - idle,
+                "max_connections": self.max_connections,
+                "max_keepalive": self.max_keepalive,
+            },
+            "reuse_ratio": round(1 - self.stats["connects"] / requests, 3) if requests else None,
+            "connect_ms": self._latency_summary(self._connect_ms),
+            "tls_ms": self._latency_summary(self._tls_ms),
+        }
+
+    def _pool_connections(self) -> list:
+        # httpx не отдаёт пул публично: транспорт -> httpcore pool -> connections
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        return list(getattr(pool, "connections", []) or [])
+
+    @staticmethod
+    def _latency_summary(samples: Deque[float]) -> Dict[str, Optional[float]]:
+        def rounded(value: Optional[float]) -> Optional[float]:
+            return round(value, 2) if value is not None else None
+
+        return {
+            "samples": len(samples),
+            "p50": rounded(percentile(samples, 50)),
+            "p95": rounded(percentile(samples, 95)),
+            "max": rounded(max(samples) if samples else None),
+        }
+
+
+# Singleton
+upstream_client = UpstreamClient()
@@ -0,0 +1,135 @@
+"""
+User Agent - общий разбор User-Agent VPN-клиентов.
+
+Один разбор для /sub прокси, RemnawaveService и XrayService: регулярные
+выражения скомпилированы один раз, результат кэшируется LRU по сырой
+строке (различных UA всего несколько сотен, а запросов — на порядки
+больше). Результат — неизменяемый UserAgentInfo; как его показать
+(HTML в боте, строка в профиле), решает вызывающий сервис.
+
+    Happ/3.7.0/ios CFNetwork/3860.300.31 Darwin/25.2.0
+    Happ/1.5.2 (iOS 17.2; iPhone14,3)
+    V2RayTun/3.0 (Android 14; SM-S918B)
+"""
+
+import os
+import re
+from functools import lru_cache
+from typing import Dict, NamedTuple, Optional
+
+# Приложение и версия в начале строки: "Happ/3.7.0"
+_APP_RE = re.compile(r"^(\w+)/([0-9.]+)")
+# "ios" не внутри слова: подстрока есть и в чужих UA ("radios", "studios"),
+# но цифры и "_" рядом допустимы ("ios17.2", "Karing_ios_1.1.2")
+_IOS_RE = re.compile(r"(?<![a-z])ios(?![a-z])")
+_IOS_VERSION_RE = re.compile(r"(?<![a-z])ios[\s/]*([\d.]+)")
+_ANDROID_VERSION_RE = re.compile(r"android[\s/]*([\d.]+)")
+_DARWIN_RE = re.compile(r"darwin/(\d+)\.(\d+)")
+
+# Версия Darwin -> версия iOS (приблизительно)
+_DARWIN_TO_IOS = {
+    "25": "18",
+    "24": "17",
+    "23": "16",
+    "22": "15",
+    "21": "14",
+}
+
+# Производитель Android-устройства по подстрокам
+_ANDROID_VENDORS = (
+    (("samsung", "sm-"), "Samsung"),
+    (("xiaomi", "redmi"), "Xiaomi"),
+    (("huawei",), "Huawei"),
+)
+
+# Семейство ОС -> название устройства
+_OS_DEVICES = {
+    "Windows": "Windows PC",
+    "macOS": "Mac",
+    "Linux": "Linux PC",
+}
+
+
+class UserAgentInfo(NamedTuple):
+    """Разобранный User-Agent (общий для всех вызывающих — не изменять)."""
+
+    raw: str
+    app_name: Optional[str] = None       # Happ
+    app_version: Optional[str] = None    # 3.7.0
+    os_name: Optional[str] = None        # iOS / Android / Windows / macOS / Linux
+    os_version: Optional[str] = None     # 17.2 (только номер)
+    device: Optional[str] = None         # iPhone / iPad / Android / Windows PC / Mac / Linux PC
+    vendor: Optional[str] = None         # Samsung / Xiaomi / Huawei (Android)
+
+    @property
+    def os_label(self) -> Optional[str]:
+        """ОС с версией ("iOS 17.2", "Android"); None, если ОС не определена."""
+        if self.os_name and self.os_version:
+            return f"{self.os_name} {self.os_version}"
+        return self.os_name
+
+    def as_device_info(self) -> Dict[str, Optional[str]]:
+        """Словарь в формате parse_device_from_headers (колонки devices)."""
+        return {
+            "user_agent": self.raw,
+            "device_name": self.device,
+            "os_version": self.os_label,
+            "app_name": self.app_name,
+            "app_version": self.app_version,
+        }
+
+
+def _parse(ua: str) -> UserAgentInfo:
+    lower = ua.lower()
+    app_name = app_version = os_name = os_version = device = vendor = None
+
+    app = _APP_RE.match(ua)
+    if app:
+        app_name, app_version = app.group(1), app.group(2)
+
+    if "iphone" in lower or "ipad" in lower or _IOS_RE.search(lower):
+        os_name = "iOS"
+        device = "iPad" if "ipad" in lower else "iPhone"
+        version = _IOS_VERSION_RE.search(lower)
+        if version:
+            os_version = version.group(1)
+        else:
+            darwin = _DARWIN_RE.search(lower)
+            if darwin and darwin.group(1) in _DARWIN_TO_IOS:
+                minor = int(darwin.group(2))
+                # Darwin minor -> примерный minor iOS
+                os_version = f"{_DARWIN_TO_IOS[darwin.group(1)]}.{minor // 100 if minor > 10 else minor}"
+    elif "android" in lower:
+        os_name = device = "Android"
+        version = _ANDROID_VERSION_RE.search(lower)
+        if version:
+            os_version = version.group(1)
+        for needles, name in _ANDROID_VENDORS:
+            if any(needle in lower for needle in needles):
+                vendor = name
+                break
+    elif "windows" in lower:
+        os_name = "Windows"
+    elif "mac" in lower or "darwin" in lower:
+        os_name = "macOS"
+    elif "linux" in lower:
+        os_name = "Linux"
+
+    if device is None and os_name:
+        device = _OS_DEVICES[os_name]
+
+    return UserAgentInfo(ua, app_name, app_version, os_name, os_version, device, vendor)
+
+
+_cached_parse = lru_cache(maxsize=int(os.getenv("UA_CACHE_SIZE", "1024")))(_parse)
+
+
+def parse_user_agent(ua: Optional[str]) -> UserAgentInfo:
+    """Разобрать User-Agent (кэш LRU по сырой строке)."""
+    return _cached_parse(ua or "")
+
+
+def cache_stats() -> Dict[str, int]:
+    """Счётчики LRU для /metrics."""
+    info = _cached_parse.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
@@ -0,0 +1,140 @@
+"""
+User Directory - индекс пользователей Remnawave в памяти.
+
+Держит последний полный список пользователей панели и индексы по username,
+telegram_id, uuid и short_uuid, чтобы get_user не перебирал всю панель
+на каждый клик в боте.
+"""
+
+import time
+import logging
+from typing import Optional, Dict, Any, List, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class UserDirectory:
+    """Индекс пользователей панели с TTL и явной инвалидацией."""
+
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        self._loaded_at: Optional[float] = None
+        self._by_username: Dict[str, Dict[str, Any]] = {}
+        self._by_telegram_id: Dict[int, Dict[str, Any]] = {}
+        self._by_uuid: Dict[str, Dict[str, Any]] = {}
+        self._by_short_uuid: Dict[str, Dict[str, Any]] = {}
+
+    # ==================== СОСТОЯНИЕ ====================
+
+    def is_fresh(self) -> bool:
+        """Справочник загружен и TTL ещё не истёк."""
+        if self._loaded_at is None:
+            return False
+        return (time.monotonic() - self._loaded_at) < self.ttl
+
+    @property
+    def age(self) -> Optional[float]:
+        """Возраст справочника в секундах (None, если ещё не загружен)."""
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    def __len__(self) -> int:
+        return len(self._by_uuid)
+
+    def replace(self, users: Iterable[Dict[str, Any]]) -> None:
+        """Полностью пересобрать индексы из свежего списка пользователей."""
+        self._by_username = {}
+        self._by_telegram_id = {}
+        self._by_uuid = {}
+        self._by_short_uuid = {}
+        for user in users:
+            self._index(user)
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self) -> None:
+        """Пометить справочник устаревшим: следующий lookup перечитает панель."""
+        self._loaded_at = None
+
+    # ==================== ТОЧЕЧНЫЕ ИЗМЕНЕНИЯ ====================
+
+    def upsert(self, user: Dict[str, Any]) -> None:
+        """Добавить или заменить одного пользователя (после create/update)."""
+        uuid = user.get("_uuid")
+        if uuid and uuid in self._by_uuid:
+            self._unindex(self._by_uuid[uuid])
+        self._index(user)
+
+    def remove(self, user: Dict[str, Any]) -> None:
+        """Удалить пользователя из всех индексов."""
+        existing = self._by_uuid.get(user.get("_uuid")) or user
+        self._unindex(existing)
+
+    # ==================== ПОИСК ====================
+
+    def get(self, username: str) -> Optional[Dict[str, Any]]:
+        """
+        Найти пользователя так же, как это делал get_user:
+        сначала точное совпадение username, затем Telegram ID из user_123.
+        """
+        user = self._by_username.get(username)
+        if user is not None:
+            return user
+
+        if username.startswith("user_"):
+            try:
+                return self._by_telegram_id.get(int(username.replace("user_", "")))
+            except ValueError:
+                return None
+        return None
+
+    def get_by_telegram_id(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        return self._by_telegram_id.get(int(telegram_id))
+
+    def get_by_uuid(self, uuid: str) -> Optional[Dict[str, Any]]:
+        return self._by_uuid.get(uuid)
+
+    def get_by_short_uuid(self, short_uuid: str) -> Optional[Dict[str, Any]]:
+        return self._by_short_uuid.get(short_uuid)
+
+    def all(self) -> List[Dict[str, Any]]:
+        """Все пользователи справочника."""
+        return list(self._by_uuid.values())
+
+    # ==================== ВНУТРЕННЕЕ ====================
+
+    def _index(self, user: Dict[str, Any]) -> None:
+        uuid = user.get("_uuid")
+        if not uuid:
+            return
+        self._by_uuid[uuid] = user
+        if user.get("username"):
+            self._by_username[user["username"]] = user
+        if user.get("short_uuid"):
+            self._by_short_uuid[user["short_uuid"]] = user
+        telegram_id = user.get("telegram_id")
+        if telegram_id is not None:
+            try:
+                # Первый найденный выигрывает, как в старом линейном поиске
+                self._by_telegram_id.setdefault(int(telegram_id), user)
+            except (TypeError, ValueError):
+                pass
+
+    def _unindex(self, user: Dict[str, Any]) -> None:
+        uuid = user.get("_uuid")
+        if uuid and self._by_uuid.get(uuid) is user:
+            del self._by_uuid[uuid]
+        username = user.get("username")
+        if username and self._by_username.get(username) is user:
+            del self._by_username[username]
+        short_uuid = user.get("short_uuid")
+        if short_uuid and self._by_short_uuid.get(short_uuid) is user:
+            del self._by_short_uuid[short_uuid]
+        telegram_id = user.get("telegram_id")
+        if telegram_id is not None:
+            try:
+                telegram_id = int(telegram_id)
+            except (TypeError, ValueError):
+                return
+            if self._by_telegram_id.get(telegram_id) is user:
+                del self._by_telegram_id[telegram_id]
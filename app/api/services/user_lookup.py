@@ -0,0 +1,164 @@
+"""
+User Lookup - точечный поиск пользователя через API панели.
+
+Вместо полной выборки /api/users пробуем эндпоинты по ключу, от самого
+дешёвого: uuid -> short_uuid -> username -> telegram_id. Разные версии
+Remnawave поддерживают разный набор, поэтому для каждого эндпоинта
+запоминаем, отвечает ли он, и не дёргаем неподдерживаемые на каждый клик.
+"""
+
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# (ключ, путь) в порядке стоимости; uuid — первичный ключ панели
+LOOKUP_ENDPOINTS: Tuple[Tuple[str, str], ...] = (
+    ("uuid", "/api/users/{}"),
+    ("short_uuid", "/api/users/by-short-uuid/{}"),
+    ("username", "/api/users/by-username/{}"),
+    ("telegram_id", "/api/users/by-telegram-id/{}"),
+)
+
+# Ответы, которыми панель говорит «такого маршрута нет»
+# (400 — ошибка конкретного запроса, например невалидный ключ, а не признак маршрута)
+_UNSUPPORTED_STATUSES = (405, 501)
+
+
+class LookupResult:
+    """Итог точечного поиска."""
+
+    __slots__ = ("user", "conclusive")
+
+    def __init__(self, user: Optional[Dict[str, Any]] = None, conclusive: bool = False):
+        self.user = user              # Сырой пользователь Remnawave или None
+        self.conclusive = conclusive  # True: панель подтвердила, что пользователя нет
+
+
+class DirectLookup:
+    """Поиск по ключу с памятью о поддержке эндпоинтов."""
+
+    def __init__(self, client: httpx.AsyncClient, base_url: str,
+                 get_headers: Callable[[], Awaitable[Dict[str, str]]],
+                 recheck_after: float = 3600.0):
+        self.client = client
+        self.base_url = base_url
+        self._get_headers = get_headers
+        # Неподдерживаемый эндпоинт перепроверяем раз в recheck_after (обновление панели)
+        self.recheck_after = recheck_after
+        self._support: Dict[str, bool] = {}
+        self._checked_at: Dict[str, float] = {}
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "not_found": 0,
+            "inconclusive": 0,
+            "requests": 0,
+        }
+
+    # ==================== ПУБЛИЧНОЕ API ====================
+
+    def supports(self, key: str) -> Optional[bool]:
+        """True / False — проверено, None — ещё не пробовали (или пора перепроверить)."""
+        supported = self._support.get(key)
+        if supported is False and time.monotonic() - self._checked_at[key] >= self.recheck_after:
+            return None
+        return supported
+
+    def support_snapshot(self) -> Dict[str, Optional[bool]]:
+        return {key: self.supports(key) for key, _ in LOOKUP_ENDPOINTS}
+
+    async def find(self, keys: Dict[str, Any],
+                   match: Optional[Callable[[Dict[str, Any]], bool]] = None) -> LookupResult:
+        """
+        Найти пользователя по первому ключу, на который ответит панель.
+        keys: {"uuid": ..., "short_uuid": ..., "username": ..., "telegram_id": ...},
+        пустые значения пропускаются.
+        match: проверка найденного (uuid/short_uuid из старого индекса могли
+        уже принадлежать другому пользователю).
+        Результат conclusive, только если username и telegram_id (те, что
+        переданы) поддерживаются и оба ответили «не найден».
+        """
+        self.stats["lookups"] += 1
+        authoritative = [key for key in ("username", "telegram_id") if keys.get(key) not in (None, "")]
+        missing = set()
+
+        for key, path in LOOKUP_ENDPOINTS:
+            value = keys.get(key)
+            if value in (None, "") or self.supports(key) is False:
+                continue
+            # username приходит от пользователя: "/", "?" и "#" не должны менять путь
+            found, status = await self._request(key, path.format(quote(str(value), safe="")))
+            candidates = [u for u in found if match is None or match(u)]
+            if candidates:
+                self.stats["hits"] += 1
+                return LookupResult(candidates[0])
+            if status in ("ok", "missing"):
+                # by-telegram-id отвечает пустым списком, а не 404
+                missing.add(key)
+
+        if authoritative and all(key in missing for key in authoritative):
+            self.stats["not_found"] += 1
+            return LookupResult(conclusive=True)
+        self.stats["inconclusive"] += 1
+        return LookupResult()
+
+    # ==================== ВНУТРЕННЕЕ ====================
+
+    async def _request(self, key: str, path: str) -> Tuple[List[Dict[str, Any]], str]:
+        """
+        Один запрос к эндпоинту. Возвращает (пользователи, статус):
+        "ok" | "missing" | "unsupported" | "error".
+        """
+        self.stats["requests"] += 1
+        try:
+            response = await self.client.get(f"{self.base_url}{path}", headers=await self._get_headers())
+        except httpx.HTTPError as e:
+            logger.debug(f"Direct lookup by {key} failed: {e!r}")
+            return [], "error"
+
+        if response.status_code == 200:
+            try:
+                payload = response.json()
+            except ValueError:
+                # Обрезанный ответ или HTML прокси перед панелью — не повод считать ключ отсутствующим
+                logger.debug(f"Direct lookup by {key} returned invalid JSON")
+                return [], "error"
+            self._mark(key, True)
+            users = payload.get("response", payload) if isinstance(payload, dict) else payload
+            if isinstance(users, dict):
+                users = [users]
+            elif users is None:
+                users = []
+            if not isinstance(users, list):
+                return [], "error"
+            return [u for u in users if isinstance(u, dict) and u.get("uuid")], "ok"
+
+        if response.status_code == 404 and self._is_not_found(response):
+            # Маршрут есть, пользователя нет
+            self._mark(key, True)
+            return [], "missing"
+
+        if response.status_code in _UNSUPPORTED_STATUSES or response.status_code == 404:
+            logger.info(f"Remnawave lookup by {key} unsupported ({response.status_code}), using fallback")
+            self._mark(key, False)
+            return [], "unsupported"
+
+        return [], "error"
+
+    @staticmethod
+    def _is_not_found(response: httpx.Response) -> bool:
+        """404 от обработчика панели (есть errorCode), а не от роутера («Cannot GET ...»)."""
+        try:
+            body = response.json()
+        except ValueError:
+            return False
+        return isinstance(body, dict) and "errorCode" in body
+
+    def _mark(self, key: str, supported: bool) -> None:
+        self._support[key] = supported
+        self._checked_at[key] = time.monotonic()
@@ -0,0 +1,144 @@
+"""
+UserRecord - компактная запись пользователя панели.
+
+Заменяет dict из 13 ключей, который собирался на каждого пользователя при
+каждой выборке. Поля в __slots__, expireAt разбирается один раз при
+конвертации, а интерфейс dict (get / [] / keys / items) сохранён, чтобы код
+бота и админки продолжал работать без изменений.
+"""
+
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+# Поля в формате Marzban — те же ключи, что были у конвертированного dict
+USER_FIELDS: Tuple[str, ...] = (
+    # Сохраняем оригинальный UUID для API вызовов
+    "_uuid",
+
+    # Совместимость с Marzban полями
+    "username",
+    "status",
+    "data_limit",
+    "used_traffic",
+    "expire",
+    "subscription_url",
+    "sub_last_user_agent",
+    "online_at",
+    "note",
+
+    # Дополнительные поля Remnawave
+    "telegram_id",
+    "short_uuid",
+    "hwid_device_limit",
+
+    # Учётные данные протоколов (локальный рендер подписки, local_render)
+    "vless_uuid",
+    "trojan_password",
+    "ss_password",
+)
+
+_FIELD_SET = frozenset(USER_FIELDS)
+
+
+def parse_expire_at(expire_at: Optional[str]) -> int:
+    """ISO-дата expireAt из Remnawave -> unix timestamp (0 если нет/не разобрать)."""
+    if not expire_at:
+        return 0
+    try:
+        return int(datetime.fromisoformat(expire_at.replace("Z", "+00:00")).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+class UserRecord:
+    """Пользователь панели в формате Marzban с dict-совместимым доступом."""
+
+    __slots__ = USER_FIELDS
+
+    def __init__(self, **fields: Any):
+        for name in USER_FIELDS:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_panel(cls, remnawave_user: Dict[str, Any]) -> "UserRecord":
+        """Конвертировать ответ Remnawave в запись (формат Marzban для совместимости)."""
+        traffic = remnawave_user.get("userTraffic") or {}
+        record = cls.__new__(cls)
+        record._uuid = remnawave_user.get("uuid")
+        record.username = remnawave_user.get("username")
+        record.status = (remnawave_user.get("status") or "ACTIVE").lower()  # active/disabled
+        record.data_limit = remnawave_user.get("trafficLimitBytes", 0)
+        record.used_traffic = traffic.get("usedTrafficBytes", 0)
+        record.expire = parse_expire_at(remnawave_user.get("expireAt"))
+        record.subscription_url = remnawave_user.get("subscriptionUrl", "")
+        record.sub_last_user_agent = remnawave_user.get("subLastUserAgent", "")
+        record.online_at = traffic.get("onlineAt")
+        record.note = remnawave_user.get("description", "")
+        record.telegram_id = remnawave_user.get("telegramId")
+        record.short_uuid = remnawave_user.get("shortUuid")
+        record.hwid_device_limit = remnawave_user.get("hwidDeviceLimit")
+        record.vless_uuid = remnawave_user.get("vlessUuid")
+        record.trojan_password = remnawave_user.get("trojanPassword")
+        record.ss_password = remnawave_user.get("ssPassword")
+        return record
+
+    # ==================== DICT-СОВМЕСТИМОСТЬ ====================
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key in _FIELD_SET:
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key: str) -> Any:
+        if key in _FIELD_SET:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in _FIELD_SET:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: object) -> bool:
+        return key in _FIELD_SET
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(USER_FIELDS)
+
+    def __len__(self) -> int:
+        return len(USER_FIELDS)
+
+    def keys(self) -> Tuple[str, ...]:
+        return USER_FIELDS
+
+    def values(self) -> List[Any]:
+        return [getattr(self, name) for name in USER_FIELDS]
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(name, getattr(self, name)) for name in USER_FIELDS]
+
+    def copy(self) -> "UserRecord":
+        clone = UserRecord.__new__(UserRecord)
+        for name in USER_FIELDS:
+            setattr(clone, name, getattr(self, name))
+        return clone
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in USER_FIELDS}
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, UserRecord):
+            return self.items() == other.items()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"UserRecord(username={self.username!r}, uuid={self._uuid!r}, status={self.status!r})"
+
+
+def records_from_panel(remnawave_users: Iterable[Dict[str, Any]]) -> List[UserRecord]:
+    """Синхронно конвертировать страницу пользователей Remnawave."""
+    from_panel = UserRecord.from_panel
+    return [from_panel(u) for u in remnawave_users]
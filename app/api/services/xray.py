@@ -3,6 +3,8 @@ import os
 import logging
 from typing import Optional, Dict, Any
 
+from app.api.services.user_agent import parse_user_agent
+
 logger = logging.getLogger(__name__)
 
 class MarzbanService:
@@ -257,61 +259,17 @@ class MarzbanService:
         }
     
     def _parse_user_agent(self, ua: str) -> str:
-        """Parse User-Agent string to extract device info."""
+        """Format a User-Agent as "OS — device" for the bot (shared cached parser)."""
         if not ua:
             return None
         
-        import re
-        
-        # Common patterns for VPN clients
-        # Happ/1.5.2 (iOS 17.2; iPhone14,3)
-        # V2RayTun/3.0 (Android 14; SM-S918B)
-        # Shadowrocket/2.2.0 (iOS; iPhone)
-        
-        ua_lower = ua.lower()
-        
-        # Detect OS
-        if "ios" in ua_lower or "iphone" in ua_lower or "ipad" in ua_lower:
-            os_name = "iOS"
-            # Try to extract version
-            ios_match = re.search(r'ios[\s/]*([\d.]+)', ua_lower)
-            if ios_match:
-                os_name = f"iOS {ios_match.group(1)}"
-            
-            # Detect device type
-            if "ipad" in ua_lower:
-                device = "iPad"
-            else:
-                device = "iPhone"
-            
-            return f"{os_name} — {device}"
-        
-        elif "android" in ua_lower:
-            os_name = "Android"
-            android_match = re.search(r'android[\s/]*([\d.]+)', ua_lower)
-            if android_match:
-                os_name = f"Android {android_match.group(1)}"
-            
-            # Try to detect device model
-            if "samsung" in ua_lower or "sm-" in ua_lower:
-                device = "Samsung"
-            elif "xiaomi" in ua_lower or "redmi" in ua_lower:
-                device = "Xiaomi"
-            elif "huawei" in ua_lower:
-                device = "Huawei"
-            else:
-                device = "Android Device"
-            
-            return f"{os_name} — {device}"
-        
-        elif "windows" in ua_lower:
-            return "Windows — PC"
-        
-        elif "mac" in ua_lower or "darwin" in ua_lower:
-            return "macOS — Mac"
-        
-        elif "linux" in ua_lower:
-            return "Linux — PC"
+        info = parse_user_agent(ua)
+        if info.os_name == "iOS":
+            return f"{info.os_label} — {info.device}"
+        elif info.os_name == "Android":
+            return f"{info.os_label} — {info.vendor or 'Android Device'}"
+        elif info.os_name:
+            return f"{info.os_name} — {info.device.split()[-1]}"
         
         # Generic fallback
         return ua[:30] + "..." if len(ua) > 30 else ua
@@ -93,12 +93,17 @@ async def admin_stats(callback: CallbackQuery):
         
         # Get all users from Marzban via direct call
         from app.api.services.remnawave import remnawave_service as marzban_service
-        users = await marzban_service.get_all_users()
-        
-        total_users = len(users) if users else 0
-        active_users = sum(1 for u in users if u.get("status") == "active") if users else 0
-        disabled_users = sum(1 for u in users if u.get("status") == "disabled") if users else 0
-        total_traffic = sum(u.get("used_traffic", 0) for u in users) if users else 0
+        total_users = 0
+        active_users = 0
+        disabled_users = 0
+        total_traffic = 0
+        async for u in marzban_service.iter_users():
+            total_users += 1
+            if u.get("status") == "active":
+                active_users += 1
+            elif u.get("status") == "disabled":
+                disabled_users += 1
+            total_traffic += u.get("used_traffic", 0) or 0
         total_traffic_gb = round(total_traffic / (1024**3), 2)
         
         online_users = server.get("online_users", 0) if server.get("online") else 0
@@ -147,25 +152,19 @@ async def admin_users(callback: CallbackQuery):
         from app.bot.utils.users_db import get_users_with_subscription
         from datetime import datetime
         
-        # Get Marzban users
-        marzban_users = await marzban_service.get_all_users() or []
-        
-        # Get local users with active subscriptions
-        local_users = get_users_with_subscription() or []
-        
-        # Create a set of Marzban telegram IDs for deduplication
+        # Stream Marzban users, keeping only the fields the list needs
         marzban_tg_ids = set()
-        for user in marzban_users:
+        merged_users = []
+        async for user in marzban_service.iter_users():
             uname = user.get("username", "")
+            # Collect Marzban telegram IDs for deduplication
             if uname.startswith("user_"):
                 try:
                     marzban_tg_ids.add(int(uname.replace("user_", "")))
                 except:
                     pass
-        
-        # Merge: start with Marzban users
-        merged_users = []
-        for user in marzban_users:
+            
+            # Merge: start with Marzban users
             merged_users.append({
                 "type": "marzban",
                 "username": user.get("username"),
@@ -174,6 +173,9 @@ async def admin_users(callback: CallbackQuery):
                 "display_name": extract_tg_username(user)
             })
         
+        # Get local users with active subscriptions
+        local_users = get_users_with_subscription() or []
+        
         # Add local users who are NOT in Marzban yet
         for local_user in local_users:
             tg_id = local_user.get("telegram_id")
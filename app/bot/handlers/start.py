@@ -4,13 +4,13 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQu
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 import logging
 from app.bot.utils.api_client import api
+from app.bot.services.profile import profile_service
 from app.bot.services.subscription_sync import subscription_sync_service
 from app.bot.utils.users_db import create_or_update_user, has_local_subscription, get_user as get_local_user
 from app.bot.utils.oferta_db import is_oferta_accepted, accept_oferta
 from app.bot.utils.momsclub_api import check_momsclub_subscription
 
 logger = logging.getLogger(__name__)
-import os
 
 router = Router()
 
@@ -157,87 +157,8 @@ async def command_profile(message: types.Message):
         )
         return
     
-    # Получаем инфо из Marzban
-    sub_info = await api.get_subscription(telegram_id)
-    
-    # Получаем роль и лимит из Moms Club
-    from app.bot.utils.momsclub_api import get_user_ip_limit, is_admin
-    import httpx
-    
-    # Получаем роль
-    role_text = "🎀 Участница Mom's Club"
-    role_group = None
-    try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            # Use MARZBAN_URL from env or default to https endpoint
-            base_url = os.getenv("MARZBAN_URL", "https://instabotwebhook.ru") 
-            resp = await client.get(f"{base_url}/api/vpn/is_admin/{telegram_id}")
-            if resp.status_code == 200:
-                data = resp.json()
-                role_group = data.get("group")
-                if role_group == "admin" or role_group == "developer":
-                    role_text = "💻 Разработчик"
-                elif role_group == "creator":
-                    role_text = "👑 Создательница"
-                elif role_group == "curator":
-                    role_text = "🎯 Куратор"
-    except:
-        pass
-    
-    # Статус VPN
-    vpn_status = "❌ Не активен"
-    traffic_text = "—"
-    if sub_info:
-        status_map = {"active": "🟢 Активен", "disabled": "🔴 Отключен", "limited": "🟡 Лимит"}
-        vpn_status = status_map.get(sub_info.get("status"), "🟢 Активен")
-        used_bytes = sub_info.get("traffic_used") or 0
-        traffic_text = f"{round(used_bytes / (1024**3), 2)} ГБ"
-    
-    # Лимит устройств
-    ip_limit = await get_user_ip_limit(telegram_id)
-    is_vip = await is_admin(telegram_id)
-    if is_vip or ip_limit is None:
-        limit_text = "∞ Безлимит"
-    else:
-        limit_text = f"до {ip_limit}"
-    
-    # Подписка
-    sub_data = await check_momsclub_subscription(telegram_id)
-    if sub_data.get("end_date"):
-        from datetime import datetime
-        try:
-            end_date = datetime.fromisoformat(sub_data["end_date"])
-            if end_date.year > 2100:
-                sub_until = "безлимитная"
-            else:
-                sub_until = end_date.strftime("%d.%m.%Y")
-        except:
-            sub_until = "активна"
-    else:
-        sub_until = "не активна"
-    
-    # Формируем username строку
-    username_str = f"@{username}" if username else ""
-    
-    text = (
-        f"🎀 <b>Добро пожаловать в личный кабинет Moms VPN!</b>\n\n"
-        f"👋 Привет, <b>{first_name}</b>!\n"
-        f"{username_str}\n\n"
-        f"{role_text}\n\n"
-        f"━━━ <b>VPN</b> ━━━\n"
-        f"🔐 Статус: <b>{vpn_status}</b>\n"
-        f"📱 Устройств: <b>{limit_text}</b>\n"
-        f"📊 Трафик: <b>{traffic_text}</b>\n"
-        f"📅 Подписка: <b>{sub_until}</b>"
-    )
-    
-    # Кнопки — скрываем +1 устройство для VIP
-    buttons = [[InlineKeyboardButton(text="🛡️ Мой VPN", callback_data="my_keys")]]
-    if not is_vip:
-        buttons.append([InlineKeyboardButton(text="📱 +1 устройство (100₽)", callback_data="add_device")])
-    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_home")])
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+    # Панель, роль, лимит устройств и подписка Moms Club — параллельно, с таймаутами
+    text, kb = await profile_service.build(telegram_id, first_name, username)
     
     await message.answer(text, reply_markup=kb, parse_mode="HTML")
 
@@ -361,86 +282,8 @@ async def profile_handler(callback: CallbackQuery):
     first_name = callback.from_user.first_name or "друг"
     username = callback.from_user.username
     
-    # Получаем инфо из Marzban
-    sub_info = await api.get_subscription(telegram_id)
-    
-    # Получаем роль и лимит из Moms Club
-    from app.bot.utils.momsclub_api import get_user_ip_limit, is_admin
-    import httpx
-    
-    # Получаем роль
-    role_text = "🎀 Участница Mom's Club"
-    role_group = None
-    try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            base_url = os.getenv("MARZBAN_URL", "https://instabotwebhook.ru")
-            resp = await client.get(f"{base_url}/api/vpn/is_admin/{telegram_id}")
-            if resp.status_code == 200:
-                data = resp.json()
-                role_group = data.get("group")
-                if role_group == "admin" or role_group == "developer":
-                    role_text = "💻 Разработчик"
-                elif role_group == "creator":
-                    role_text = "👑 Создательница"
-                elif role_group == "curator":
-                    role_text = "🎯 Куратор"
-    except:
-        pass
-    
-    # Статус VPN
-    vpn_status = "❌ Не активен"
-    traffic_text = "—"
-    if sub_info:
-        status_map = {"active": "🟢 Активен", "disabled": "🔴 Отключен", "limited": "🟡 Лимит"}
-        vpn_status = status_map.get(sub_info.get("status"), "🟢 Активен")
-        used_bytes = sub_info.get("traffic_used") or 0
-        traffic_text = f"{round(used_bytes / (1024**3), 2)} ГБ"
-    
-    # Лимит устройств
-    ip_limit = await get_user_ip_limit(telegram_id)
-    is_vip = await is_admin(telegram_id)
-    if is_vip or ip_limit is None:
-        limit_text = "∞ Безлимит"
-    else:
-        limit_text = f"до {ip_limit}"
-    
-    # Подписка
-    sub_data = await check_momsclub_subscription(telegram_id)
-    if sub_data.get("end_date"):
-        from datetime import datetime
-        try:
-            end_date = datetime.fromisoformat(sub_data["end_date"])
-            if end_date.year > 2100:
-                sub_until = "безлимитная"
-            else:
-                sub_until = end_date.strftime("%d.%m.%Y")
-        except:
-            sub_until = "активна"
-    else:
-        sub_until = "не активна"
-    
-    # Формируем username строку
-    username_str = f"@{username}" if username else ""
-    
-    text = (
-        f"🎀 <b>Добро пожаловать в личный кабинет Moms VPN!</b>\n\n"
-        f"👋 Привет, <b>{first_name}</b>!\n"
-        f"{username_str}\n\n"
-        f"{role_text}\n\n"
-        f"━━━ <b>VPN</b> ━━━\n"
-        f"🔐 Статус: <b>{vpn_status}</b>\n"
-        f"📱 Устройств: <b>{limit_text}</b>\n"
-        f"📊 Трафик: <b>{traffic_text}</b>\n"
-        f"📅 Подписка: <b>{sub_until}</b>"
-    )
-    
-    # Кнопки — скрываем +1 устройство для VIP
-    buttons = [[InlineKeyboardButton(text="🛡️ Мой VPN", callback_data="my_keys")]]
-    if not is_vip:
-        buttons.append([InlineKeyboardButton(text="📱 +1 устройство (100₽)", callback_data="add_device")])
-    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_home")])
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+    # Панель, роль, лимит устройств и подписка Moms Club — параллельно, с таймаутами
+    text, kb = await profile_service.build(telegram_id, first_name, username)
     
     if callback.message.photo:
         await callback.message.delete()
@@ -602,6 +445,8 @@ async def reset_devices_handler(callback: CallbackQuery):
     
     try:
         success = await api.reset_devices(telegram_id)
+        # Кэш устройств сбрасываем в любом случае — my_keys покажет актуальный список
+        await api.invalidate_devices(telegram_id)
         if success:
             await callback.answer("✅ Вы отвязали все устройства от своего VPN ключа.\nМожете снова выбрать, где он будет работать 🚀", show_alert=True)
             # Обновляем инфо о ключе
@@ -0,0 +1,187 @@
+"""
+Profile Service - builds the bot's personal account screen (/profile and the "profile" button).
+
+The screen needs four independent remote lookups:
+- the VPN user from the panel (status, traffic);
+- the role group from /api/vpn/is_admin on MARZBAN_URL;
+- VIP flag and device limit from Moms Club (one /api/vpn/is_admin call);
+- the Moms Club subscription end date.
+
+They run concurrently, each under PROFILE_CALL_TIMEOUT seconds. A lookup that
+fails or times out leaves its line as "no data" instead of holding up the
+reply, so the profile takes as long as the slowest lookup, not the sum of all.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Dict, Optional, Set, Tuple
+
+import httpx
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+# Marker for a lookup that failed or ran out of time
+UNAVAILABLE = object()
+
+NO_DATA = "⏳ нет данных"
+
+ROLE_TEXTS = {
+    "admin": "💻 Разработчик",
+    "developer": "💻 Разработчик",
+    "creator": "👑 Создательница",
+    "curator": "🎯 Куратор",
+}
+DEFAULT_ROLE_TEXT = "🎀 Участница Mom's Club"
+
+VPN_STATUS_TEXTS = {"active": "🟢 Активен", "disabled": "🔴 Отключен", "limited": "🟡 Лимит"}
+
+
+class ProfileData:
+    """Results of the profile lookups; UNAVAILABLE for the ones that did not make it."""
+
+    __slots__ = ("subscription", "role_group", "vpn_access", "club_subscription")
+
+    def __init__(self, subscription: Any, role_group: Any, vpn_access: Any, club_subscription: Any):
+        self.subscription = subscription
+        self.role_group = role_group
+        self.vpn_access = vpn_access
+        self.club_subscription = club_subscription
+
+    @property
+    def missing(self) -> Set[str]:
+        return {name for name in self.__slots__ if getattr(self, name) is UNAVAILABLE}
+
+
+class ProfileService:
+    """Concurrent profile lookups with per-call timeouts and a partial render."""
+
+    def __init__(self):
+        self.timeout = float(os.getenv("PROFILE_CALL_TIMEOUT", "4"))
+        self.stats = {
+            "built": 0,
+            "partial": 0,     # Rendered with at least one lookup missing
+            "timeouts": 0,
+            "errors": 0,
+        }
+
+    # ==================== LOOKUPS ====================
+
+    async def gather(self, telegram_id: int) -> ProfileData:
+        """Run all profile lookups at once; each one is bounded by self.timeout."""
+        from app.bot.utils.api_client import api
+        from app.bot.utils.momsclub_api import check_momsclub_subscription, get_vpn_access
+
+        # raise_errors: a failed lookup must become UNAVAILABLE, not "no VPN" / default limit
+        results = await asyncio.gather(
+            self._call("subscription", api.get_subscription(telegram_id, raise_errors=True)),
+            self._call("role_group", self._fetch_role_group(telegram_id)),
+            self._call("vpn_access", get_vpn_access(telegram_id, raise_errors=True)),
+            self._call("club_subscription", check_momsclub_subscription(telegram_id, raise_errors=True)),
+        )
+        return ProfileData(*results)
+
+    async def _call(self, name: str, call: Awaitable[Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(call, self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            logger.warning(f"Profile lookup {name} timed out after {self.timeout:.1f}s")
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Profile lookup {name} failed after {time.perf_counter() - started:.2f}s: {e}")
+        return UNAVAILABLE
+
+    @staticmethod
+    async def _fetch_role_group(telegram_id: int) -> Optional[str]:
+        """Role group (admin / developer / creator / curator) or None for a regular member."""
+        base_url = os.getenv("MARZBAN_URL", "https://instabotwebhook.ru")
+        async with httpx.AsyncClient(timeout=5) as client:
+            resp = await client.get(f"{base_url}/api/vpn/is_admin/{telegram_id}")
+        if resp.status_code != 200:
+            return None
+        return resp.json().get("group")
+
+    # ==================== RENDER ====================
+
+    async def build(self, telegram_id: int, first_name: str,
+                    username: Optional[str]) -> Tuple[str, InlineKeyboardMarkup]:
+        """Profile text and keyboard for the user."""
+        data = await self.gather(telegram_id)
+        self.stats["built"] += 1
+        if data.missing:
+            self.stats["partial"] += 1
+        return self.render(data, first_name, username)
+
+    def render(self, data: ProfileData, first_name: str,
+               username: Optional[str]) -> Tuple[str, InlineKeyboardMarkup]:
+        # Role: a missing lookup shows the regular member role, as before
+        role_group = data.role_group if data.role_group is not UNAVAILABLE else None
+        role_text = ROLE_TEXTS.get(role_group, DEFAULT_ROLE_TEXT)
+
+        # VPN status
+        if data.subscription is UNAVAILABLE:
+            vpn_status = traffic_text = NO_DATA
+        elif data.subscription:
+            vpn_status = VPN_STATUS_TEXTS.get(data.subscription.get("status"), "🟢 Активен")
+            used_bytes = data.subscription.get("traffic_used") or 0
+            traffic_text = f"{round(used_bytes / (1024**3), 2)} ГБ"
+        else:
+            vpn_status, traffic_text = "❌ Не активен", "—"
+
+        # Device limit
+        if data.vpn_access is UNAVAILABLE:
+            is_vip = False
+            limit_text = NO_DATA
+        else:
+            access = data.vpn_access or {}
+            is_vip = access.get("is_admin", False)
+            ip_limit = access.get("ip_limit", 2)
+            limit_text = "∞ Безлимит" if is_vip or ip_limit is None else f"до {ip_limit}"
+
+        # Moms Club subscription
+        if data.club_subscription is UNAVAILABLE:
+            sub_until = NO_DATA
+        else:
+            sub_until = self._subscription_until(data.club_subscription or {})
+
+        username_str = f"@{username}" if username else ""
+
+        text = (
+            f"🎀 <b>Добро пожаловать в личный кабинет Moms VPN!</b>\n\n"
+            f"👋 Привет, <b>{first_name}</b>!\n"
+            f"{username_str}\n\n"
+            f"{role_text}\n\n"
+            f"━━━ <b>VPN</b> ━━━\n"
+            f"🔐 Статус: <b>{vpn_status}</b>\n"
+            f"📱 Устройств: <b>{limit_text}</b>\n"
+            f"📊 Трафик: <b>{traffic_text}</b>\n"
+            f"📅 Подписка: <b>{sub_until}</b>"
+        )
+        if data.missing:
+            text += "\n\n<i>Часть данных не успела загрузиться — открой кабинет ещё раз чуть позже</i>"
+
+        # Buttons: no "+1 device" for VIP, nor when VIP status is unknown
+        buttons = [[InlineKeyboardButton(text="🛡️ Мой VPN", callback_data="my_keys")]]
+        if not is_vip and data.vpn_access is not UNAVAILABLE:
+            buttons.append([InlineKeyboardButton(text="📱 +1 устройство (100₽)", callback_data="add_device")])
+        buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_home")])
+        return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    @staticmethod
+    def _subscription_until(sub_data: Dict[str, Any]) -> str:
+        if not sub_data.get("end_date"):
+            return "не активна"
+        try:
+            end_date = datetime.fromisoformat(sub_data["end_date"])
+        except (TypeError, ValueError):
+            return "активна"
+        return "безлимитная" if end_date.year > 2100 else end_date.strftime("%d.%m.%Y")
+
+
+# Singleton
+profile_service = ProfileService()
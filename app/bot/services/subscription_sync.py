@@ -109,46 +109,95 @@ class SubscriptionSyncService:
             "started_at": datetime.now().isoformat()
         }
         
-        # Get all Marzban users
-        all_users = await marzban_service.get_all_users()
-        if not all_users:
+        # Enable/disable decisions need the live status, so stream Marzban page by page
+        # (the SQL mirror can lag by a sync interval; it only backs the admin views)
+        users_source = marzban_service.iter_users()
+        
+        # Collect status changes
+        seen_users = 0
+        to_enable: Dict[str, int] = {}   # uuid -> telegram_id
+        to_disable: Dict[str, int] = {}
+        try:
+            async for user in users_source:
+                seen_users += 1
+                username = user.get("username", "")
+                
+                # Only process user_* accounts (Telegram users)
+                if not username.startswith("user_"):
+                    continue
+                
+                try:
+                    telegram_id = int(username.replace("user_", ""))
+                except ValueError:
+                    continue
+                
+                current_status = user.get("status", "active")
+                target = user.get("_uuid") or username
+                self.stats["checked"] += 1
+                
+                try:
+                    has_access = await self.check_subscription_status(telegram_id)
+                except Exception as e:
+                    logger.error(f"Error syncing user {telegram_id}: {e}")
+                    self.stats["errors"] += 1
+                    continue
+                
+                # User has access but VPN is disabled → enable
+                if has_access and current_status == "disabled":
+                    to_enable[target] = telegram_id
+                # User has no access but VPN is active → disable
+                elif not has_access and current_status == "active":
+                    to_disable[target] = telegram_id
+                else:
+                    self.stats["no_change"] += 1
+        except Exception as e:
+            # Listing failed mid-way: apply what was collected, report the failure
+            logger.error(f"Error listing users from Marzban: {e}")
+            self.stats["errors"] += 1
+        
+        # Apply changes in bulk: resolved from the listing above, concurrent PUTs
+        await self._apply_changes(marzban_service, to_enable, "ACTIVE", send_notifications)
+        await self._apply_changes(marzban_service, to_disable, "DISABLED", send_notifications)
+        
+        if not seen_users:
             logger.warning("No users found in Marzban")
             return self.stats
         
-        for user in all_users:
-            username = user.get("username", "")
-            
-            # Only process user_* accounts (Telegram users)
-            if not username.startswith("user_"):
-                continue
-            
-            try:
-                telegram_id = int(username.replace("user_", ""))
-            except ValueError:
+        self.stats["finished_at"] = datetime.now().isoformat()
+        logger.info(f"Sync completed: {self.stats}")
+        return self.stats
+    
+    async def _apply_changes(self, marzban_service, targets: Dict[str, int], status: str,
+                             send_notifications: bool) -> None:
+        """Set status for collected users via bulk_set_status and update stats."""
+        if not targets:
+            return
+        
+        try:
+            report = await marzban_service.bulk_set_status(list(targets), status)
+        except Exception as e:
+            logger.error(f"Bulk status {status} failed: {e}")
+            self.stats["errors"] += len(targets)
+            return
+        
+        enabled = status == "ACTIVE"
+        for target, result in report["results"].items():
+            telegram_id = targets[target]
+            if result["result"] != "updated":
+                logger.error(f"Error syncing user {telegram_id}: {result['result']} {result.get('error') or ''}".rstrip())
+                self.stats["errors"] += 1
                 continue
             
-            current_status = user.get("status", "active")
-            
-            # Sync this user
-            result = await self.sync_user(telegram_id, current_status)
-            
-            self.stats["checked"] += 1
-            if result == "enabled":
+            if enabled:
+                logger.info(f"✅ Enabled VPN for user {telegram_id} (subscription active)")
                 self.stats["enabled"] += 1
                 if send_notifications:
                     await self._send_enabled_notification(telegram_id)
-            elif result == "disabled":
+            else:
+                logger.info(f"🔒 Disabled VPN for user {telegram_id} (subscription expired)")
                 self.stats["disabled"] += 1
                 if send_notifications:
                     await self._send_disabled_notification(telegram_id)
-            elif result == "error":
-                self.stats["errors"] += 1
-            else:
-                self.stats["no_change"] += 1
-        
-        self.stats["finished_at"] = datetime.now().isoformat()
-        logger.info(f"Sync completed: {self.stats}")
-        return self.stats
     
     async def _send_enabled_notification(self, telegram_id: int):
         """Send notification when VPN is enabled."""
@@ -46,6 +46,14 @@ class APIClient:
             logger.error(f"reset_devices error: {e}")
             return False
 
+    async def invalidate_devices(self, telegram_id: int):
+        """Drop cached device list so the next key view re-reads it."""
+        try:
+            from app.api.services.remnawave import remnawave_service as marzban_service
+            await marzban_service.invalidate_user_devices(telegram_id)
+        except Exception as e:
+            logger.error(f"invalidate_devices error: {e}")
+
     async def get_user(self, telegram_id: int):
         """Get user from Marzban directly."""
         try:
@@ -56,12 +64,18 @@ class APIClient:
             logger.error(f"get_user error: {e}")
             return None
 
-    async def get_subscription(self, telegram_id: int, fetch_devices: bool = False):
-        """Get subscription data from Marzban directly."""
+    async def get_subscription(self, telegram_id: int, fetch_devices: bool = False,
+                               raise_errors: bool = False):
+        """
+        Get subscription data from Marzban directly.
+        None means no VPN user; with raise_errors=True panel errors raise instead of returning None.
+        """
         try:
             from app.api.services.remnawave import remnawave_service as marzban_service
             username = f"user_{telegram_id}"
-            user = await marzban_service.get_user(username, fetch_devices=fetch_devices)
+            user = await marzban_service.get_user(
+                username, fetch_devices=fetch_devices, raise_errors=raise_errors
+            )
             if user:
                 return {
                     "subscription_url": user.get("subscription_url"),
@@ -74,6 +88,8 @@ class APIClient:
                 }
             return None
         except Exception as e:
+            if raise_errors:
+                raise
             logger.error(f"get_subscription error: {e}")
             return None
 
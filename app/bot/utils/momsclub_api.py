@@ -8,9 +8,10 @@ import os
 MOMSCLUB_API = os.getenv("MOMSCLUB_API", "http://127.0.0.1:8000")
 
 
-async def check_momsclub_subscription(telegram_id: int) -> Dict:
+async def check_momsclub_subscription(telegram_id: int, raise_errors: bool = False) -> Dict:
     """
     Проверяет подписку в Moms Club.
+    raise_errors=True: ошибку запроса пробросить, а не вернуть status "error".
     
     Returns:
         {"status": "active/expired/none/error", "end_date": str|None, "level": str|None}
@@ -18,36 +19,45 @@ async def check_momsclub_subscription(telegram_id: int) -> Dict:
     try:
         async with httpx.AsyncClient(timeout=5) as client:
             resp = await client.get(f"{MOMSCLUB_API}/api/vpn/subscription/{telegram_id}")
-            if resp.status_code == 200:
-                return resp.json()
-            return {"status": "error", "end_date": None, "level": None}
+            resp.raise_for_status()
+            return resp.json()
     except Exception as e:
+        if raise_errors:
+            raise
         logger.warning(f"check_momsclub_subscription error: {e}")
         return {"status": "error", "end_date": None, "level": None}
 
 
-async def is_admin(telegram_id: int) -> bool:
-    """Проверяет является ли пользователь VIP для VPN"""
+async def get_vpn_access(telegram_id: int, raise_errors: bool = False) -> Optional[Dict]:
+    """
+    VIP-статус и лимит устройств одним запросом.
+    raise_errors=True: ошибку запроса пробросить, а не вернуть None.
+    
+    Returns:
+        {"is_admin": bool, "ip_limit": int, ...} или None при ошибке
+    """
     try:
         async with httpx.AsyncClient(timeout=5) as client:
             resp = await client.get(f"{MOMSCLUB_API}/api/vpn/is_admin/{telegram_id}")
-            if resp.status_code == 200:
-                return resp.json().get("is_admin", False)
+            resp.raise_for_status()
+            return resp.json()
     except Exception as e:
-        logger.warning(f"is_admin error: {e}")
-    return False
+        if raise_errors:
+            raise
+        logger.warning(f"get_vpn_access error: {e}")
+    return None
+
+
+async def is_admin(telegram_id: int) -> bool:
+    """Проверяет является ли пользователь VIP для VPN"""
+    access = await get_vpn_access(telegram_id)
+    return access.get("is_admin", False) if access else False
 
 
 async def get_user_ip_limit(telegram_id: int) -> Optional[int]:
     """Получает лимит устройств для пользователя"""
-    try:
-        async with httpx.AsyncClient(timeout=5) as client:
-            resp = await client.get(f"{MOMSCLUB_API}/api/vpn/is_admin/{telegram_id}")
-            if resp.status_code == 200:
-                return resp.json().get("ip_limit", 2)
-    except Exception as e:
-        logger.warning(f"get_ip_limit error: {e}")
-    return 2
+    access = await get_vpn_access(telegram_id)
+    return access.get("ip_limit", 2) if access else 2
 
 
 async def buy_device(telegram_id: int) -> Optional[str]:
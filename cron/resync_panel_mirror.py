@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Rebuild the local SQL mirror of Remnawave panel users.
+
+Usage:
+    python resync_panel_mirror.py [--delta]
+
+Options:
+    --delta     Only write changed rows (same as the background sync)
+                instead of rewriting every row of the table
+
+Use the full resync to recover after a failed migration, a manual edit of
+panel_users, or when the dashboard keeps reporting a stale mirror.
+"""
+
+import asyncio
+import sys
+import os
+import logging
+from datetime import datetime
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Load environment variables
+from dotenv import load_dotenv
+load_dotenv()
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("panel_mirror_resync")
+
+
+async def main(full: bool = True):
+    """Run one mirror sync and report the result."""
+    from app.api.services.panel_mirror import panel_mirror
+    
+    logger.info("=" * 50)
+    logger.info(f"Panel mirror {'FULL RESYNC' if full else 'DELTA SYNC'} started at {datetime.now()}")
+    logger.info("=" * 50)
+    
+    try:
+        result = await panel_mirror.sync(full=full)
+    except Exception as e:
+        logger.error(f"Resync failed: {e}")
+        sys.exit(1)
+    
+    mirror = await panel_mirror.freshness()
+    
+    logger.info("-" * 50)
+    logger.info(f"  Seen: {result['seen']}")
+    logger.info(f"  Inserted: {result['inserted']}")
+    logger.info(f"  Updated: {result['updated']}")
+    logger.info(f"  Unchanged: {result['unchanged']}")
+    logger.info(f"  Deleted: {result['deleted']}")
+    logger.info(f"  Duration: {result['duration']}s")
+    logger.info(f"  Mirror synced at: {mirror['synced_at']}")
+    logger.info("=" * 50)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(full="--delta" not in sys.argv))
@@ -46,15 +46,13 @@ async def main(dry_run: bool = False, send_notifications: bool = False):
     
     if dry_run:
         # In dry run mode, just report what would be changed
-        all_users = await marzban_service.get_all_users()
-        if not all_users:
-            logger.info("No users found in Marzban")
-            return
-        
         would_enable = 0
         would_disable = 0
+        seen_users = 0
         
-        for user in all_users:
+        # Stream users page by page; later pages load while we check earlier ones
+        async for user in marzban_service.iter_users():
+            seen_users += 1
             username = user.get("username", "")
             if not username.startswith("user_"):
                 continue
@@ -74,6 +72,10 @@ async def main(dry_run: bool = False, send_notifications: bool = False):
                 logger.info(f"  [WOULD DISABLE] user_{telegram_id}: subscription expired but VPN active")
                 would_disable += 1
         
+        if not seen_users:
+            logger.info("No users found in Marzban")
+            return
+        
         logger.info("-" * 50)
         logger.info(f"Dry run complete. Would enable: {would_enable}, Would disable: {would_disable}")
         return
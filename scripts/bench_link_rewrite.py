@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: rewriting a subscription's links.
+
+Compares the old substring-scanning loop from subscription_proxy with the
+compiled rules of app/api/services/link_rewrite.py. Both must produce the
+same output, and the script checks that before it times them. It exits
+non-zero when the compiled rules are less than --min-speedup times faster
+than the old loop.
+
+Usage:
+    python scripts/bench_link_rewrite.py [--links 50] [--rounds 2000] [--rules path.json]
+                                         [--min-speedup 1.15]
+"""
+
+import argparse
+import base64
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.api.services.link_rewrite import load_rewriter
+
+
+def legacy_rewrite(all_links: list) -> list:
+    """The rewrite loop as it was in subscription_proxy."""
+    enhanced_links = []
+    user_uuid = None
+    has_trojan = False
+    profile_counter = 0
+
+    for link in all_links:
+        if link.startswith('vless://'):
+            uuid_match = link.split('://')[1].split('@')[0]
+            if uuid_match:
+                user_uuid = uuid_match
+
+        if link.startswith('trojan://'):
+            has_trojan = True
+
+        if '#' in link:
+            base, old_name = link.rsplit('#', 1)
+            profile_counter += 1
+
+            if 'security=reality' in link:
+                link = f"{base}&fragment=3,1,tlshello#✅ Основной Moms"
+            elif link.startswith('vless://') and 'type=ws' in link:
+                link = f"{base}#✅ Запасной Moms"
+            elif link.startswith('trojan://'):
+                link = f"{base}#✅ Альтернативный Moms"
+            elif link.startswith('ss://'):
+                continue
+        else:
+            if 'security=reality' in link:
+                link = f"{link}&fragment=3,1,tlshello#✅ Основной Moms"
+
+        enhanced_links.append(link)
+
+    if user_uuid and not has_trojan:
+        trojan_link = f"trojan://{user_uuid}@instabotwebhook.ru:443?security=tls&type=ws&path=%2Ftrojanws&sni=instabotwebhook.ru&fp=chrome#✅ Альтернативный Moms"
+        enhanced_links.append(trojan_link)
+
+    ss_key = "6Xtl5eyOFNZ73i0xfHWeCw=="
+    ss_userinfo = base64.b64encode(f"2022-blake3-aes-128-gcm:{ss_key}".encode()).decode()
+    shadowsocks_link = f"ss://{ss_userinfo}@31.130.130.238:8388#✅ Резервный Moms"
+    enhanced_links.append(shadowsocks_link)
+    return enhanced_links
+
+
+def make_links(count: int, rng: random.Random, with_trojan: bool = False) -> list:
+    """A subscription mixing every link shape the rules care about."""
+    user_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    shapes = [
+        lambda i: f"vless://{user_id}@nl{i}.example.com:443?security=reality&type=tcp&pbk=AbCd{i}&sni=www.microsoft.com&fp=chrome&sid=ab{i}#🇳🇱 NL {i}",
+        lambda i: f"vless://{user_id}@de{i}.example.com:443?security=reality&type=grpc&serviceName=grpc&pbk=Key{i}",
+        lambda i: f"vless://{user_id}@ws{i}.example.com:443?security=tls&type=ws&path=%2Fws&host=ws{i}.example.com#WS {i}",
+        lambda i: f"vless://{user_id}@h{i}.example.com:443?security=tls&type=grpc&serviceName=x#gRPC {i}",
+        lambda i: "vmess://" + base64.b64encode(('{"add":"vm%d.example.com"}' % i).encode()).decode(),
+        lambda i: f"ss://{base64.b64encode(b'aes-256-gcm:pw').decode()}@ss{i}.example.com:8388#SS {i}",
+        lambda i: f"ss://{base64.b64encode(b'aes-256-gcm:pw').decode()}@ss{i}.example.com:8388",
+        lambda i: f"hysteria2://pw@hy{i}.example.com:443?sni=hy{i}.example.com#HY2 {i}",
+    ]
+    if with_trojan:
+        shapes.append(lambda i: f"trojan://pw{i}@tr{i}.example.com:443?security=tls&type=tcp#TR {i}")
+    return [rng.choice(shapes)(i) for i in range(count)]
+
+
+def time_once(func, links: list, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func(links)
+    return (time.perf_counter() - started) / rounds
+
+
+def best_of(funcs: list, links: list, rounds: int, repeat: int = 9) -> list:
+    """Best time per function; runs are interleaved so machine noise hits both alike."""
+    best = [float("inf")] * len(funcs)
+    for _ in range(repeat):
+        for index, func in enumerate(funcs):
+            best[index] = min(best[index], time_once(func, links, rounds))
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--links", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--rules", help="rules JSON (default: app/api/config/link_rewrite.json)")
+    parser.add_argument("--min-speedup", type=float, default=1.15,
+                        help="fail unless the compiled rules are at least this many times faster")
+    args = parser.parse_args()
+
+    rewriter = load_rewriter(args.rules)
+    rng = random.Random(42)
+
+    # Same output as the old loop on many random subscriptions
+    for case in range(500):
+        links = make_links(rng.randint(0, 60), rng, with_trojan=case % 3 == 0)
+        expected, actual = legacy_rewrite(links), rewriter.rewrite(links)
+        if expected != actual:
+            raise SystemExit(f"Output mismatch on case {case}:\n{expected}\n{actual}")
+    print("Output matches the legacy loop on 500 random subscriptions\n")
+
+    links = make_links(args.links, rng)
+    legacy, compiled = best_of([legacy_rewrite, rewriter.rewrite], links, args.rounds)
+    speedup = legacy / compiled
+    print(f"{args.links}-link subscription, best of 9 x {args.rounds} rounds")
+    print(f"  legacy loop      {legacy * 1e6:8.1f} us")
+    print(f"  compiled rules   {compiled * 1e6:8.1f} us   ({speedup:.2f}x)")
+    if speedup < args.min_speedup:
+        raise SystemExit(f"Compiled rules are {speedup:.2f}x the legacy speed, expected at least {args.min_speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
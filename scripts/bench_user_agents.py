@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+User-Agent parser micro-benchmark.
+
+Times a stream of /sub hits built from the UA corpus in
+tests/test_user_agent.py: the old inline parser from the subscription
+router against the shared precompiled + LRU parser. Correctness of the
+parser is covered by that test (python -m pytest tests).
+
+Usage:
+    python scripts/bench_user_agents.py [--hits 200000] [--distinct 300]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.api.services.user_agent import _parse, cache_stats, parse_user_agent
+from tests.test_user_agent import CORPUS
+
+def legacy_parse_device(user_agent: str) -> dict:
+    """The parser that was inlined in the /sub router (regexes compiled per call)."""
+    device_info = {"user_agent": user_agent, "device_name": None, "os_version": None,
+                   "app_name": None, "app_version": None}
+    if not user_agent:
+        return device_info
+    ua_lower = user_agent.lower()
+    app_match = re.match(r'^(\w+)/([0-9.]+)', user_agent)
+    if app_match:
+        device_info["app_name"] = app_match.group(1)
+        device_info["app_version"] = app_match.group(2)
+    darwin_to_ios = {"25.": "18.", "24.": "17.", "23.": "16.", "22.": "15.", "21.": "14."}
+    darwin_match = re.search(r'darwin/(\d+)\.(\d+)', ua_lower)
+    if darwin_match:
+        major, minor = darwin_match.group(1), darwin_match.group(2)
+        for darwin_prefix, ios_prefix in darwin_to_ios.items():
+            if major + "." == darwin_prefix:
+                ios_minor = int(minor) // 100 if int(minor) > 10 else minor
+                device_info["os_version"] = f"iOS {ios_prefix}{ios_minor}"
+                break
+    if "iphone" in ua_lower or "/ios" in ua_lower:
+        device_info["device_name"] = "iPhone"
+    elif "ipad" in ua_lower:
+        device_info["device_name"] = "iPad"
+    elif "android" in ua_lower:
+        device_info["device_name"] = "Android"
+        android_match = re.search(r'android[/\s]*([\d.]+)', ua_lower)
+        if android_match:
+            device_info["os_version"] = f"Android {android_match.group(1)}"
+    elif "windows" in ua_lower:
+        device_info["device_name"] = "Windows PC"
+        device_info["os_version"] = "Windows"
+    elif "mac" in ua_lower:
+        device_info["device_name"] = "Mac"
+        device_info["os_version"] = "macOS"
+    return device_info
+
+
+def make_stream(hits: int, distinct: int, rng: random.Random) -> list:
+    """Hits over a few hundred distinct UAs, skewed like real clients (a few apps dominate)."""
+    templates = [ua for ua, *_ in CORPUS if ua]
+    pool = [f"{rng.choice(templates)} build/{i}" for i in range(distinct)]
+    weights = [1 / (rank + 1) for rank in range(distinct)]
+    return rng.choices(pool, weights=weights, k=hits)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--hits", type=int, default=200000)
+    parser.add_argument("--distinct", type=int, default=300)
+    args = parser.parse_args()
+
+    stream = make_stream(args.hits, args.distinct, random.Random(42))
+
+    started = time.perf_counter()
+    for ua in stream:
+        legacy_parse_device(ua)
+    legacy = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for ua in stream:
+        _parse(ua).as_device_info()
+    uncached = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for ua in stream:
+        parse_user_agent(ua).as_device_info()
+    cached = time.perf_counter() - started
+
+    per_hit = lambda seconds: seconds / args.hits * 1e6
+    print(f"{args.hits} hits over {args.distinct} distinct user agents")
+    print(f"  legacy inline parser      {per_hit(legacy):6.2f} us/hit")
+    print(f"  precompiled, no cache     {per_hit(uncached):6.2f} us/hit")
+    print(f"  precompiled + LRU         {per_hit(cached):6.2f} us/hit   ({legacy / cached:.1f}x)")
+    print(f"  LRU: {cache_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: converting a full panel listing into user objects.
+
+Compares the old per-row async dict converter with the synchronous
+UserRecord batch converter, for CPU time and retained memory.
+
+Usage:
+    python scripts/bench_user_records.py [--users 10000] [--rounds 5]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.api.services.user_record import records_from_panel
+
+
+def make_panel_users(count: int) -> list:
+    """Fake /api/users rows shaped like Remnawave responses."""
+    base = datetime(2026, 1, 1)
+    users = []
+    for i in range(count):
+        users.append({
+            "uuid": str(uuid.uuid4()),
+            "shortUuid": uuid.uuid4().hex[:16],
+            "username": f"user_{100000 + i}",
+            "status": "ACTIVE" if i % 7 else "DISABLED",
+            "trafficLimitBytes": 0,
+            "expireAt": (base + timedelta(days=3650, seconds=i)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "subscriptionUrl": f"https://panel.example/sub/{i:016x}",
+            "subLastUserAgent": "Happ/3.7.0/ios CFNetwork/3860.300.31 Darwin/25.2.0",
+            "description": f"TG ID: {100000 + i}",
+            "telegramId": 100000 + i,
+            "hwidDeviceLimit": 2,
+            "userTraffic": {"usedTrafficBytes": i * 1024, "onlineAt": "2026-10-01T10:00:00.000Z"},
+        })
+    return users
+
+
+async def legacy_convert(remnawave_user: dict) -> dict:
+    """The pre-UserRecord converter: async, one 13-key dict per user."""
+    traffic = remnawave_user.get("userTraffic", {})
+    expire_at = remnawave_user.get("expireAt")
+    expire_timestamp = 0
+    if expire_at:
+        try:
+            dt = datetime.fromisoformat(expire_at.replace("Z", "+00:00"))
+            expire_timestamp = int(dt.timestamp())
+        except Exception:
+            pass
+    return {
+        "_uuid": remnawave_user.get("uuid"),
+        "username": remnawave_user.get("username"),
+        "status": remnawave_user.get("status", "ACTIVE").lower(),
+        "data_limit": remnawave_user.get("trafficLimitBytes", 0),
+        "used_traffic": traffic.get("usedTrafficBytes", 0),
+        "expire": expire_timestamp,
+        "subscription_url": remnawave_user.get("subscriptionUrl", ""),
+        "sub_last_user_agent": remnawave_user.get("subLastUserAgent", ""),
+        "online_at": traffic.get("onlineAt"),
+        "note": remnawave_user.get("description", ""),
+        "telegram_id": remnawave_user.get("telegramId"),
+        "short_uuid": remnawave_user.get("shortUuid"),
+        "hwid_device_limit": remnawave_user.get("hwidDeviceLimit"),
+    }
+
+
+async def legacy_listing(raw_users: list) -> list:
+    return [await legacy_convert(u) for u in raw_users]
+
+
+def record_listing(raw_users: list) -> list:
+    return records_from_panel(raw_users)
+
+
+def measure(label: str, convert, raw_users: list, rounds: int) -> None:
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        convert(raw_users)
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = convert(raw_users)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+    best = min(timings)
+    print(f"{label:<22} best {best * 1000:8.1f} ms   "
+          f"{best / len(raw_users) * 1e6:6.2f} us/user   "
+          f"retained {retained / 1024:8.0f} KiB ({retained / len(result):5.0f} B/user)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    raw_users = make_panel_users(args.users)
+    print(f"Converting {args.users} panel users, best of {args.rounds} rounds\n")
+
+    loop = asyncio.new_event_loop()
+    measure("async dict (before)", lambda rows: loop.run_until_complete(legacy_listing(rows)), raw_users, args.rounds)
+    measure("UserRecord (after)", record_listing, raw_users, args.rounds)
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
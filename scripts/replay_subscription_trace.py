@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Replay recorded /sub traffic against the proxy and a local fake Marzban.
+
+Reads the trace lines written by app/api/services/trace_recorder.py
+(SUB_TRACE_ENABLED=true). It starts a fake Marzban that answers every
+hashed token with the recorded upstream status, body size and latency.
+The requests are then replayed at the recorded pace (--speed 1), faster
+(--speed 10) or back to back (--speed 0; --concurrency caps the requests
+in flight). Background refresh lines (X-Cache REFRESH) are not replayed:
+they only feed the fake Marzban's answers and the recorded upstream count.
+
+By default the proxy runs in-process: the subscription router over ASGI,
+with the real cache, admission control and upstream pool, and device
+logging off. --target http://host:port drives a running proxy instead.
+Start that proxy with MARZBAN_URL=http://127.0.0.1:<--marzban-port>.
+
+Reports latency p50/p95/p99, throughput, statuses, X-Cache states and
+upstream calls, next to the same numbers from the recording.
+
+Usage:
+    python scripts/replay_subscription_trace.py traces/sub_trace.jsonl* [--speed 10]
+    python scripts/replay_subscription_trace.py trace.jsonl --speed 0 --concurrency 200
+    python scripts/replay_subscription_trace.py trace.jsonl --target http://127.0.0.1:8000 --marzban-port 9900
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.api.services.upstream_client import percentile
+
+DEFAULT_UPSTREAM_BYTES = 2500
+
+
+# ==================== TRACE ====================
+
+def load_trace(paths: List[str], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Trace lines from all files (rotated ones included), in arrival order."""
+    entries = []
+    skipped = 0
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    valid = isinstance(entry.get("t"), (int, float)) and bool(entry.get("tk"))
+                except (ValueError, AttributeError):
+                    valid = False
+                if not valid:
+                    skipped += 1
+                    continue
+                entries.append(entry)
+    if skipped:
+        print(f"Skipped {skipped} malformed trace lines", file=sys.stderr)
+    entries.sort(key=lambda entry: entry["t"])
+    return entries[:limit] if limit else entries
+
+
+class UpstreamProfile:
+    """What the fake Marzban answers for one token: the recorded status, size and latency."""
+
+    __slots__ = ("status", "size", "latency", "_body")
+
+    def __init__(self, status: int, size: int, latency: float):
+        self.status = status
+        self.size = size
+        self.latency = latency
+        self._body: Optional[bytes] = None
+
+    def body(self, token: str) -> bytes:
+        if self._body is None:
+            self._body = fake_subscription(token, self.size) if self.status == 200 else b"User not found"
+        return self._body
+
+
+REFRESH = "REFRESH"
+
+
+def client_requests(entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Lines for client requests, without the cache's own background refreshes."""
+    return [entry for entry in entries if entry.get("cs") != REFRESH]
+
+
+def build_profiles(entries: List[Dict[str, Any]], latency_override: Optional[float]) -> Dict[str, UpstreamProfile]:
+    calls: Dict[str, List[Dict[str, Any]]] = {}
+    for entry in entries:
+        if entry.get("us") is not None:
+            calls.setdefault(entry["tk"], []).append(entry)
+
+    profiles = {}
+    for token in {entry["tk"] for entry in entries}:
+        recorded = calls.get(token)
+        if not recorded:
+            # Never fetched in the recording (served from a cache warmed before it started)
+            profiles[token] = UpstreamProfile(200, DEFAULT_UPSTREAM_BYTES, latency_override or 0.0)
+            continue
+        last = recorded[-1]
+        status = last["us"] or 502
+        latency = latency_override if latency_override is not None else statistics.median(
+            entry.get("um") or 0.0 for entry in recorded
+        )
+        profiles[token] = UpstreamProfile(status, last.get("ub") or DEFAULT_UPSTREAM_BYTES, latency)
+    return profiles
+
+
+def fake_subscription(token: str, size: int) -> bytes:
+    """Base64 link list of about `size` bytes, with links the rewrite rules act on."""
+    user = uuid.uuid5(uuid.NAMESPACE_URL, token)
+    templates = [
+        "vless://{user}@nl{i}.example:443?security=reality&type=tcp&flow=xtls-rprx-vision"
+        "&pbk=PUBLICKEY&sid=ab&sni=www.google.com&fp=chrome#Reality {i}",
+        "vless://{user}@ws{i}.example:443?security=tls&type=ws&path=%2Fvlessws&sni=ws{i}.example#WS {i}",
+        "trojan://{user}@tr{i}.example:443?security=tls&type=ws&path=%2Ftrojanws#Trojan {i}",
+    ]
+    links: List[str] = []
+    remaining = size * 3 // 4
+    while remaining > 0:
+        link = templates[len(links) % len(templates)].format(user=user, i=len(links))
+        links.append(link)
+        remaining -= len(link) + 1
+    return base64.b64encode("\n".join(links).encode())
+
+
+# ==================== FAKE MARZBAN ====================
+
+class FakeMarzban(ThreadingHTTPServer):
+    """Keep-alive HTTP server answering /sub/{token} from the recorded profiles."""
+
+    daemon_threads = True
+    # The default backlog of 5 turns a burst of new pool connections into 1s SYN retries
+    request_queue_size = 1024
+
+    def __init__(self, port: int, profiles: Dict[str, UpstreamProfile]):
+        super().__init__(("127.0.0.1", port), _FakeMarzbanHandler)
+        self.profiles = profiles
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def count_call(self) -> None:
+        with self._lock:
+            self.calls += 1
+
+
+class _FakeMarzbanHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server: FakeMarzban = self.server  # type: ignore[assignment]
+        server.count_call()
+        token = self.path.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+        profile = server.profiles.get(token) or UpstreamProfile(404, 0, 0.0)
+        if profile.latency:
+            time.sleep(profile.latency / 1000)
+        body = profile.body(token)
+        self.send_response(profile.status)
+        self.send_header("Content-Length", str(len(body)))
+        if profile.status == 200:
+            self.send_header("subscription-userinfo", "upload=0; download=1073741824; total=0; expire=0")
+            self.send_header("profile-update-interval", "12")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# ==================== REPLAY ====================
+
+async def replay(entries: List[Dict[str, Any]], client, speed: float,
+                 concurrency: int) -> Tuple[List[Tuple[float, int, str]], float]:
+    """Send every entry at its (scaled) offset; (latency ms, status, X-Cache) per request, wall time."""
+    results: List[Tuple[float, int, str]] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(entry: Dict[str, Any]) -> None:
+        params = {"format": entry["f"]} if entry.get("f") else None
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.get(f"/sub/{entry['tk']}", params=params,
+                                            headers={"User-Agent": entry.get("ua") or ""})
+                status, cache_state = response.status_code, response.headers.get("x-cache", "-")
+            except Exception as e:
+                status, cache_state = 0, type(e).__name__
+            results.append(((time.perf_counter() - started) * 1000, status, cache_state))
+
+    first = entries[0]["t"]
+    began = time.perf_counter()
+    tasks = []
+    for entry in entries:
+        if speed > 0:
+            delay = (entry["t"] - first) / speed - (time.perf_counter() - began)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(entry)))
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - began
+
+
+async def run(args, entries: List[Dict[str, Any]], marzban: FakeMarzban) -> Tuple[List[Tuple[float, int, str]], float]:
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    if args.target:
+        async with httpx.AsyncClient(base_url=args.target, limits=limits, timeout=60) as client:
+            return await replay(entries, client, args.speed, args.concurrency)
+
+    # In-process proxy against the fake Marzban; service settings are read at import time
+    os.environ.setdefault("DEVICE_LOG_ENABLED", "false")
+    os.environ.setdefault("SUB_TRACE_ENABLED", "false")
+    os.environ.setdefault("SUB_LKG_PATH", os.path.join(tempfile.mkdtemp(prefix="sub-replay-"), "lkg.db"))
+    from fastapi import FastAPI
+    from app.api.routers import subscription
+    from app.api.services.lkg_store import lkg_store
+    from app.api.services.upstream_client import upstream_client
+
+    app = FastAPI()
+    app.include_router(subscription.router)
+    # The pool singleton already exists (percentile import above), point it at the fake
+    upstream_client.base_url = f"http://127.0.0.1:{marzban.server_address[1]}"
+    await upstream_client.start()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=60) as client:
+            return await replay(entries, client, args.speed, args.concurrency)
+    finally:
+        await lkg_store.flush()
+        await upstream_client.close()
+
+
+# ==================== REPORT ====================
+
+def _latency_row(label: str, values: List[float]) -> str:
+    cells = [percentile(values, pct) for pct in (50, 95, 99)] + [max(values) if values else None]
+    return f"  {label:<10}" + "".join(f"{value:>10.1f}" if value is not None else f"{'-':>10}" for value in cells)
+
+
+def _counts(counter: Counter) -> str:
+    return ", ".join(f"{key}: {count}" for key, count in counter.most_common())
+
+
+def report(entries: List[Dict[str, Any]], results: List[Tuple[float, int, str]], wall: float,
+           upstream_calls: int, speed: float) -> None:
+    # Upstream calls include background refreshes, everything else is about client requests
+    recorded_calls = sum(1 for entry in entries if entry.get("us") is not None)
+    refreshes = len(entries)
+    entries = client_requests(entries)
+    refreshes -= len(entries)
+    recorded_span = entries[-1]["t"] - entries[0]["t"]
+    total = len(results)
+    pace = f"{speed:g}x" if speed > 0 else "max"
+
+    print(f"Replayed {total} requests ({len({e['tk'] for e in entries})} tokens) in {wall:.2f}s at {pace} speed")
+    print(f"Throughput: {total / wall:.1f} req/s (recorded {len(entries) / recorded_span:.1f} req/s)"
+          if recorded_span > 0 and wall > 0 else f"Throughput: {total / max(wall, 1e-9):.1f} req/s")
+    print()
+    print(f"  {'latency ms':<10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    print(_latency_row("replay", [latency for latency, _, _ in results]))
+    print(_latency_row("recorded", [entry["ms"] for entry in entries if entry.get("ms") is not None]))
+    print()
+    print(f"Statuses: {_counts(Counter(status for _, status, _ in results))}")
+    print(f"  recorded: {_counts(Counter(entry.get('st') for entry in entries))}")
+    print(f"X-Cache:  {_counts(Counter(state for _, _, state in results))}")
+    print(f"  recorded: {_counts(Counter(entry.get('cs') or '-' for entry in entries))}")
+    print(f"Upstream calls: {upstream_calls} ({upstream_calls / max(total, 1):.1%} of requests), "
+          f"recorded {recorded_calls} ({recorded_calls / max(len(entries), 1):.1%}, "
+          f"{refreshes} of them background refreshes)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("traces", nargs="+", help="trace files (sub_trace.jsonl, sub_trace.jsonl.1, ...)")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale: 1 = recorded pace, 0 = no pauses")
+    parser.add_argument("--concurrency", type=int, default=500, help="max requests in flight")
+    parser.add_argument("--limit", type=int, default=None, help="replay only the first N requests")
+    parser.add_argument("--upstream-latency", type=float, default=None,
+                        help="fake Marzban latency in ms (default: recorded median per token)")
+    parser.add_argument("--target", default=None, help="running proxy base URL instead of the in-process one")
+    parser.add_argument("--marzban-port", type=int, default=0, help="fake Marzban port (0 = any free port)")
+    args = parser.parse_args()
+
+    entries = load_trace(args.traces, args.limit)
+    if not client_requests(entries):
+        sys.exit("No trace entries to replay")
+
+    marzban = FakeMarzban(args.marzban_port, build_profiles(entries, args.upstream_latency))
+    threading.Thread(target=marzban.serve_forever, daemon=True).start()
+    print(f"Fake Marzban on http://127.0.0.1:{marzban.server_address[1]}", file=sys.stderr)
+    try:
+        results, wall = asyncio.run(run(args, client_requests(entries), marzban))
+    finally:
+        marzban.shutdown()
+    report(entries, results, wall, marzban.calls, args.speed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Send a signed fake Remnawave webhook event to a local API.
+
+Usage:
+    python scripts/send_fake_remnawave_event.py user.modified --telegram-id 123 --status DISABLED
+    python scripts/send_fake_remnawave_event.py user_hwid_devices.added --uuid <panel uuid>
+    python scripts/send_fake_remnawave_event.py user.modified --bad-signature   # expect 401
+
+The secret defaults to REMNAWAVE_WEBHOOK_SECRET, same as the API.
+"""
+
+import argparse
+import json
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.api.routers.webhooks import SIGNATURE_HEADER, sign_payload
+
+EVENTS = (
+    "user.created", "user.modified", "user.disabled", "user.enabled",
+    "user.revoked", "user.traffic_reset", "user.deleted",
+    "user_hwid_devices.added", "user_hwid_devices.deleted",
+)
+
+
+def fake_user(args) -> dict:
+    """Panel user shaped like /api/users rows."""
+    telegram_id = args.telegram_id
+    expire = datetime.now(timezone.utc) + timedelta(days=3650)
+    return {
+        "uuid": args.uuid,
+        "shortUuid": args.short_uuid or args.uuid.replace("-", "")[:16],
+        "username": args.username or f"user_{telegram_id}",
+        "status": args.status,
+        "telegramId": telegram_id,
+        "trafficLimitBytes": 0,
+        "expireAt": expire.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+        "subscriptionUrl": f"https://panel.example/sub/{args.uuid[:8]}",
+        "description": f"TG ID: {telegram_id}",
+        "hwidDeviceLimit": 2,
+        "userTraffic": {"usedTrafficBytes": 0 if args.event == "user.traffic_reset" else 1024 ** 3},
+    }
+
+
+def build_event(args) -> dict:
+    user = fake_user(args)
+    if args.event.startswith("user_hwid_devices."):
+        data = {
+            "user": user,
+            "hwidUserDevice": {
+                "hwid": uuid.uuid4().hex,
+                "userUuid": args.uuid,
+                "platform": "iOS",
+                "osVersion": "18.2",
+                "deviceModel": args.device_model,
+                "userAgent": "Happ/3.7.0/ios CFNetwork/3860.300.31 Darwin/25.2.0",
+            },
+        }
+    else:
+        data = user
+    return {
+        "event": args.event,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "data": data,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Send a signed fake Remnawave webhook event")
+    parser.add_argument("event", choices=EVENTS)
+    parser.add_argument("--url", default="http://localhost:8000/webhooks/remnawave")
+    parser.add_argument("--secret", default=os.getenv("REMNAWAVE_WEBHOOK_SECRET", ""))
+    parser.add_argument("--uuid", default=str(uuid.uuid4()))
+    parser.add_argument("--short-uuid")
+    parser.add_argument("--username")
+    parser.add_argument("--telegram-id", type=int, default=123456789)
+    parser.add_argument("--status", default="ACTIVE", choices=("ACTIVE", "DISABLED", "LIMITED", "EXPIRED"))
+    parser.add_argument("--device-model", default="iPhone 15 Pro")
+    parser.add_argument("--bad-signature", action="store_true", help="sign with a wrong secret")
+    args = parser.parse_args()
+
+    if not args.secret:
+        parser.error("set REMNAWAVE_WEBHOOK_SECRET or pass --secret")
+
+    body = json.dumps(build_event(args), ensure_ascii=False).encode()
+    secret = args.secret + "-wrong" if args.bad_signature else args.secret
+    headers = {"Content-Type": "application/json", SIGNATURE_HEADER: sign_payload(body, secret)}
+
+    response = httpx.post(args.url, content=body, headers=headers, timeout=10.0)
+    print(f"{response.status_code} {response.text}")
+    sys.exit(0 if response.is_success else 1)
+
+
+if __name__ == "__main__":
+    main()
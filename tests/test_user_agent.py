@@ -0,0 +1,49 @@
+"""Разбор User-Agent клиентов /sub на корпусе реальных строк."""
+
+import pytest
+
+from app.api.services.user_agent import parse_user_agent
+
+# (User-Agent, app_name, app_version, os_name, os_version, device, vendor)
+CORPUS = [
+    ("Happ/3.7.0/ios CFNetwork/3860.300.31 Darwin/25.2.0", "Happ", "3.7.0", "iOS", "18.2", "iPhone", None),
+    ("Happ/3.5.1/ios CFNetwork/1568.100.1 Darwin/24.0.0", "Happ", "3.5.1", "iOS", "17.0", "iPhone", None),
+    ("Happ/1.5.2 (iOS 17.2; iPhone14,3)", "Happ", "1.5.2", "iOS", "17.2", "iPhone", None),
+    ("Happ/2.0.1 (iPadOS; iPad13,4)", "Happ", "2.0.1", "iOS", None, "iPad", None),
+    ("Shadowrocket/2.2.0 (iOS; iPhone)", "Shadowrocket", "2.2.0", "iOS", None, "iPhone", None),
+    ("Streisand/1.6.3 CFNetwork/1494.0.7 Darwin/23.4.0 iOS", "Streisand", "1.6.3", "iOS", "16.4", "iPhone", None),
+    ("V2RayTun/3.0 (Android 14; SM-S918B)", "V2RayTun", "3.0", "Android", "14", "Android", "Samsung"),
+    ("Happ/3.2.0/Android", "Happ", "3.2.0", "Android", None, "Android", None),
+    ("v2rayNG/1.8.19 (Linux; Android 13; Redmi Note 12)", "v2rayNG", "1.8.19", "Android", "13", "Android", "Xiaomi"),
+    ("NekoBox/1.3.1 (Android 12; HUAWEI P40)", "NekoBox", "1.3.1", "Android", "12", "Android", "Huawei"),
+    ("Hiddify/2.5.7 (android)", "Hiddify", "2.5.7", "Android", None, "Android", None),
+    ("Hiddify/2.5.7 (windows)", "Hiddify", "2.5.7", "Windows", None, "Windows PC", None),
+    ("v2rayN/6.42 (Windows NT 10.0; Win64; x64)", "v2rayN", "6.42", "Windows", None, "Windows PC", None),
+    ("FoXray/2.1 (Macintosh; Intel Mac OS X 14_2)", "FoXray", "2.1", "macOS", None, "Mac", None),
+    ("Happ/1.0.4 CFNetwork/1492.0.1 Darwin/23.3.0", "Happ", "1.0.4", "macOS", None, "Mac", None),
+    ("clash-verge/1.6.1 (Linux x86_64)", None, None, "Linux", None, "Linux PC", None),
+    ("ClashMeta/1.18.0", "ClashMeta", "1.18.0", None, None, None, None),
+    ("curl/8.4.0", "curl", "8.4.0", None, None, None, None),
+    ("Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X)", "Mozilla", "5.0", "iOS", None, "iPhone", None),
+    ("", None, None, None, None, None, None),
+    ("Happ/3.1.0 (ios17.2; iPhone15,2)", "Happ", "3.1.0", "iOS", "17.2", "iPhone", None),
+    ("Karing_ios_1.1.2", None, None, "iOS", None, "iPhone", None),
+    ("Radios/4.2 (Linux)", "Radios", "4.2", "Linux", None, "Linux PC", None),
+    ("Studios/1.0", "Studios", "1.0", None, None, None, None),
+]
+
+
+@pytest.mark.parametrize(
+    "ua, app_name, app_version, os_name, os_version, device, vendor",
+    CORPUS,
+    ids=[ua or "<empty>" for ua, *_ in CORPUS],
+)
+def test_parse_user_agent(ua, app_name, app_version, os_name, os_version, device, vendor):
+    info = parse_user_agent(ua)
+    assert (info.app_name, info.app_version, info.os_name, info.os_version, info.device, info.vendor) == (
+        app_name, app_version, os_name, os_version, device, vendor,
+    )
+
+
+def test_empty_user_agent_is_not_cached_separately_from_none():
+    assert parse_user_agent(None) is parse_user_agent("")